@@ -0,0 +1,129 @@
+# address_pool.py
+# Key sets and bot payment addresses made ahead of time,
+# so before_mint() only has to claim one.
+
+import threading
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import config
+import key_util
+from create_db import session_scope, Tokens, TokenStage
+import logging
+logger = logging.getLogger(__name__)
+
+_refill_needed = threading.Event()
+_metrics_lock = threading.Lock()
+_metrics = {
+    'claims': 0,
+    'misses': 0,
+    'refilled': 0,
+    'refill_seconds': 0.0,
+}
+_refiller = None
+
+
+def _count(name, amount=1):
+    with _metrics_lock:
+        _metrics[name] += amount
+
+
+def _pooled():
+    """ Filter for ready key sets not owned by a session yet """
+    return (Tokens.session_uuid.is_(None),
+            Tokens.bot_payment_addr.isnot(None),
+            Tokens.stage >= TokenStage.POLICY_KEYS_READY)
+
+
+def pool_size(session):
+    return session.query(Tokens).filter(*_pooled()).count()
+
+
+def metrics():
+    """ Claim and refill counters plus the current pool size """
+    with session_scope() as session:
+        size = pool_size(session)
+    with _metrics_lock:
+        return dict(_metrics, size=size)
+
+
+def claim(session, session_uuid, **fields):
+    """ Hands a pooled key set to a new session in a single row update
+    Returns False when the pool is empty """
+    fields = dict(fields, session_uuid=session_uuid, date_created=datetime.utcnow())
+    values = {getattr(Tokens, key): value for key, value in fields.items()}
+    # Another thread may take the same row, then try the next one
+    for _ in range(3):
+        pooled_id = session.query(Tokens.id).filter(*_pooled()).limit(1).scalar()
+        if pooled_id is None:
+            break
+        claimed = session.query(Tokens).filter(
+            Tokens.id == pooled_id).filter(
+            Tokens.session_uuid.is_(None)).update(
+            values, synchronize_session=False)
+        session.commit()
+        if claimed:
+            _count('claims')
+            _refill_needed.set()
+            return True
+    _count('misses')
+    _refill_needed.set()
+    return False
+
+
+def create_key_set(session):
+    """ Creates stake, payment and policy keys plus the bot address """
+    key_id = str(uuid4())
+    token_data = Tokens(session_uuid=None)
+    token_data.key_id = key_id
+    stake_vkey = key_util.generate_key_pair(
+        token_data.key_file('stake.vkey'), token_data.key_file('stake.skey'), role='stake')
+    payment_vkey = key_util.generate_key_pair(
+        token_data.key_file('payment.vkey'), token_data.key_file('payment.skey'))
+    key_util.generate_key_pair(
+        token_data.key_file('policy.vkey'), token_data.key_file('policy.skey'))
+    token_data.bot_payment_addr = key_util.build_address(payment_vkey, stake_vkey)
+    token_data.advance(TokenStage.POLICY_KEYS_READY)
+    session.add(token_data)
+    session.commit()
+    return token_data
+
+
+def refill():
+    """ Tops the pool up to the high watermark once it drops below the low one """
+    with session_scope() as session:
+        size = pool_size(session)
+        if size >= config.ADDRESS_POOL_LOW:
+            return 0
+        started = time.monotonic()
+        missing = config.ADDRESS_POOL_HIGH - size
+        for _ in range(missing):
+            create_key_set(session)
+        _count('refilled', missing)
+        _count('refill_seconds', time.monotonic() - started)
+        logger.info(f"Address pool refilled with {missing} key sets")
+        return missing
+
+
+def _refill_loop(stop_event):
+    while not stop_event.is_set():
+        try:
+            refill()
+        except Exception:
+            logger.exception("Address pool refill failed")
+        _refill_needed.wait(config.ADDRESS_POOL_POLL)
+        _refill_needed.clear()
+
+
+def start():
+    """ Starts the background refiller thread """
+    global _refiller
+    if _refiller is not None:
+        return _refiller
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=_refill_loop, args=(stop_event,), name="address-pool", daemon=True)
+    thread.start()
+    _refiller = stop_event
+    return stop_event
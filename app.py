@@ -1,17 +1,34 @@
 # app.py
 
+import mimetypes
 import os
+import zipfile
+import requests
+from sqlalchemy.exc import SQLAlchemyError
 from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import Updater, CommandHandler, MessageHandler, \
-    Filters, CallbackContext, ConversationHandler, Defaults
+    Filters, CallbackContext, ConversationHandler, Defaults, TypeHandler
 from uuid import uuid4
 import logging
 
 # Local Imports
 import config
-from create_db import Session, Tokens
-from ipfs_util import create_ipfs, pin_ipfs
-from token_util import before_mint, mint, get_tx_details, check_wallet_utxo
+import create_db
+from create_db import session_scope
+from ipfs_util import download_chunks, lookup
+from ipfs_pinning import add_and_pin_stream
+from token_util import before_mint, get_tx_details, check_wallet_utxo
+import address_pool
+import cli_runner
+import collection_util
+import mint_queue
+import protocol_params
+import token_repo
+import confirm_watcher
+import funding_watcher
+import user_state
+from persistence import DBPersistence
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,6 +42,7 @@ logging.info('****** NFT-TELEGRAM-BOT START ******')
 API_TOKEN = os.getenv('BOT_API_TOKEN')
 # Conversation STATES
 PHOTO, TICKER, NAME, DESCRIPTION, NUMBER, PRE_MINT = range(6)
+COLLECTION_FILES, COLLECTION_TICKER = range(6, 8)
 
 
 def get_chat_info(chat_update):
@@ -42,6 +60,8 @@ def get_chat_info(chat_update):
 
 def start(update: Update, context: CallbackContext) -> int:
     """ Starts the whole process """
+    # A new draft, a pre-minted session stays around for /MINT
+    user_state.clear(context, 'session_uuid')
     chat_info = get_chat_info(chat_update=update)
     context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -68,43 +88,68 @@ def start(update: Update, context: CallbackContext) -> int:
     context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="Please upload a *PHOTO* using the PHOTO "
-             "upload feature in your Telegram to start minting."
+             "upload feature in your Telegram to start minting. "
+             "Send it as a file to keep the original quality, GIFs and videos work too."
              "\n This will be uploaded and pinned to IPFS, and you'll receive the IPFS hash."
     )
     return PHOTO
 
 def photo(update: Update, context: CallbackContext) -> int:
+    """ Photos are recompressed by Telegram, documents keep the original quality """
     chat_info = get_chat_info(chat_update=update)
-    photo_file = update.message.photo[-1].get_file()
-    logging.info(update.message.photo[-1])
-    file_name = f"{chat_info['username']}_{chat_info['user_id']}_{chat_info['message_id']}.jpg"
-    photo_file.download(file_name)
-    # Upload to BF
-    res = create_ipfs(image=file_name)
-    if res:
-        # Pin it
-        pin_response = pin_ipfs(ipfs_hash=res['ipfs_hash'])
-        if pin_response:
-            update.message.reply_text(
-                "Geeez! Your image is  uploaded and pinned to IPFS:"
-            )
-            update.message.reply_text(
-                f"We made this link for you! \n"
-                f"https://gateway.ipfs.io/ipfs/{res['ipfs_hash']}"
-            )
-            context.user_data["token_ipfs_hash"] = res['ipfs_hash']
-        else:
-            update.message.reply_text(
-                'Something failed here? Pin to blockfrost.io failed.'
-            )
-            return ConversationHandler.END
+    file_name = f"{chat_info['username']}_{chat_info['user_id']}_{chat_info['message_id']}"
+    if update.message.document:
+        media = update.message.document
+        file_name += os.path.splitext(media.file_name or '')[1].lower()
+    else:
+        media = update.message.photo[-1]
+        file_name += '.jpg'
+    logging.info(media)
+    if media.file_size and media.file_size > config.BLOCKFROST_IPFS_MAX_BYTES:
+        update.message.reply_text(
+            f"Sorry, that file is too big. The limit is "
+            f"{config.BLOCKFROST_IPFS_MAX_BYTES // (1024 * 1024)} MB, please send a smaller one."
+        )
+        return PHOTO
+    try:
+        # Retries of the same file skip Telegram and IPFS altogether
+        ipfs_hash = lookup(file_unique_id=media.file_unique_id)
+        if not ipfs_hash:
+            try:
+                media_file = media.get_file()
+            except TelegramError as err:
+                update.message.reply_text(f"Sorry, Telegram won't hand over that file: {err}")
+                return PHOTO
+            progress = None
+            if media.file_size and media.file_size > config.IPFS_PROGRESS_MIN_BYTES:
+                view = collection_util.ProgressView(
+                    context.bot, update.effective_chat.id, "Uploading to IPFS", [file_name])
+                total = media.file_size / (1024 * 1024)
+
+                def progress(sent):
+                    view.update(0, f"{sent / (1024 * 1024):.1f} of {total:.1f} MB")
+            # Stream from Telegram to BF, nothing is written to disk
+            ipfs_hash = add_and_pin_stream(
+                file_name, download_chunks(media_file.file_path),
+                file_unique_id=media.file_unique_id, progress=progress, size=media.file_size)
+    except (requests.RequestException, TelegramError, SQLAlchemyError):
+        logging.exception("Streaming upload failed")
+        ipfs_hash = False
+    if ipfs_hash:
+        update.message.reply_text(
+            "Geeez! Your image is  uploaded and pinned to IPFS:"
+        )
+        update.message.reply_text(
+            f"We made this link for you! \n"
+            f"https://gateway.ipfs.io/ipfs/{ipfs_hash}"
+        )
+        context.user_data["token_ipfs_hash"] = ipfs_hash
     else:
         update.message.reply_text(
-            'Something failed here? Upload to blockfrost.io failed.'
+            'Something failed here? Upload or pin to blockfrost.io failed.'
         )
+        user_state.clear(context, 'session_uuid')
         return ConversationHandler.END
-    # Remove left overs
-    os.remove(file_name)
     # Respond to get ticker
     context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -113,13 +158,14 @@ def photo(update: Update, context: CallbackContext) -> int:
     )
     return TICKER
 
-def skip_photo(update: Update, _: CallbackContext) -> int:
+def skip_photo(update: Update, context: CallbackContext) -> int:
     """ User doesn't want to upload an image, End the session. """
     user = update.message.from_user
     logging.info(f"User {user.username} did not upload a photo.")
     update.message.reply_text(
         'Process Ended. Use /start to try again.'
     )
+    user_state.clear(context, 'session_uuid')
     return ConversationHandler.END
 
 
@@ -191,6 +237,7 @@ def put_before_mint(update: Update, context: CallbackContext) -> int:
                 'token_desc': context.user_data.get('token_desc', 'Not found'),
                 'token_number': context.user_data.get('token_number', 'Not found'),
                 'token_ipfs_hash': context.user_data.get('token_ipfs_hash', 'Not found'),
+                'chat_id': update.effective_chat.id,
             }
             update.message.reply_text(
                 "Here is the metadata data for the NFT. \n"
@@ -207,26 +254,26 @@ def put_before_mint(update: Update, context: CallbackContext) -> int:
             if before_minted:
                 # Means we updated the DB and have a addr to send funds to
                 # Start DB Session to get addr
-                session = Session()
-                sesh_exists = session.query(Tokens).filter(
-                    Tokens.session_uuid == session_uuid).scalar() is not None
-                if sesh_exists:
-                    token_data = session.query(Tokens).filter(
-                        Tokens.session_uuid == session_uuid).one()
+                with session_scope() as session:
+                    token_data = token_repo.get(session, session_uuid)
+                    if token_data is not None:
+                        session.expunge(token_data)
+                if token_data is not None:
                     logging.info(f'Session Data Created: {token_data}')
                     logging.info(f'Bot Address: {token_data.bot_payment_addr}')
                     # At this point we need the bot_payment_addr to have UTXO to burn
                     update.message.reply_text(f'Please send 5 ADA to the following address:')
                     update.message.reply_text(f'*{token_data.bot_payment_addr}*')
                     update.message.reply_text(
-                        f'Once the ransaction is confirmed in your Daedalus wallet, \n'
-                        f'run the /MINT command.')
+                        f'Minting starts automatically once the transaction is confirmed, \n'
+                        f'no need to do anything else. You can also run the /MINT command.')
                     return ConversationHandler.END
                 else:
                     update.message.reply_text("No Session Data yet. /start to begin.")
                     return ConversationHandler.END
             else:
                 update.message.reply_text("Pre-mint failed, check bot logs.")
+                user_state.clear(context)
                 return ConversationHandler.END
         else:
             update.message.reply_text("No Data yet. /start to begin.")
@@ -235,62 +282,144 @@ def put_before_mint(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 def put_mint(update: Update, context: CallbackContext) -> int:
-    """ Returns the token data to user """
-    session_uuid = context.user_data['session_uuid']
-    user = get_chat_info(update)
-    creator_username = user['username']
-
-    # Start DB Session to get addr
-    session = Session()
-    sesh_exists = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).scalar() is not None
+    """ Queues the minting job, the mint workers report back to the chat """
+    session_uuid = context.user_data.get('session_uuid')
+
+    # Start DB Session to check the session
+    sesh_exists = False
+    if session_uuid:
+        with session_scope() as session:
+            sesh_exists = token_repo.get(session, session_uuid) is not None
     if sesh_exists:
-        # Add a check for the UTXO, bail if not found
-        token_data = session.query(Tokens).filter(
-            Tokens.session_uuid == session_uuid).one()
-        logging.info(f'Searching for the UTXOs in address: {token_data}')
-        bot_payment_addr = token_data.bot_payment_addr
-        update.message.reply_text("Checking for confirmed transactions.")
-        utxo = check_wallet_utxo(bot_payment_addr)
-        if utxo:
-            sesh = {'session_uuid': session_uuid}
-            update.message.reply_text("OK, I found the Transaction!")
+        queued = mint_queue.enqueue(session_uuid, update.effective_chat.id)
+        if queued:
+            # Everything needed is in the DB now, session_uuid stays
+            # until eviction so a failed or expired mint can be retried
+            user_state.clear(context, 'session_uuid')
             update.message.reply_text(
                 "Please grab a coffee as I build your NFT "
-                "I'll ssend it back to you with your change in ADA."
+                "I'll send it back to you with your change in ADA."
+            )
+            update.message.reply_text(
+                "Your NFT is queued for minting, I'll keep you posted here."
             )
-            update.message.reply_text("Initiating NFT Minting process....")
-            minted = mint(**sesh)
-            if minted:
-                update.message.reply_text(
-                    f"Holey Baloney! \n your token is minted, @{creator_username}."
-                )
-                update.message.reply_text(
-                    f"The token should arrive in your wallet any second now."
-                )
-                update.message.reply_text(
-                    f"Thank you for using the *NFT-TELEGRAM-BOT*. \n Have a Daedalus day."
-                )
-                return ConversationHandler.END
-            else:
-                update.message.reply_text(
-                    f"Something failed, please try not to panic, "
-                    f"but you may have hit a bug. Sorry."
-                )
-                return ConversationHandler.END
         else:
             update.message.reply_text(
-                f"Sorry, but there is no UTXO to use yet. "
-                f"Transaction not found."
-                f"Please try running /MINT again in a few moments."
+                "This session is already queued or minted."
             )
-            return ConversationHandler.END
+        return ConversationHandler.END
     update.message.reply_text(
         f"Sorry, but there is no PRE_MINT session yet. "
         f"Please try /start again in a few moments."
     )
     return ConversationHandler.END
 
+#
+# Collections
+#
+
+def start_collection(update: Update, context: CallbackContext) -> int:
+    """ Starts a collection, many NFTs under one policy """
+    context.user_data['collection_files'] = []
+    update.message.reply_text(
+        "Let's mint a *collection*. \n"
+        "Send a ZIP archive with your images and a manifest.csv or manifest.json, "
+        "or send your images as an album followed by the manifest as a file. \n"
+        "The manifest has the columns file, name, description and optionally number, "
+        "numbers are assigned in order otherwise."
+    )
+    update.message.reply_text("Type /done when everything is uploaded.")
+    return COLLECTION_FILES
+
+def collection_file(update: Update, context: CallbackContext) -> int:
+    """ Collects the images, archives and manifest of a collection """
+    message = update.message
+    files = context.user_data.setdefault('collection_files', [])
+    if message.photo:
+        files.append((f"photo_{len(files) + 1:03d}.jpg", message.photo[-1].file_id))
+    else:
+        document = message.document
+        # Some clients send no file name, the MIME type tells what it is
+        extension = mimetypes.guess_extension(document.mime_type or '') or ''
+        file_name = document.file_name or f"file_{len(files) + 1:03d}{extension}"
+        files.append((file_name, document.file_id))
+    # Albums arrive as one message per photo, don't answer every one
+    if not message.media_group_id:
+        update.message.reply_text(f"Got it, {len(files)} file(s) so far. Type /done when finished.")
+    return COLLECTION_FILES
+
+def collection_done(update: Update, context: CallbackContext) -> int:
+    """ All files are in, ask for the ticker """
+    if not context.user_data.get('collection_files'):
+        update.message.reply_text("Nothing uploaded yet, send your images first.")
+        return COLLECTION_FILES
+    update.message.reply_text(
+        "Provide a 4-5 character token ticker for the collection, e.g. MINE. \n"
+        "Every token is named after it plus its number, e.g. MINE001."
+    )
+    return COLLECTION_TICKER
+
+def collection_ticker(update: Update, context: CallbackContext) -> int:
+    """ Uploads the collection to IPFS and sets up its policy and bot address """
+    chat_info = get_chat_info(chat_update=update)
+    chat_id = update.effective_chat.id
+    ticker = update.message.text.strip().upper()
+    files = context.user_data.pop('collection_files', [])
+    update.message.reply_text("Reading your files...")
+    try:
+        media = []
+        manifest = None
+        for file_name, file_id in files:
+            data = bytes(context.bot.get_file(file_id).download_as_bytearray())
+            if file_name.lower().endswith('.zip'):
+                archive_media, archive_manifest = collection_util.read_archive(data)
+                media += archive_media
+                manifest = archive_manifest or manifest
+            elif collection_util.is_manifest(file_name):
+                manifest = collection_util.parse_manifest(file_name, data)
+            else:
+                media.append((file_name, data))
+        items = collection_util.build_items(media, manifest)
+    except (ValueError, zipfile.BadZipFile) as err:
+        logging.exception("Collection files could not be read")
+        update.message.reply_text(f"Sorry, that didn't work: {err} \n/collection to try again.")
+        return ConversationHandler.END
+    except TelegramError as err:
+        # e.g. files over the 20 MB the Bot API hands out
+        logging.exception("Collection files could not be downloaded")
+        update.message.reply_text(
+            f"Sorry, Telegram won't hand over your files: {err} \n/collection to try again.")
+        return ConversationHandler.END
+
+    try:
+        view = collection_util.ProgressView(
+            context.bot, chat_id, "Uploading your collection to IPFS",
+            [f"#{item['number']} {item['name']}" for item in items])
+        if not collection_util.upload_items(items, view):
+            update.message.reply_text(
+                'Something failed here? Upload to blockfrost.io failed. /collection to try again.'
+            )
+            return ConversationHandler.END
+
+        collection = collection_util.create_collection(
+            chat_info['username'], chat_id, ticker, items)
+    except (cli_runner.CliError, SQLAlchemyError, OSError, TelegramError):
+        logging.exception("Collection could not be created")
+        update.message.reply_text(
+            "Something failed while setting up your collection, sorry. /collection to try again.")
+        return ConversationHandler.END
+    update.message.reply_text(
+        f"Your collection of {collection.item_count} NFTs uses policy ID: \n"
+        f"{collection.policy_id}"
+    )
+    update.message.reply_text(
+        f'Please send {collection.required_lovelace / 1000000:g} ADA to the following address:')
+    update.message.reply_text(f'*{collection.bot_payment_addr}*')
+    update.message.reply_text(
+        'Minting starts automatically once the transaction is confirmed, '
+        'the change is sent back with your tokens.')
+    return ConversationHandler.END
+
 #
 # Misc Helper Chat Commands
 #
@@ -324,6 +453,9 @@ def get_tx(update: Update, context: CallbackContext) -> int:
     logging.info(f"tx_hash: {tx_hash}")
     data = get_tx_details(tx_hash=tx_hash)
     logging.info(data)
+    if not data:
+        update.message.reply_text("Transaction not found (yet).")
+        return ConversationHandler.END
     update.message.reply_text("Transaction found.")
     update.message.reply_text(
         f"{data}"
@@ -347,24 +479,42 @@ def get_utxo(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 
-def cancel(update: Update, _: CallbackContext) -> int:
+def cancel(update: Update, context: CallbackContext) -> int:
     """ User opted to end the conversation """
     user = update.message.from_user
     logging.info(f"User {user.username} canceled the conversation.")
+    user_state.clear(context, 'session_uuid')
     update.message.reply_text('Bye!')
     return ConversationHandler.END
 
+def timeout(update: Update, context: CallbackContext) -> None:
+    """ The user went quiet for CONVERSATION_TIMEOUT, drop the draft """
+    logging.info(f"Conversation of {update.effective_user.id} timed out.")
+    user_state.clear(context, 'session_uuid')
+    context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="Your session timed out. Use /start or /collection to begin again."
+    )
+
 def main() -> None:
     """Start the bot."""
+    # Bring the DB schema up to date, the persistence loads from it right away
+    create_db.init_db()
+    # Session files, a volume mounted by every replica in multi-node setups
+    os.makedirs(config.SHARED_DIR, exist_ok=True)
     # Create the Updater and pass it your token and private key
+    # Conversations and user_data survive restarts and deploys
     updater = Updater(
         token=API_TOKEN,
         use_context=True,
-        defaults=Defaults(parse_mode='Markdown')
+        defaults=Defaults(parse_mode='Markdown'),
+        persistence=DBPersistence()
     )
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
+    # Track every user's activity first, idle users are evicted
+    dispatcher.add_handler(TypeHandler(Update, user_state.touch), group=-1)
 
     # Handlers
     # Add conversation handler with the states PHOTO, TICKER, NAME, DESCRIPTION, NUMBER, and PRE_MINT
@@ -372,21 +522,62 @@ def main() -> None:
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            PHOTO: [MessageHandler(Filters.photo, photo), CommandHandler('skip', skip_photo)],
+            # Uploads can take minutes, keep the dispatcher free for other users
+            PHOTO: [
+                MessageHandler(Filters.photo | Filters.document, photo, run_async=True),
+                CommandHandler('skip', skip_photo)
+            ],
             TICKER: [MessageHandler(Filters.text & ~Filters.command, put_ticker)],
             NAME: [MessageHandler(Filters.text & ~Filters.command, put_token_name)],
             DESCRIPTION: [MessageHandler(Filters.text & ~Filters.command, put_token_desc)],
             NUMBER: [MessageHandler(Filters.text & ~Filters.command, put_token_number)],
-            PRE_MINT: [MessageHandler(Filters.text & ~Filters.command, put_before_mint)]
+            PRE_MINT: [MessageHandler(Filters.text & ~Filters.command, put_before_mint)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, timeout)]
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        conversation_timeout=config.CONVERSATION_TIMEOUT,
+        name='mint',
+        persistent=True,
     )
     dispatcher.add_handler(conv_handler)
+    # Collections: bulk upload, one policy, minted in batches
+    collection_handler = ConversationHandler(
+        entry_points=[CommandHandler('collection', start_collection)],
+        states={
+            COLLECTION_FILES: [
+                MessageHandler(Filters.photo | Filters.document, collection_file),
+                CommandHandler('done', collection_done)
+            ],
+            # Uploading takes a while, keep the dispatcher free
+            COLLECTION_TICKER: [
+                MessageHandler(Filters.text & ~Filters.command, collection_ticker, run_async=True)
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, timeout)]
+        },
+        fallbacks=[CommandHandler('cancel', cancel)],
+        conversation_timeout=config.CONVERSATION_TIMEOUT,
+        name='collection',
+        persistent=True,
+    )
+    dispatcher.add_handler(collection_handler)
     dispatcher.add_handler(CommandHandler('get_token_data', get_token_data))
     dispatcher.add_handler(CommandHandler('get_tx', get_tx))
     dispatcher.add_handler(CommandHandler('get_utxo', get_utxo))
     dispatcher.add_handler(CommandHandler('MINT', put_mint))
 
+    # Keep the protocol parameters fresh across epochs
+    protocol_params.start()
+    # Keep ready made bot addresses around for pre-minting
+    address_pool.start()
+    # Start the workers that drain the mint queue
+    mint_queue.start(updater.bot)
+    # One watcher confirms every submitted transaction
+    confirm_watcher.start(updater.bot)
+    # One watcher detects funding of every bot address
+    funding_watcher.start(updater.bot)
+    # Reclaim the user_data of abandoned sessions
+    user_state.start(dispatcher)
+
     # Start the Bot
     updater.start_polling()
 
@@ -394,6 +585,7 @@ def main() -> None:
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    create_db.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,41 @@
+# cbor_util.py
+# Minimal CBOR encoder for native scripts, metadata and transactions.
+# Maps and arrays are always definite length and keep insertion order.
+
+
+def _head(major, value):
+    """ Major type plus argument in the shortest form """
+    if value < 24:
+        return bytes([major << 5 | value])
+    if value < 0x100:
+        return bytes([major << 5 | 24, value])
+    if value < 0x10000:
+        return bytes([major << 5 | 25]) + value.to_bytes(2, 'big')
+    if value < 0x100000000:
+        return bytes([major << 5 | 26]) + value.to_bytes(4, 'big')
+    return bytes([major << 5 | 27]) + value.to_bytes(8, 'big')
+
+
+def dumps(obj):
+    """ Serializes int, bytes, str, list, tuple, dict, bool and None """
+    if obj is None:
+        return b'\xf6'
+    if obj is True:
+        return b'\xf5'
+    if obj is False:
+        return b'\xf4'
+    if isinstance(obj, int):
+        if obj >= 0:
+            return _head(0, obj)
+        return _head(1, -1 - obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return _head(2, len(obj)) + bytes(obj)
+    if isinstance(obj, str):
+        data = obj.encode('utf-8')
+        return _head(3, len(data)) + data
+    if isinstance(obj, (list, tuple)):
+        return _head(4, len(obj)) + b''.join(dumps(item) for item in obj)
+    if isinstance(obj, dict):
+        return _head(5, len(obj)) + b''.join(
+            dumps(key) + dumps(value) for key, value in obj.items())
+    raise TypeError(f"Can't CBOR encode {type(obj).__name__}")
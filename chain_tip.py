@@ -0,0 +1,52 @@
+# chain_tip.py
+# Cached chain tip, the current slot is extrapolated from wall-clock time
+# between node queries.
+
+import json
+import threading
+import time
+
+import cli_runner
+import config
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_cache = {'tip': None, 'fetched_at': None}
+
+
+def _query_tip():
+    result = cli_runner.run(
+        ['query', 'tip', '--testnet-magic', config.TESTNET_ID], check=True)
+    logger.info(result.stdout)
+    return json.loads(result.stdout)
+
+
+def staleness():
+    """ Seconds since the node was last asked for the tip, None if never """
+    fetched_at = _cache['fetched_at']
+    if fetched_at is None:
+        return None
+    return time.monotonic() - fetched_at
+
+
+def get_tip(max_age=None):
+    """ Returns the last known tip, querying the node when it is older than max_age """
+    if max_age is None:
+        max_age = config.TIP_REFRESH_SECONDS
+    age = staleness()
+    if age is not None and age < max_age:
+        return _cache['tip']
+    with _lock:
+        # Someone else may have refreshed while we waited
+        age = staleness()
+        if age is None or age >= max_age:
+            _cache['tip'] = _query_tip()
+            _cache['fetched_at'] = time.monotonic()
+        return _cache['tip']
+
+
+def current_slot():
+    """ Last known tip slot plus the slots passed since it was fetched """
+    tip = get_tip()
+    return tip['slot'] + int(staleness() / config.SLOT_LENGTH)
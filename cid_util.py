@@ -0,0 +1,166 @@
+# cid_util.py
+# IPFS CIDs computed locally, same as `ipfs add` with its defaults:
+# CIDv0, 256 KiB fixed size chunks, balanced DAG of at most 174 links,
+# UnixFS file leaves wrapped in dag-pb nodes.
+
+import base64
+import hashlib
+
+CHUNK_SIZE = 256 * 1024
+MAX_LINKS = 174
+
+# UnixFS Data.Type
+UNIXFS_FILE = 2
+
+# Multicodec of dag-pb nodes and of sha2-256 hashes
+DAG_PB = 0x70
+SHA2_256 = 0x12
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(data):
+    """ Returns the varint at the start of data and the rest """
+    value = shift = 0
+    for index, byte in enumerate(data):
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, data[index + 1:]
+    raise ValueError("Truncated varint")
+
+
+def _field(number, value):
+    """ Protobuf field, ints as varints, bytes length delimited """
+    if isinstance(value, int):
+        return _varint(number << 3) + _varint(value)
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _unixfs(filesize, data=None, blocksizes=()):
+    message = _field(1, UNIXFS_FILE)
+    if data:
+        message += _field(2, data)
+    message += _field(3, filesize)
+    for size in blocksizes:
+        message += _field(4, size)
+    return message
+
+
+def _dag_pb(data, links=()):
+    """ dag-pb PBNode, links go first
+    links: [(multihash, tsize)] """
+    node = b''
+    for multihash, tsize in links:
+        link = _field(1, multihash) + _field(2, b'') + _field(3, tsize)
+        node += _field(2, link)
+    return node + _field(1, data)
+
+
+def _multihash(block):
+    """ sha2-256 multihash """
+    return b'\x12\x20' + hashlib.sha256(block).digest()
+
+
+def base58(data):
+    number = int.from_bytes(data, 'big')
+    out = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        out = BASE58_ALPHABET[remainder] + out
+    # Leading zero bytes are kept as '1'
+    padding = len(data) - len(data.lstrip(b'\x00'))
+    return BASE58_ALPHABET[0] * padding + out
+
+
+def base58_decode(text):
+    number = 0
+    for char in text:
+        number = number * 58 + BASE58_ALPHABET.index(char)
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    padding = len(text) - len(text.lstrip(BASE58_ALPHABET[0]))
+    return b'\x00' * padding + data
+
+
+def to_v0(cid):
+    """ The CIDv0 of a CID, e.g. the base32 CIDv1 NFT.Storage answers with
+    None when it has no CIDv0, i.e. it is not a dag-pb node hashed with sha2-256 """
+    try:
+        if cid.startswith('Qm'):
+            multihash = base58_decode(cid)
+        elif cid.startswith('b'):
+            # Multibase base32, lower case without padding
+            encoded = cid[1:].upper()
+            raw = base64.b32decode(encoded + '=' * (-len(encoded) % 8))
+            version, raw = _read_varint(raw)
+            codec, multihash = _read_varint(raw)
+            if version != 1 or codec != DAG_PB:
+                return None
+        else:
+            return None
+    except ValueError:
+        return None
+    if multihash[:2] != bytes([SHA2_256, 32]) or len(multihash) != 34:
+        return None
+    return base58(multihash)
+
+
+class CidBuilder:
+    """ Computes the CID of a file fed in chunks of any size
+    Only the leaf hashes are kept, memory stays small for large files """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # (multihash, tsize, filesize) per leaf
+        self._leaves = []
+        self.size = 0
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        self._buffer += chunk
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._add_leaf(bytes(self._buffer[:CHUNK_SIZE]))
+            del self._buffer[:CHUNK_SIZE]
+
+    def _add_leaf(self, data):
+        block = _dag_pb(_unixfs(len(data), data))
+        self._leaves.append((_multihash(block), len(block), len(data)))
+
+    def cid(self):
+        """ CIDv0 of everything fed so far """
+        if self._buffer or not self._leaves:
+            self._add_leaf(bytes(self._buffer))
+            self._buffer.clear()
+        level = self._leaves
+        # Balanced layout: leaves grouped by MAX_LINKS until one root is left
+        while len(level) > 1:
+            parents = []
+            for start in range(0, len(level), MAX_LINKS):
+                children = level[start:start + MAX_LINKS]
+                filesize = sum(child[2] for child in children)
+                block = _dag_pb(
+                    _unixfs(filesize, blocksizes=[child[2] for child in children]),
+                    [(child[0], child[1]) for child in children])
+                tsize = len(block) + sum(child[1] for child in children)
+                parents.append((_multihash(block), tsize, filesize))
+            level = parents
+        return base58(level[0][0])
+
+
+def compute_cid(data):
+    """ CIDv0 of in-memory file data """
+    builder = CidBuilder()
+    builder.update(data)
+    return builder.cid()
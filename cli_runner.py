@@ -0,0 +1,94 @@
+# cli_runner.py
+# Every cardano-cli call goes through here: no shell, a global
+# concurrency limit, timeouts, captured stderr and latency metrics.
+
+import asyncio
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+import config
+import logging
+logger = logging.getLogger(__name__)
+
+CliResult = namedtuple('CliResult', 'returncode stdout stderr seconds')
+
+_slots = threading.BoundedSemaphore(config.CLI_CONCURRENCY)
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+class CliError(RuntimeError):
+    """ cardano-cli failed, timed out or could not be started """
+
+
+def _command_name(args):
+    """ e.g. 'query utxo' or 'transaction submit' """
+    return ' '.join(arg for arg in args[:2] if not arg.startswith('-'))
+
+
+def _record(name, seconds, failed=False, timed_out=False):
+    with _metrics_lock:
+        stats = _metrics.setdefault(
+            name, {'calls': 0, 'errors': 0, 'timeouts': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['timeouts'] += timed_out
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def metrics():
+    """ Per command call counts, errors, timeouts and latency """
+    with _metrics_lock:
+        return {name: dict(stats) for name, stats in _metrics.items()}
+
+
+def run(args, timeout=None, check=False):
+    """ Runs cardano-cli with the given arguments
+    Raises CliError on timeout, or on a non zero exit when check is set """
+    args = [str(arg) for arg in args]
+    name = _command_name(args)
+    if timeout is None:
+        timeout = config.CLI_TIMEOUTS.get(name, config.CLI_TIMEOUT)
+    with _slots:
+        started = time.monotonic()
+        try:
+            proc = subprocess.run(
+                [config.CARDANO_CLI] + args,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _record(name, time.monotonic() - started, failed=True, timed_out=True)
+            raise CliError(f"cardano-cli {name} timed out after {timeout}s")
+        except OSError as err:
+            _record(name, time.monotonic() - started, failed=True)
+            raise CliError(f"cardano-cli {name} could not start: {err}")
+        seconds = time.monotonic() - started
+    result = CliResult(
+        proc.returncode,
+        str(proc.stdout, 'UTF-8'),
+        str(proc.stderr, 'UTF-8'),
+        seconds
+    )
+    _record(name, seconds, failed=result.returncode != 0)
+    if result.returncode != 0:
+        logger.error(f"cardano-cli {name} exited {result.returncode}: {result.stderr.strip()}")
+        if check:
+            raise CliError(f"cardano-cli {name} failed: {result.stderr.strip()}")
+    return result
+
+
+async def run_async(args, timeout=None, check=False):
+    """ asyncio entry point, shares the concurrency limit with run() """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: run(args, timeout, check))
+
+
+def run_many(commands, timeout=None):
+    """ Runs independent commands side by side, returns results in order
+    Failures are returned as CliError instances instead of raised """
+    async def _gather():
+        return await asyncio.gather(
+            *(run_async(args, timeout) for args in commands), return_exceptions=True)
+    return asyncio.run(_gather())
@@ -0,0 +1,361 @@
+# collection_util.py
+# Collections: many NFTs from one bulk upload, minted under a single policy.
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+import config
+import key_util
+import policy_util
+import protocol_params
+import token_repo
+import tx_util
+from create_db import session_scope, Tokens, TokenStage, Collections
+from ipfs_pinning import add_and_pin_data
+from token_util import get_current_slot, get_tx_details, submit_tx
+import logging
+logger = logging.getLogger(__name__)
+
+MEDIA_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.mp4')
+MANIFEST_EXTENSIONS = ('.csv', '.json')
+
+
+def is_manifest(file_name):
+    return file_name.lower().endswith(MANIFEST_EXTENSIONS)
+
+
+def parse_manifest(file_name, data):
+    """ Manifest rows with file, name, description and an optional number
+    CSV needs a header row, JSON is a list of objects """
+    if file_name.lower().endswith('.json'):
+        rows = json.loads(data)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("The JSON manifest must be a list of objects")
+    else:
+        rows = list(csv.DictReader(io.StringIO(bytes(data).decode('utf-8-sig'))))
+    return [
+        {str(key).strip().lower(): str(value).strip() for key, value in row.items() if value is not None}
+        for row in rows
+    ]
+
+
+def read_archive(data):
+    """ Returns the media files [(name, bytes)] and manifest rows of a zip """
+    files = []
+    manifest = None
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            name = os.path.basename(info.filename)
+            # Skip folders and macOS resource forks
+            if info.is_dir() or name.startswith('.') or '__MACOSX' in info.filename:
+                continue
+            total += info.file_size
+            if total > config.COLLECTION_MAX_BYTES:
+                raise ValueError("Archive is too big")
+            if is_manifest(name):
+                manifest = parse_manifest(name, archive.read(info))
+            elif name.lower().endswith(MEDIA_EXTENSIONS):
+                files.append((name, archive.read(info)))
+    files.sort()
+    return files, manifest
+
+
+def build_items(files, manifest):
+    """ Matches manifest rows to files by file name, or in order without one
+    Numbers are auto assigned unless the manifest has them """
+    by_name = dict(files)
+    rows = manifest or [{} for _ in files]
+    if not rows:
+        raise ValueError("No images found")
+    if len(rows) > config.COLLECTION_MAX_ITEMS:
+        raise ValueError(f"A collection holds at most {config.COLLECTION_MAX_ITEMS} items")
+    items = []
+    for index, row in enumerate(rows):
+        file_name = row.get('file') or row.get('filename')
+        if file_name:
+            if file_name not in by_name:
+                raise ValueError(f"{file_name} is in the manifest but was not uploaded")
+            data = by_name[file_name]
+        elif index < len(files):
+            file_name, data = files[index]
+        else:
+            raise ValueError("The manifest has more rows than there are images")
+        items.append({
+            'file_name': file_name,
+            'data': data,
+            'number': int(row.get('number') or index + 1),
+            'name': row.get('name') or os.path.splitext(file_name)[0],
+            'description': row.get('description', ''),
+        })
+    numbers = [item['number'] for item in items]
+    if len(set(numbers)) != len(numbers):
+        raise ValueError("Token numbers must be unique")
+    return items
+
+
+class ProgressView:
+    """ One chat message with a status line per item, edited in place """
+    # Telegram rejects longer messages
+    MAX_LENGTH = 4096
+
+    def __init__(self, bot, chat_id, title, labels):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.title = title
+        self.labels = labels
+        self.status = ['waiting'] * len(labels)
+        self._lock = threading.Lock()
+        self._last_edit = 0
+        self.message = bot.send_message(chat_id=chat_id, text=self._text(), parse_mode=None)
+
+    def _text(self):
+        lines = [self.title]
+        lines += [f"{label}: {status}" for label, status in zip(self.labels, self.status)]
+        text = '\n'.join(lines)
+        if len(text) > self.MAX_LENGTH:
+            # Too many items to list, show a summary instead
+            counts = {}
+            for status in self.status:
+                counts[status] = counts.get(status, 0) + 1
+            text = '\n'.join([self.title] + [f"{s}: {n}" for s, n in counts.items()])
+        return text
+
+    def update(self, index, status, force=False):
+        with self._lock:
+            self.status[index] = status
+            # Don't hit Telegram's edit rate limit
+            if not force and time.monotonic() - self._last_edit < config.PROGRESS_EDIT_INTERVAL:
+                return
+            self._last_edit = time.monotonic()
+            text = self._text()
+        try:
+            self.bot.edit_message_text(
+                text, chat_id=self.chat_id, message_id=self.message.message_id, parse_mode=None)
+        except Exception:
+            logger.info("Progress view not updated")
+
+    def flush(self):
+        with self._lock:
+            self._last_edit = 0
+        self.update(0, self.status[0], force=True)
+
+
+def upload_items(items, view=None):
+    """ Uploads and pins every item in parallel, sets item['ipfs_hash']
+    Returns True when all items made it """
+    def upload(index):
+        item = items[index]
+        try:
+            if view:
+                view.update(index, 'uploading')
+            # Items pinned before are not uploaded again
+            ipfs_hash = add_and_pin_data(item['file_name'], item['data'])
+            if not ipfs_hash:
+                raise ValueError("Upload or pin failed")
+        except Exception:
+            logger.exception(f"Upload failed for {item['file_name']}")
+            if view:
+                view.update(index, 'upload failed')
+            return False
+        item['ipfs_hash'] = ipfs_hash
+        if view:
+            view.update(index, f"pinned {ipfs_hash}")
+        return True
+
+    with ThreadPoolExecutor(max_workers=config.IPFS_UPLOAD_WORKERS) as pool:
+        uploaded = list(pool.map(upload, range(len(items))))
+    if view:
+        view.flush()
+    return all(uploaded)
+
+
+def create_collection(creator_username, chat_id, ticker, items):
+    """ Creates one set of keys, bot address and policy plus a Tokens row per item
+    Returns the Collections row """
+    collection_uuid = str(uuid4())
+    collection = Collections(collection_uuid=collection_uuid)
+    collection.chat_id = chat_id
+    collection.creator_username = creator_username
+    collection.token_ticker = ticker
+    collection.item_count = len(items)
+
+    stake_vkey = key_util.generate_key_pair(
+        collection.key_file('stake.vkey'), collection.key_file('stake.skey'), role='stake')
+    payment_vkey = key_util.generate_key_pair(
+        collection.key_file('payment.vkey'), collection.key_file('payment.skey'))
+    policy_vkey = key_util.generate_key_pair(
+        collection.key_file('policy.vkey'), collection.key_file('policy.skey'))
+    collection.bot_payment_addr = key_util.build_address(payment_vkey, stake_vkey)
+
+    # Every batch has to be minted before the policy locks
+    collection.invalid_after_slot = get_current_slot() + config.COLLECTION_SLOT_BUFFER
+    collection.policy_keyhash = key_util.key_hash(policy_vkey)
+    policy_dict = policy_util.build_policy(
+        collection.policy_keyhash, before_slot=collection.invalid_after_slot)
+    with open(f'{config.SHARED_DIR}/{collection_uuid}-policy.script', 'w') as policy_script_out:
+        json.dump(policy_dict, policy_script_out)
+    collection.policy_id = policy_util.policy_id(policy_dict)
+    collection.required_lovelace = config.MIN_FUNDING_LOVELACE + \
+        config.COLLECTION_LOVELACE_PER_ITEM * len(items)
+
+    with session_scope() as session:
+        session.add(collection)
+        for item in items:
+            token_data = Tokens(session_uuid=str(uuid4()))
+            token_data.update(
+                collection_uuid=collection_uuid,
+                chat_id=chat_id,
+                creator_username=creator_username,
+                token_ticker=ticker,
+                asset_name=f"{ticker}{item['number']:03d}",
+                token_name=item['name'],
+                token_desc=item['description'],
+                token_number=item['number'],
+                token_ipfs_hash=item['ipfs_hash'],
+                policy_keyhash=collection.policy_keyhash,
+                policy_id=collection.policy_id,
+                invalid_after_slot=collection.invalid_after_slot,
+            )
+            # Keys, funding and policy belong to the collection
+            token_data.advance(TokenStage.POLICY_READY)
+            session.add(token_data)
+        session.commit()
+        session.refresh(collection)
+        session.expunge(collection)
+    logger.info(f"Created collection {collection_uuid} with {len(items)} items")
+    return collection
+
+
+def _batch_tx(collection, batch, final, params, policy_dict, signing_keys):
+    """ Mints a batch of items to the creator
+    The change goes back to the bot address unless this is the final batch """
+    policy_id = collection.policy_id
+    assets = {policy_id: {t.asset(): t.token_amount for t in batch}}
+    metadata = {"721": {policy_id: {
+        t.asset(): {
+            "image": f"ipfs://{t.token_ipfs_hash}",
+            "ticker": t.token_ticker,
+            "name": t.token_name,
+            "description": t.token_desc,
+            "number": t.token_number,
+        } for t in batch
+    }}}
+    if final:
+        outputs = [(collection.creator_pay_addr, collection.utxo_lovelace, assets)]
+        fee_payers = (0,)
+    else:
+        token_lovelace = tx_util.min_ada(assets, params)
+        outputs = [
+            (collection.creator_pay_addr, token_lovelace, assets),
+            (collection.bot_payment_addr, collection.utxo_lovelace - token_lovelace, None),
+        ]
+        fee_payers = (1,)
+    signed = tx_util.build_signed_tx(
+        inputs=[(collection.utxo_tx_hash, collection.utxo_tx_ix)],
+        outputs=outputs,
+        invalid_hereafter=collection.invalid_after_slot,
+        protocol_params=params,
+        signing_keys=signing_keys,
+        scripts=[policy_dict],
+        mint=assets,
+        metadata=metadata,
+        fee_payers=fee_payers,
+    )
+    # Change left for the next batch
+    change = 0 if final else outputs[1][1] - signed[3]
+    if change < (0 if final else tx_util.min_ada(None, params)):
+        raise ValueError("Not enough funds left for the next batch")
+    return signed, change
+
+
+def _fit_batch(collection, items, params, policy_dict, signing_keys):
+    """ The largest batch from the start of items that fits maxTxSize """
+    max_size = params['maxTxSize'] * config.BATCH_SIZE_MARGIN
+    batch = items[:config.COLLECTION_BATCH_MAX]
+    while True:
+        final = len(batch) == len(items)
+        signed, change = _batch_tx(collection, batch, final, params, policy_dict, signing_keys)
+        size = len(signed[0])
+        if size <= max_size or len(batch) == 1:
+            return batch, final, signed, change
+        batch = batch[:min(len(batch) - 1, int(len(batch) * max_size / size))]
+
+
+def mint_collection(collection_uuid, on_item=None, on_start=None):
+    """ Mints every item of a funded collection in as few transactions as fit
+    Batches are chained, each spends the change of the one before
+    on_start(token_numbers) is called once the funding is confirmed,
+    on_item(token_number, text) receives per item updates
+    Returns None when it is too early to mint """
+    on_item = on_item or (lambda number, text: None)
+    with session_scope() as session:
+        collection = session.query(Collections).filter(
+            Collections.collection_uuid == collection_uuid).one_or_none()
+        if collection is None or not collection.utxo_tx_hash:
+            logger.info(f"Collection not found or not funded: {collection_uuid}")
+            return False
+        if not collection.creator_pay_addr:
+            # Send the tokens back to whoever funded the collection
+            tx_details = get_tx_details(collection.utxo_tx_hash)
+            if not tx_details:
+                # Try again on a later pass
+                logger.info(f"Funding of {collection_uuid} not indexed by Blockfrost yet")
+                return None
+            collection.creator_pay_addr = tx_details['inputs'][0]['address']
+            session.commit()
+
+        items = session.query(Tokens).filter(
+            Tokens.collection_uuid == collection_uuid).filter(
+            Tokens.stage < TokenStage.SUBMITTED).order_by(
+            Tokens.token_number).all()
+        if on_start:
+            on_start([t.token_number for t in items])
+        params = protocol_params.get()
+        with open(f'{config.SHARED_DIR}/{collection_uuid}-policy.script') as policy_script_in:
+            policy_dict = json.load(policy_script_in)
+        signing_keys = [
+            key_util.signing_key(collection.key_file('payment.skey')),
+            key_util.signing_key(collection.key_file('policy.skey')),
+        ]
+
+        batch_number = 0
+        while items:
+            batch_number += 1
+            batch, final, signed, change = _fit_batch(
+                collection, items, params, policy_dict, signing_keys)
+            signed_tx, raw_tx, tx_id, tx_fee = signed
+            tx_prefix = f'{config.SHARED_DIR}/{collection_uuid}-batch{batch_number}'
+            tx_util.write_envelope(f'{tx_prefix}-matx.raw', tx_util.TX_BODY_TYPE, raw_tx)
+            matx_signed = f'{tx_prefix}-matx.signed'
+            tx_util.write_envelope(matx_signed, tx_util.TX_SIGNED_TYPE, signed_tx)
+            if not submit_tx(matx_signed):
+                logger.info(f"Batch {batch_number} of {collection_uuid} failed to submit")
+                for token_data in batch:
+                    on_item(token_data.token_number, 'failed')
+                return False
+            logger.info(f"Batch {batch_number} of {collection_uuid} submitted: {tx_id} fee {tx_fee}")
+            if not final:
+                collection.utxo_tx_hash = tx_id
+                collection.utxo_tx_ix = 1
+                collection.utxo_lovelace = change
+            # The batch and the collection's new change UTXO in one commit
+            token_repo.advance_all(
+                session, batch, TokenStage.SUBMITTED,
+                creator_pay_addr=collection.creator_pay_addr,
+                tx_file=matx_signed,
+                tx_submitted_at=datetime.utcnow(),
+                tx_resubmits=0,
+            )
+            for token_data in batch:
+                on_item(token_data.token_number, f'submitted in batch {batch_number}')
+            items = items[len(batch):]
+        return True
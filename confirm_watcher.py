@@ -0,0 +1,161 @@
+# confirm_watcher.py
+
+import threading
+from datetime import datetime
+
+import chain_tip
+import config
+from create_db import session_scope, Tokens, TokenStage
+from mint_queue import notify, CONFIRMED, EXPIRED
+from token_util import query_utxos, submit_txs
+import logging
+logger = logging.getLogger(__name__)
+
+_watcher = None
+
+
+def _pending(session):
+    """ All submitted sessions still waiting for their token on chain
+    Replicas sharing a server database each lock a different share """
+    return session.query(Tokens).filter(
+        Tokens.stage == TokenStage.SUBMITTED).filter(
+        Tokens.token_tx_hash.is_(None)).with_for_update(skip_locked=True).all()
+
+
+def _find_token_utxo(token_data, utxos):
+    """ Returns the UTXO holding the freshly minted token, or None """
+    policy_id = (token_data.policy_id or '').strip()
+    asset = token_data.asset() or ''
+    for utxo in utxos.get(token_data.creator_pay_addr, []):
+        tokens = utxo['assets'].get(policy_id, {})
+        # Newer cardano-cli versions show asset names hex encoded
+        if asset in tokens or asset.encode('utf-8').hex() in tokens:
+            return utxo
+    return None
+
+
+def _notify_collections(bot, session, collections):
+    """ One message per collection once none of its items is pending """
+    for collection_uuid, (chat_id, expired) in collections.items():
+        pending = session.query(Tokens).filter(
+            Tokens.collection_uuid == collection_uuid).filter(
+            Tokens.stage == TokenStage.SUBMITTED).count()
+        if pending:
+            continue
+        if expired:
+            notify(bot, chat_id, "Some items of your collection expired before they "
+                                 "were confirmed, the policy is locked now. Sorry.")
+        else:
+            notify(bot, chat_id, "Holey Baloney! \n your whole collection is minted.")
+
+
+def resubmit(*pending):
+    """ Counts a resubmission of pending sessions
+    Returns their signed transaction files, submit them with submit_txs() """
+    # Sessions of a batch mint share one transaction
+    matx_signed = sorted(
+        {t.tx_file or f'{config.SHARED_DIR}/{t.session_uuid}-matx.signed' for t in pending})
+    for token_data in pending:
+        token_data.tx_resubmits = (token_data.tx_resubmits or 0) + 1
+        token_data.tx_submitted_at = datetime.utcnow()
+    return matx_signed
+
+
+def _pending_addresses():
+    """ Creator addresses of all submitted sessions, read without locks """
+    with session_scope() as session:
+        return {addr for (addr,) in session.query(Tokens.creator_pay_addr).filter(
+            Tokens.stage == TokenStage.SUBMITTED).filter(
+            Tokens.token_tx_hash.is_(None)).distinct()}
+
+
+def check_pending(bot, tip_slot):
+    """ Resolves every pending session in one batched UTXO query
+    The node is queried before any row is locked, transactions are
+    resubmitted and chats are told after the commit """
+    addresses = _pending_addresses()
+    if not addresses:
+        return
+    utxos = query_utxos(addresses)
+    # (chat_id, text) sent once the new stages are committed
+    messages = []
+    matx_signed = []
+    with session_scope() as session:
+        # Sessions submitted since the query are found on a later pass
+        pending = _pending(session)
+        now = datetime.utcnow()
+        slow = []
+        # Collection items are reported per collection, not per item
+        collections = {}
+        for token_data in pending:
+            utxo = _find_token_utxo(token_data, utxos)
+            if utxo and token_data.collection_uuid:
+                token_data.token_tx_hash = utxo['tx_hash']
+                token_data.mint_stage = CONFIRMED
+                token_data.advance(TokenStage.CONFIRMED)
+                collections.setdefault(token_data.collection_uuid, (token_data.chat_id, False))
+            elif utxo:
+                logger.info(f"Confirmed {token_data.session_uuid}: {utxo['tx_hash']}")
+                token_data.token_tx_hash = utxo['tx_hash']
+                token_data.mint_stage = CONFIRMED
+                token_data.advance(TokenStage.CONFIRMED)
+                messages += [
+                    (token_data.chat_id,
+                     f"Holey Baloney! \n your token is minted, @{token_data.creator_username}."),
+                    (token_data.chat_id, f"Transaction: {utxo['tx_hash']}"),
+                    (token_data.chat_id,
+                     "Thank you for using the *NFT-TELEGRAM-BOT*. \n Have a Daedalus day."),
+                ]
+            elif token_data.invalid_after_slot and tip_slot > token_data.invalid_after_slot:
+                # The transaction can never make it on chain now,
+                # the funds are untouched so the user can mint again.
+                # The policy is locked too, a new one is made on the next try
+                logger.info(f"Transaction expired for {token_data.session_uuid}")
+                token_data.advance(TokenStage.FUNDED)
+                token_data.mint_stage = EXPIRED
+                if token_data.collection_uuid:
+                    collections[token_data.collection_uuid] = (token_data.chat_id, True)
+                    continue
+                messages.append((token_data.chat_id,
+                                 "Your transaction expired before it was confirmed. "
+                                 "Your funds are safe, please run /MINT again."))
+            elif token_data.tx_submitted_at and \
+                    (now - token_data.tx_submitted_at).total_seconds() > config.CONFIRM_RESUBMIT_AFTER and \
+                    (token_data.tx_resubmits or 0) < config.CONFIRM_MAX_RESUBMITS:
+                slow.append(token_data)
+        if slow:
+            matx_signed = resubmit(*slow)
+        session.commit()
+        if matx_signed:
+            logger.info(f"Resubmitting {matx_signed}")
+            submit_txs(matx_signed)
+        for chat_id, text in messages:
+            notify(bot, chat_id, text)
+        _notify_collections(bot, session, collections)
+
+
+def _watch(bot, stop_event):
+    last_block = None
+    while not stop_event.wait(config.CONFIRM_POLL):
+        try:
+            tip = chain_tip.get_tip()
+            # Nothing can be confirmed until a new block arrives
+            if tip.get('hash') == last_block:
+                continue
+            last_block = tip.get('hash')
+            check_pending(bot, chain_tip.current_slot())
+        except Exception:
+            logger.exception("Confirmation watcher pass failed")
+
+
+def start(bot):
+    """ Starts the single shared confirmation watcher thread """
+    global _watcher
+    if _watcher is not None:
+        return _watcher
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=_watch, args=(bot, stop_event), name="confirm-watcher", daemon=True)
+    thread.start()
+    _watcher = stop_event
+    return stop_event
@@ -1,18 +1,103 @@
 # ### CREATE A DB ###
 
-from sqlalchemy import Column, Integer, \
-    String, DateTime, Boolean
-from sqlalchemy.orm import sessionmaker
+import enum
+import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, BigInteger, \
+    String, DateTime, Boolean, Text, Index
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.functions import current_timestamp
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 
 import config
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _create_engine(uri):
+    if not uri.startswith('sqlite'):
+        # Server database, shared by every bot replica
+        return create_engine(
+            uri, pool_pre_ping=True,
+            pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW)
+    # Handler threads, workers and watchers share the file
+    engine = create_engine(
+        uri, connect_args={'check_same_thread': False, 'timeout': config.SQLITE_BUSY_TIMEOUT})
+
+    @event.listens_for(engine, 'connect')
+    def _pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma in config.SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {pragma}')
+        cursor.close()
+    return engine
 
-engine = create_engine(config.SQLALCHEMY_DATABASE_URI)
+
+engine = _create_engine(config.SQLALCHEMY_DATABASE_URI)
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
+# One session per thread for session_scope()
+_registry = scoped_session(Session)
+_scope_depth = threading.local()
+
+
+@contextmanager
+def session_scope(independent=False):
+    """ The thread's session, nested scopes share it
+    The outermost scope commits, rolls back on errors and always closes it
+    independent: a session of its own, outside the caller's transaction,
+    for writes like caches that must neither fail nor be undone with it """
+    if independent:
+        session = Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return
+    depth = getattr(_scope_depth, 'value', 0)
+    _scope_depth.value = depth + 1
+    session = _registry()
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except Exception:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        _scope_depth.value = depth
+        if depth == 0:
+            _registry.remove()
+
+
+class TokenStage(enum.IntEnum):
+    """ How far a session got, every stage implies the ones before it
+    Collection items start at POLICY_READY, the collection is funded instead """
+    NEW = 0
+    # Stake and payment keys plus the bot payment address
+    KEYS_READY = 10
+    POLICY_KEYS_READY = 20
+    # Funding UTXO and the creator's address are known
+    FUNDED = 30
+    # Policy script and policy ID
+    POLICY_READY = 40
+    METADATA_READY = 50
+    SIGNED = 60
+    SUBMITTED = 70
+    CONFIRMED = 80
+
+
 class Tokens(Base):
     """ Individual Token data """
     __tablename__ = 'tokens'
@@ -27,8 +112,8 @@ class Tokens(Base):
         default=current_timestamp()
     )
 
-    # Token Bot Session UUID
-    session_uuid = Column(String())
+    # Token Bot Session UUID, NULL for pooled key sets
+    session_uuid = Column(String(36), unique=True, index=True)
 
     # Creator Details
     creator_username = Column(String())
@@ -41,39 +126,53 @@ class Tokens(Base):
     token_number = Column(Integer, default=0)
     # Added, maybe future use with generic Native Tokens..?
     token_amount = Column(Integer, default=1)
-    token_ipfs_hash = Column(String(50))
+    # CIDv0 from Blockfrost, CIDv1 from NFT.Storage
+    token_ipfs_hash = Column(String(64))
+
+    # Collection items share the policy and funding of their collection
+    collection_uuid = Column(String(36), index=True)
+    # Defaults to the ticker, collection items add their number
+    asset_name = Column(String(32))
+
+    # Progress through the mint pipeline, see TokenStage
+    stage = Column(Integer, default=TokenStage.NEW, index=True)
+    stage_at = Column(DateTime)
+    # JSON of stage name -> time it was reached
+    stage_log = Column(Text)
 
     # Stake Keys and Payment Keys
-    stake_keys_created = Column(Boolean, default=False)
-    payment_keys_created = Column(Boolean, default=False)
+    # Key files are {SHARED_DIR}/{key_id}-*, pooled keys are made before the session
+    key_id = Column(String(36))
 
     # The bot ADA address for funding
-    bot_payment_addr = Column(String(128))
-
-    protocol_params_created = Column(Boolean, default=False)
+    bot_payment_addr = Column(String(128), index=True)
 
-    policy_keys_created = Column(Boolean, default=False)
-    policy_script_created = Column(Boolean, default=False)
     policy_keyhash = Column(String(64))
     policy_id = Column(String(64))
     current_slot = Column(Integer)
     slot_cushion = Column(Integer)
     invalid_after_slot = Column(Integer)
 
-    # Token metadata.json
-    metadata_created = Column(Boolean, default=False)
-
     # UTXO to burn from bot payment_addr
     utxo_tx_hash = Column(String(64))
     utxo_tx_ix = Column(Integer)
     utxo_lovelace = Column(Integer)
 
     # Mint Transaction
-    raw_tx_created = Column(Boolean, default=False)
-    signed_tx_created = Column(Boolean, default=False)
-    tx_submitted = Column(Boolean, default=False)
+    # Signed TX file, shared by every session of a batch mint
+    tx_file = Column(String(128))
+    tx_submitted_at = Column(DateTime)
+    tx_resubmits = Column(Integer, default=0)
     token_tx_hash = Column(String(64))
 
+    # Mint job queue, see mint_queue.py
+    chat_id = Column(BigInteger)
+    mint_stage = Column(String(16), index=True)
+    mint_queued_at = Column(DateTime)
+    # config.NODE_ID of the bot process minting it
+    mint_claimed_by = Column(String(64))
+    mint_claimed_at = Column(DateTime)
+
     def __init__(self, session_uuid):
         self.session_uuid = session_uuid
 
@@ -85,12 +184,262 @@ class Tokens(Base):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    def key_file(self, name):
+        """ Path of a key file, e.g. key_file('payment.skey') """
+        return f'{config.SHARED_DIR}/{self.key_id or self.session_uuid}-{name}'
+
+    def asset(self):
+        """ The on-chain asset name """
+        return self.asset_name or self.token_ticker
+
+    def reached(self, stage):
+        """ True when the session got to stage or further """
+        return (self.stage or TokenStage.NEW) >= stage
+
+    def advance(self, stage, when=None):
+        """ Moves to stage in memory and logs the time, see token_repo.advance """
+        when = when or datetime.utcnow()
+        log = json.loads(self.stage_log) if self.stage_log else {}
+        log[TokenStage(stage).name] = when.isoformat()
+        self.stage_log = json.dumps(log)
+        self.stage = int(stage)
+        self.stage_at = when
+
+
+class Collections(Base):
+    """ A series of tokens minted under one policy """
+    __tablename__ = 'collections'
+
+    id = Column(
+        Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    date_created = Column(
+        DateTime,
+        default=current_timestamp()
+    )
+    collection_uuid = Column(String(36), unique=True, index=True)
+    chat_id = Column(BigInteger)
+
+    # Creator Details
+    creator_username = Column(String())
+    creator_pay_addr = Column(String())
+
+    token_ticker = Column(String(5))
+    item_count = Column(Integer, default=0)
+
+    # One set of keys, one bot address and one policy for every item
+    key_id = Column(String(36))
+    bot_payment_addr = Column(String(128), index=True)
+    required_lovelace = Column(Integer)
+    policy_keyhash = Column(String(64))
+    policy_id = Column(String(64))
+    invalid_after_slot = Column(Integer)
+
+    # Funding UTXO, then the change of each submitted batch
+    utxo_tx_hash = Column(String(64))
+    utxo_tx_ix = Column(Integer)
+    utxo_lovelace = Column(Integer)
+
+    mint_stage = Column(String(16), index=True)
+    mint_queued_at = Column(DateTime)
+    mint_claimed_by = Column(String(64))
+    mint_claimed_at = Column(DateTime)
+
+    def __init__(self, collection_uuid):
+        self.collection_uuid = collection_uuid
+        self.key_id = collection_uuid
+
+    def __repr__(self):
+        return f"{self.collection_uuid} - {self.token_ticker} x{self.item_count}"
+
+    def key_file(self, name):
+        """ Path of a key file, e.g. key_file('policy.skey') """
+        return f'{config.SHARED_DIR}/{self.key_id}-{name}'
+
+class IpfsContent(Base):
+    """ Content already uploaded and pinned, looked up by CID or Telegram file """
+    __tablename__ = 'ipfs_content'
+
+    id = Column(
+        Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    date_created = Column(
+        DateTime,
+        default=current_timestamp()
+    )
+    cid = Column(String(64), index=True)
+    # Telegram's stable id of the file, the same for every re-send
+    file_unique_id = Column(String(64), index=True)
+    size = Column(BigInteger)
+    pinned = Column(Boolean, default=False)
+
+    def __init__(self, cid):
+        self.cid = cid
+
+    def __repr__(self):
+        return f"{self.cid} - {self.size} bytes"
+
+class TxDetails(Base):
+    """ Blockfrost UTXO data of confirmed transactions, see tx_cache.py """
+    __tablename__ = 'tx_details'
+
+    id = Column(
+        Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    date_created = Column(
+        DateTime,
+        default=current_timestamp()
+    )
+    tx_hash = Column(String(64), unique=True, index=True)
+    # JSON as returned by /txs/{hash}/utxos
+    details = Column(Text)
+
+    def __init__(self, tx_hash, details):
+        self.tx_hash = tx_hash
+        self.details = details
+
+    def __repr__(self):
+        return f"{self.tx_hash}"
+
+class UserDataEntry(Base):
+    """ One context.user_data key of a user, see persistence.py """
+    __tablename__ = 'user_data'
+    __table_args__ = (
+        Index('ix_user_data_user_key', 'user_id', 'key', unique=True),
+    )
+
+    id = Column(
+        Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    user_id = Column(BigInteger, nullable=False)
+    key = Column(String(64), nullable=False)
+    # JSON encoded value
+    value = Column(Text)
+    updated_at = Column(DateTime, default=current_timestamp(), index=True)
+
+    def __init__(self, user_id, key, value, updated_at=None):
+        self.user_id = user_id
+        self.key = key
+        self.value = value
+        self.updated_at = updated_at
+
+    def __repr__(self):
+        return f"{self.user_id} - {self.key}"
+
+class ConversationState(Base):
+    """ State of a ConversationHandler conversation, see persistence.py """
+    __tablename__ = 'conversation_states'
+    __table_args__ = (
+        Index('ix_conversation_states_name_key', 'name', 'key', unique=True),
+    )
+
+    id = Column(
+        Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+    # ConversationHandler name
+    name = Column(String(32), nullable=False)
+    # JSON list of the chat and user ids
+    key = Column(String(64), nullable=False)
+    state = Column(Integer)
+    updated_at = Column(DateTime, default=current_timestamp(), index=True)
+
+    def __init__(self, name, key, state, updated_at=None):
+        self.name = name
+        self.key = key
+        self.state = state
+        self.updated_at = updated_at
+
+    def __repr__(self):
+        return f"{self.name} {self.key} - {self.state}"
+
+# Boolean progress flags of older DBs, most advanced first
+# (column the condition reads, condition, stage)
+_LEGACY_STAGES = [
+    ("token_tx_hash", "token_tx_hash IS NOT NULL", TokenStage.CONFIRMED),
+    # Expired transactions need a new policy
+    ("mint_stage", "mint_stage = 'expired'", TokenStage.FUNDED),
+    ("tx_submitted", "tx_submitted", TokenStage.SUBMITTED),
+    ("signed_tx_created", "signed_tx_created", TokenStage.SIGNED),
+    ("metadata_created", "metadata_created", TokenStage.METADATA_READY),
+    ("policy_id", "policy_id IS NOT NULL", TokenStage.POLICY_READY),
+    ("creator_pay_addr", "creator_pay_addr IS NOT NULL", TokenStage.FUNDED),
+    ("policy_keys_created", "policy_keys_created", TokenStage.POLICY_KEYS_READY),
+    ("bot_payment_addr", "bot_payment_addr IS NOT NULL", TokenStage.KEYS_READY),
+]
+
+def _convert_legacy_stages(conn, existing):
+    """ Sets the stage from the old progress flags
+    existing: the tokens columns from before the migration """
+    cases = ' '.join(
+        f"WHEN {condition} THEN {int(stage)}"
+        for column, condition, stage in _LEGACY_STAGES if column in existing)
+    conn.execute(text(
+        f"UPDATE tokens SET stage = CASE {cases} ELSE {int(TokenStage.NEW)} END, "
+        f"stage_at = CURRENT_TIMESTAMP"))
+    logger.info("Converted progress flags to stages")
+
+def migrate():
+    """ Brings an existing DB up to date with the models
+    Missing columns and indexes are added, the old progress flags become a stage """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in tables:
+                # create_all() takes care of it
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                conn.execute(text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logger.info(f"Added {table.name}.{column.name}")
+            # Only once every column is there, the conversion sets stage_at too
+            if table.name == 'tokens' and 'stage' not in existing and 'tx_submitted' in existing:
+                _convert_legacy_stages(conn, existing)
+    _migrate_indexes(tables)
+
+def _migrate_indexes(tables):
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=engine)
+                logger.info(f"Added index {index.name}")
+            except SQLAlchemyError as err:
+                # e.g. duplicate session_uuids from before the unique index
+                logger.warning(f"Could not add index {index.name}: {err}")
+
+def init_db():
+    """ Migrates an existing DB, creates whatever is missing """
+    migrate()
+    Base.metadata.create_all(engine)
+
+def shutdown():
+    """ Closes this thread's scoped session and every pooled connection """
+    _registry.remove()
+    engine.dispose()
+
 def main():
     """ Creates the DB with Token table """
-    Base.metadata.create_all(engine)
-    session = Session()
-    session.commit()
-    session.close()
+    init_db()
     print("Created DB")
 
 
@@ -0,0 +1,114 @@
+# funding_watcher.py
+
+import threading
+from datetime import datetime, timedelta
+
+import config
+import mint_queue
+from create_db import session_scope, Tokens, TokenStage, Collections
+from token_util import query_utxos
+import logging
+logger = logging.getLogger(__name__)
+
+_watcher = None
+
+
+def _unfunded(session, *columns):
+    """ Sessions with a bot address that has not been funded yet
+    Includes mints that failed because /MINT ran before enough funds arrived """
+    since = datetime.utcnow() - timedelta(hours=config.FUNDING_WINDOW_HOURS)
+    return session.query(*(columns or (Tokens,))).filter(
+        Tokens.session_uuid.isnot(None)).filter(
+        Tokens.bot_payment_addr.isnot(None)).filter(
+        Tokens.utxo_tx_hash.is_(None)).filter(
+        Tokens.mint_stage.is_(None) |
+        ((Tokens.mint_stage == mint_queue.FAILED) & (Tokens.stage < TokenStage.FUNDED))).filter(
+        Tokens.date_created >= since)
+
+
+def _unfunded_collections(session, *columns):
+    since = datetime.utcnow() - timedelta(hours=config.FUNDING_WINDOW_HOURS)
+    return session.query(*(columns or (Collections,))).filter(
+        Collections.bot_payment_addr.isnot(None)).filter(
+        Collections.utxo_tx_hash.is_(None)).filter(
+        Collections.date_created >= since)
+
+
+def _unfunded_addresses():
+    """ Bot addresses still waiting for funds, read without locks """
+    with session_scope() as session:
+        return {addr for (addr,) in _unfunded(session, Tokens.bot_payment_addr)} | \
+            {addr for (addr,) in _unfunded_collections(session, Collections.bot_payment_addr)}
+
+
+def _check_collections(bot, collections, utxos):
+    """ Records the funding UTXO of collections that received enough ADA """
+    funded = []
+    for collection in collections:
+        found = utxos.get(collection.bot_payment_addr, [])
+        big_enough = [u for u in found if u['lovelace'] >= collection.required_lovelace]
+        if not big_enough:
+            continue
+        utxo = big_enough[0]
+        logger.info(f"Funding found for collection {collection.collection_uuid}: {utxo['tx_hash']}")
+        collection.utxo_tx_hash = utxo['tx_hash']
+        collection.utxo_tx_ix = utxo['tx_ix']
+        collection.utxo_lovelace = utxo['lovelace']
+        funded.append((collection.collection_uuid, collection.chat_id))
+    return funded
+
+
+def check_funding(bot):
+    """ Queries every unfunded bot address at once and queues funded mints
+    The node is queried before any row is locked """
+    addresses = _unfunded_addresses()
+    if not addresses:
+        return
+    utxos = query_utxos(addresses)
+    funded = []
+    with session_scope() as session:
+        # Replicas sharing a server database each lock a different share
+        unfunded = _unfunded(session).with_for_update(skip_locked=True).all()
+        collections = _unfunded_collections(session).with_for_update(skip_locked=True).all()
+        funded_collections = _check_collections(bot, collections, utxos)
+        for token_data in unfunded:
+            found = utxos.get(token_data.bot_payment_addr, [])
+            big_enough = [u for u in found if u['lovelace'] >= config.MIN_FUNDING_LOVELACE]
+            if not big_enough:
+                if found:
+                    logger.info(f"Not enough funds yet at {token_data.bot_payment_addr}")
+                continue
+            utxo = big_enough[0]
+            logger.info(f"Funding found for {token_data.session_uuid}: {utxo['tx_hash']}")
+            token_data.utxo_tx_hash = utxo['tx_hash']
+            token_data.utxo_tx_ix = utxo['tx_ix']
+            token_data.utxo_lovelace = utxo['lovelace']
+            funded.append((token_data.session_uuid, token_data.chat_id))
+
+    for collection_uuid, chat_id in funded_collections:
+        mint_queue.notify(bot, chat_id, "OK, I found your Transaction! Minting your collection now.")
+        mint_queue.enqueue_collection(collection_uuid)
+    for session_uuid, chat_id in funded:
+        mint_queue.notify(bot, chat_id, "OK, I found your Transaction! Minting starts now.")
+        mint_queue.enqueue(session_uuid, chat_id)
+
+
+def _watch(bot, stop_event):
+    while not stop_event.wait(config.FUNDING_POLL):
+        try:
+            check_funding(bot)
+        except Exception:
+            logger.exception("Funding watcher pass failed")
+
+
+def start(bot):
+    """ Starts the single shared funding watcher thread """
+    global _watcher
+    if _watcher is not None:
+        return _watcher
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=_watch, args=(bot, stop_event), name="funding-watcher", daemon=True)
+    thread.start()
+    _watcher = stop_event
+    return stop_event
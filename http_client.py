@@ -0,0 +1,196 @@
+# http_client.py
+# One HTTP layer for Blockfrost, IPFS providers, gateways and Telegram
+# file downloads: keep-alive pools per host, token bucket rate limits per
+# API key, jittered exponential backoff on 429 and 5xx, latency and quota
+# metrics.
+
+import random
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import config
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+logger = logging.getLogger(__name__)
+
+# Worth another try, the request may not have been handled
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Share of the daily quota that triggers a warning
+QUOTA_WARNING = 0.9
+
+_sessions_lock = threading.Lock()
+_sessions = {}
+_limiters_lock = threading.Lock()
+_limiters = {}
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+class QuotaExceeded(requests.RequestException):
+    """ The daily quota of an API key is used up """
+
+
+class TokenBucket:
+    """ rate tokens per second, at most burst saved up
+    daily_limit: calls per UTC day, None for no limit """
+
+    def __init__(self, rate, burst, daily_limit=None):
+        self.rate = rate
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.day = datetime.utcnow().date()
+        self.used_today = 0
+        self.warned = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is free
+        Raises QuotaExceeded once daily_limit calls were made today """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                today = datetime.utcnow().date()
+                if today != self.day:
+                    self.day = today
+                    self.used_today = 0
+                    self.warned = False
+                if self.daily_limit and self.used_today >= self.daily_limit:
+                    # Refused by the API anyway, don't waste a call on it
+                    raise QuotaExceeded(f"Daily quota of {self.daily_limit} calls used up")
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += 1
+                    if (self.daily_limit and not self.warned and
+                            self.used_today >= self.daily_limit * QUOTA_WARNING):
+                        self.warned = True
+                        logger.warning(f"{self.used_today} of the daily quota of "
+                                       f"{self.daily_limit} calls used")
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def quota(self):
+        with self._lock:
+            return {
+                'used_today': self.used_today,
+                'daily_limit': self.daily_limit,
+                'tokens': round(self.tokens, 2)
+            }
+
+
+def _limiter(name):
+    """ The bucket of a config.HTTP_RATE_LIMITS entry, one per API key """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = TokenBucket(*config.HTTP_RATE_LIMITS[name])
+        return _limiters[name]
+
+
+def _session(host):
+    """ Keep-alive connection pool per host """
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=config.HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+
+def _record(host, seconds, failed=False, retried=False):
+    with _metrics_lock:
+        stats = _metrics.setdefault(
+            host, {'calls': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['retries'] += retried
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def metrics():
+    """ Per host latency and errors, per API key quota usage """
+    with _metrics_lock:
+        hosts = {host: dict(stats) for host, stats in _metrics.items()}
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {
+        'hosts': hosts,
+        'quotas': {name: bucket.quota() for name, bucket in limiters.items()}
+    }
+
+
+def _backoff(attempt, res=None):
+    """ Seconds to wait before the next attempt, full jitter
+    A Retry-After header wins when the server sends one """
+    retry_after = res.headers.get('Retry-After') if res is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), config.HTTP_BACKOFF_MAX)
+    ceiling = min(config.HTTP_BACKOFF_MAX, config.HTTP_BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def _replayable(kwargs):
+    """ Generator and file bodies can only be sent once """
+    data = kwargs.get('data')
+    if data is not None and not isinstance(data, (bytes, str, dict, list, tuple)):
+        return False
+    for value in (kwargs.get('files') or {}).values():
+        content = value[1] if isinstance(value, tuple) else value
+        if not isinstance(content, (bytes, str)):
+            return False
+    return True
+
+
+def request(method, url, rate_limit=None, retries=None, **kwargs):
+    """ requests.request() through the shared pools
+    rate_limit: name of a config.HTTP_RATE_LIMITS entry
+    Retries 429, 5xx and connection errors with backoff, the last
+    response is returned so callers still raise_for_status() """
+    host = urlsplit(url).netloc
+    kwargs.setdefault('timeout', config.HTTP_TIMEOUT)
+    if retries is None:
+        retries = config.HTTP_RETRIES if _replayable(kwargs) else 0
+    session = _session(host)
+    for attempt in range(retries + 1):
+        if rate_limit:
+            _limiter(rate_limit).acquire()
+        started = time.monotonic()
+        try:
+            res = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            _record(host, time.monotonic() - started, failed=True, retried=attempt < retries)
+            if attempt == retries:
+                raise
+            time.sleep(_backoff(attempt))
+            continue
+        failed = res.status_code >= 400
+        retry = res.status_code in RETRY_STATUS and attempt < retries
+        _record(host, time.monotonic() - started, failed=failed, retried=retry)
+        if not retry:
+            return res
+        logger.warning(f"{method} {host} answered {res.status_code}, retrying")
+        wait = _backoff(attempt, res)
+        res.close()
+        time.sleep(wait)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
@@ -0,0 +1,103 @@
+# ipfs_gateways.py
+# Public gateway availability: all gateways are probed side by side,
+# the first one serving the CID answers. Results are cached per CID.
+# Freshly pinned content can be prefetched so wallets find it hot.
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import http_client
+import requests
+import logging
+logger = logging.getLogger(__name__)
+
+_cache_lock = threading.Lock()
+# cid -> (available, checked_at)
+_cache = {}
+_pool = ThreadPoolExecutor(
+    max_workers=config.IPFS_GATEWAY_WORKERS, thread_name_prefix='ipfs-gateway')
+
+
+def _probe(gateway, cid):
+    """ True when the gateway serves the CID """
+    try:
+        # A slow gateway is as good as a missing one here, no retries
+        res = http_client.head(
+            f"{gateway}{cid}", timeout=config.IPFS_GATEWAY_TIMEOUT,
+            allow_redirects=True, retries=0)
+    except requests.RequestException as err:
+        logger.info(f"{gateway} unreachable for {cid}: {err}")
+        return False
+    logger.info(f"{gateway}{cid}: {res.status_code}")
+    return res.status_code == 200
+
+
+def _cached(cid, max_age):
+    with _cache_lock:
+        entry = _cache.get(cid)
+    if entry and time.monotonic() - entry[1] < max_age:
+        return entry[0]
+    return None
+
+
+def _store(cid, available):
+    with _cache_lock:
+        _cache[cid] = (available, time.monotonic())
+        # Drop expired entries now and then
+        if len(_cache) > config.IPFS_AVAILABILITY_CACHE_SIZE:
+            now = time.monotonic()
+            for key in [k for k, (_, at) in _cache.items()
+                        if now - at >= config.IPFS_AVAILABILITY_TTL]:
+                del _cache[key]
+
+
+async def check_async(cid, max_age=None):
+    """ asyncio entry point, True as soon as one gateway serves the CID """
+    if max_age is None:
+        max_age = config.IPFS_AVAILABILITY_TTL
+    available = _cached(cid, max_age)
+    if available is not None:
+        return available
+    loop = asyncio.get_running_loop()
+    probes = [loop.run_in_executor(_pool, _probe, gateway, cid)
+              for gateway in config.IPFS_GATEWAYS]
+    available = False
+    for probe in asyncio.as_completed(probes):
+        if await probe:
+            available = True
+            break
+    # The other probes finish on their own, nobody waits for them
+    _store(cid, available)
+    logger.info(f"Availability of {cid}: {available}")
+    return available
+
+
+def check(cid, max_age=None):
+    """ True when at least one gateway serves the CID, cached for max_age seconds """
+    return asyncio.run(check_async(cid, max_age))
+
+
+def _warm(gateway, cid):
+    """ Reads the content through the gateway so it fetches and caches it """
+    try:
+        with http_client.get(f"{gateway}{cid}", stream=True,
+                             timeout=config.IPFS_PREFETCH_TIMEOUT) as res:
+            res.raise_for_status()
+            for _ in res.iter_content(chunk_size=config.IPFS_STREAM_CHUNK):
+                pass
+    except requests.RequestException as err:
+        logger.info(f"Prefetch of {cid} via {gateway} failed: {err}")
+        return
+    logger.info(f"Prefetched {cid} via {gateway}")
+    _store(cid, True)
+
+
+def prefetch(cid):
+    """ Warms every gateway up in the background, returns right away """
+    if not config.IPFS_PREFETCH:
+        return
+    for gateway in config.IPFS_GATEWAYS:
+        _pool.submit(_warm, gateway, cid)
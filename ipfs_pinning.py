@@ -0,0 +1,259 @@
+# ipfs_pinning.py
+# Pluggable IPFS pinning providers. Uploads are hedged: when the primary
+# provider hasn't answered within IPFS_HEDGE_AFTER seconds the next one is
+# tried too, the first success wins and the other providers pin it in the
+# background. Latency and error metrics decide which provider goes first.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cid_util
+import config
+import http_client
+import ipfs_gateways
+from ipfs_util import create_ipfs_stream, pin_ipfs, lookup, remember
+import logging
+logger = logging.getLogger(__name__)
+
+_pool = ThreadPoolExecutor(
+    max_workers=config.IPFS_HEDGE_WORKERS, thread_name_prefix='ipfs-pinning')
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+class PinningBackend:
+    """ A pinning provider
+    add() uploads and pins a file of size bytes, None if unknown, and
+    returns its CID, pin() pins a known CID. Both raise on failure """
+    name = None
+
+    def enabled(self):
+        return True
+
+    def add(self, file_name, source, progress=None, size=None):
+        raise NotImplementedError
+
+    def pin(self, cid):
+        raise NotImplementedError
+
+
+class BlockfrostBackend(PinningBackend):
+    name = 'blockfrost'
+
+    def enabled(self):
+        return bool(config.BLOCKFROST_IPFS)
+
+    def add(self, file_name, source, progress=None, size=None):
+        res = create_ipfs_stream(file_name, source, progress, size)
+        if not res or not pin_ipfs(ipfs_hash=res['ipfs_hash']):
+            raise ValueError("Upload or pin to blockfrost failed")
+        return res['ipfs_hash']
+
+    def pin(self, cid):
+        if not pin_ipfs(ipfs_hash=cid):
+            raise ValueError("Pin to blockfrost failed")
+
+
+class NftStorageBackend(PinningBackend):
+    """ NFT.Storage stores uploads for good, no separate pin needed """
+    name = 'nftstorage'
+    url = "https://api.nft.storage"
+
+    def enabled(self):
+        return bool(config.NFTSTORAGE)
+
+    def _headers(self):
+        return {"Authorization": f"Bearer {config.NFTSTORAGE}"}
+
+    def add(self, file_name, source, progress=None, size=None):
+        # A generator body is sent with chunked transfer encoding
+        res = http_client.post(
+            f"{self.url}/upload", data=source(), headers=self._headers(),
+            timeout=config.IPFS_STREAM_TIMEOUT, rate_limit='nftstorage')
+        res.raise_for_status()
+        logger.info(res.json())
+        return res.json()['value']['cid']
+
+    def pin(self, cid):
+        # Pinning Service API
+        res = http_client.post(
+            f"{self.url}/pins", json={"cid": cid}, headers=self._headers(),
+            timeout=config.IPFS_STREAM_TIMEOUT, rate_limit='nftstorage')
+        res.raise_for_status()
+
+
+class LocalBackend(PinningBackend):
+    """ In-memory stand-in for tests and development without credentials
+    delay: seconds every call takes, fail: every call raises """
+
+    def __init__(self, name='local', delay=0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.files = {}
+        self.pins = set()
+
+    def _call(self):
+        time.sleep(self.delay)
+        if self.fail:
+            raise ValueError(f"{self.name} is failing")
+
+    def add(self, file_name, source, progress=None, size=None):
+        data = b''.join(source())
+        self._call()
+        cid = cid_util.compute_cid(data)
+        self.files[cid] = data
+        self.pins.add(cid)
+        return cid
+
+    def pin(self, cid):
+        self._call()
+        self.pins.add(cid)
+
+
+BACKENDS = {
+    backend.name: backend for backend in (BlockfrostBackend(), NftStorageBackend(), LocalBackend())
+}
+
+
+def _record(name, seconds, failed=False):
+    with _metrics_lock:
+        stats = _metrics.setdefault(
+            name, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'latency': None, 'error_rate': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['seconds'] += seconds
+        # Moving averages, recent behaviour counts most
+        alpha = config.IPFS_METRICS_ALPHA
+        if stats['latency'] is None:
+            stats['latency'] = seconds
+        else:
+            stats['latency'] += alpha * (seconds - stats['latency'])
+        stats['error_rate'] += alpha * (failed - stats['error_rate'])
+
+
+def metrics():
+    """ Per provider call counts, errors, average latency and error rate """
+    with _metrics_lock:
+        return {name: dict(stats) for name, stats in _metrics.items()}
+
+
+def _score(backend):
+    """ Expected seconds to a success, lower is better """
+    with _metrics_lock:
+        stats = _metrics.get(backend.name)
+        if not stats or stats['latency'] is None:
+            # Untried providers get a chance
+            return 0.0
+        return stats['latency'] * (1 + config.IPFS_ERROR_PENALTY * stats['error_rate'])
+
+
+def ranked():
+    """ Enabled providers, the best first """
+    backends = [BACKENDS[name] for name in config.IPFS_BACKENDS if name in BACKENDS]
+    backends = [backend for backend in backends if backend.enabled()]
+    return sorted(backends, key=_score)
+
+
+def _timed(backend, method, *args):
+    started = time.monotonic()
+    try:
+        result = getattr(backend, method)(*args)
+    except Exception:
+        _record(backend.name, time.monotonic() - started, failed=True)
+        logger.exception(f"{backend.name} {method} failed")
+        raise
+    _record(backend.name, time.monotonic() - started)
+    return result
+
+
+def hedged_add(file_name, source, progress=None, size=None):
+    """ Uploads and pins with the best provider, hedging to the next one when
+    it is slow or fails. Returns the CID of the first success, or False """
+    remaining = ranked()
+    if not remaining:
+        logger.error("No IPFS provider configured")
+        return False
+    futures = {}
+    pending = set()
+    while remaining or pending:
+        if remaining:
+            backend = remaining.pop(0)
+            # Only the first provider reports progress
+            future = _pool.submit(
+                _timed, backend, 'add', file_name, source, None if futures else progress, size)
+            futures[future] = backend
+            pending.add(future)
+        done, pending = wait(
+            pending, timeout=config.IPFS_HEDGE_AFTER if remaining else None,
+            return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                winner = futures[future]
+                cid = future.result()
+                logger.info(f"{file_name} pinned by {winner.name} as {cid}")
+                _pin_elsewhere(cid, winner)
+                ipfs_gateways.prefetch(cid)
+                return cid
+    logger.error(f"Every IPFS provider failed for {file_name}")
+    return False
+
+
+def _pin_elsewhere(cid, winner):
+    """ Redundant pins by the other providers, in the background """
+    for backend in ranked():
+        if backend is not winner:
+            _pool.submit(_timed, backend, 'pin', cid)
+
+
+def _index(file_name, local_cid, ipfs_hash, size, file_unique_id=None):
+    """ Indexes content by its local CIDv0 once the provider agrees on it
+    Returns the CID to use """
+    if cid_util.to_v0(ipfs_hash) != local_cid:
+        # Another chunking or raw leaves, the content can't be found by its CIDv0
+        logger.warning(f"Local CID {local_cid} of {file_name} differs from {ipfs_hash}, not indexed")
+        return ipfs_hash
+    remember(local_cid, size=size, file_unique_id=file_unique_id)
+    return local_cid
+
+
+def add_and_pin_data(file_name, data):
+    """ Uploads and pins in-memory data unless its CID is pinned already
+    Returns the CID, or False when every provider failed """
+    cid = cid_util.compute_cid(data)
+    if lookup(cid=cid):
+        logger.info(f"{file_name} is already pinned as {cid}")
+        return cid
+    ipfs_hash = hedged_add(file_name, lambda: [data], size=len(data))
+    if not ipfs_hash:
+        return False
+    return _index(file_name, cid, ipfs_hash, len(data))
+
+
+def add_and_pin_stream(file_name, source, file_unique_id=None, progress=None, size=None):
+    """ Streams, pins and indexes a file unless the Telegram file is known
+    The CIDv0 is computed while streaming, size is the file size if known
+    Returns the CID, or False when every provider failed """
+    cid = lookup(file_unique_id=file_unique_id)
+    if cid:
+        logger.info(f"{file_name} is already pinned as {cid}")
+        return cid
+    # Builders of the passes that read the whole file, every provider
+    # and every retried upload reads the source again
+    builders = []
+
+    def hashed_source():
+        builder = cid_util.CidBuilder()
+        for chunk in source():
+            builder.update(chunk)
+            yield chunk
+        builders.append(builder)
+
+    ipfs_hash = hedged_add(file_name, hashed_source, progress, size)
+    if not ipfs_hash:
+        return False
+    if not builders:
+        logger.warning(f"{file_name} was not read to the end, not indexed")
+        return ipfs_hash
+    return _index(file_name, builders[0].cid(), ipfs_hash, builders[0].size, file_unique_id)
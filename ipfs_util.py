@@ -1,51 +1,190 @@
 # ipfs_util.py
 
+import queue
+import threading
+from contextlib import nullcontext
+from uuid import uuid4
+
 import config
+import http_client
+import ipfs_gateways
 import requests
+from create_db import session_scope, IpfsContent
 import logging
 logger = logging.getLogger(__name__)
 
+# Errors worth another try
+_TRANSIENT = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError
+)
+
+# Bounds the large uploads running at once
+_upload_slots = threading.BoundedSemaphore(config.IPFS_UPLOAD_SLOTS)
+
+
+def download_chunks(url):
+    """ Source factory for a remote file, e.g. a Telegram File.file_path
+    Returns a function yielding the file in IPFS_STREAM_CHUNK sized chunks,
+    interrupted downloads are resumed with a Range request """
+    def source():
+        received = 0
+        attempts = 0
+        while True:
+            headers = {'Range': f'bytes={received}-'} if received else {}
+            try:
+                # Resuming is done here, not by retrying from the start
+                with http_client.get(url, headers=headers, stream=True, retries=0,
+                                     timeout=config.IPFS_STREAM_TIMEOUT) as res:
+                    res.raise_for_status()
+                    if received and res.status_code != 206:
+                        raise requests.RequestException("Server can't resume the download")
+                    for chunk in res.iter_content(chunk_size=config.IPFS_STREAM_CHUNK):
+                        received += len(chunk)
+                        yield chunk
+                return
+            except _TRANSIENT:
+                attempts += 1
+                if attempts > config.IPFS_STREAM_RETRIES:
+                    raise
+                logger.warning(f"Download interrupted after {received} bytes, resuming")
+    return source
+
+
+def _read_ahead(chunks, depth):
+    """ Reads chunks on a thread so the download overlaps the upload
+    At most depth chunks are buffered """
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        # Give up when the consumer went away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _reader():
+        try:
+            for chunk in chunks:
+                if chunk and not _put(chunk):
+                    return
+            _put(done)
+        except Exception as err:
+            _put(err)
+
+    threading.Thread(target=_reader, name="ipfs-read-ahead", daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _multipart(file_name, chunks, boundary):
+    """ multipart/form-data body with a single 'file' field, generated lazily """
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8')
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+
+def _counted(chunks, progress):
+    """ Reports the bytes passed on so far """
+    sent = 0
+    for chunk in chunks:
+        sent += len(chunk)
+        progress(sent)
+        yield chunk
 
-def create_ipfs(image):
-    """ Uploads image to Blockfrost """
-    with open(image, "rb") as file_upload:
-        ipfs_create_url = "https://ipfs.blockfrost.io/api/v0/ipfs/add"
-        files = {'file': file_upload}
-        headers = {"project_id": f"{config.BLOCKFROST_IPFS}"}
-        res = requests.post(ipfs_create_url,  files=files, headers=headers)
-        res.raise_for_status()
-        if res.status_code == 200:
-            logging.info("Uploaded image to Blockfrost")
-            logging.info(res.json())
-            return res.json()
+
+def create_ipfs_stream(file_name, source, progress=None, size=None):
+    """ Streams a file to Blockfrost without touching disk
+    source: a function returning an iterable of byte chunks, see download_chunks()
+    progress: optional function called with the bytes uploaded so far
+    size: the file size if known, large files wait for a free upload slot
+    An interrupted upload starts over """
+    ipfs_create_url = "https://ipfs.blockfrost.io/api/v0/ipfs/add"
+    boundary = uuid4().hex
+    headers = {
+        "project_id": f"{config.BLOCKFROST_IPFS}",
+        "Content-Type": f"multipart/form-data; boundary={boundary}"
+    }
+    large = size is None or size > config.IPFS_LARGE_UPLOAD_BYTES
+    with _upload_slots if large else nullcontext():
+        for attempt in range(config.IPFS_STREAM_RETRIES + 1):
+            chunks = _read_ahead(source(), config.IPFS_STREAM_BUFFER)
+            body = _counted(chunks, progress) if progress else chunks
+            try:
+                # A generator body is sent with chunked transfer encoding
+                res = http_client.post(
+                    ipfs_create_url, data=_multipart(file_name, body, boundary),
+                    headers=headers, timeout=config.IPFS_STREAM_TIMEOUT,
+                    rate_limit='blockfrost_ipfs')
+                break
+            except _TRANSIENT:
+                if attempt == config.IPFS_STREAM_RETRIES:
+                    raise
+                logger.warning(f"Upload of {file_name} interrupted, starting over")
+            finally:
+                chunks.close()
+    res.raise_for_status()
+    if res.status_code == 200:
+        logger.info(f"Streamed {file_name} to Blockfrost")
+        logger.info(res.json())
+        return res.json()
+    else:
+        logger.error("Something failed here? Upload to blockfrost failed")
+        return False
+
+def lookup(cid=None, file_unique_id=None):
+    """ CID of known pinned content, by CID or Telegram file_unique_id, or None """
+    with session_scope() as session:
+        query = session.query(IpfsContent).filter(IpfsContent.pinned)
+        if cid:
+            query = query.filter(IpfsContent.cid == cid)
+        elif file_unique_id:
+            query = query.filter(IpfsContent.file_unique_id == file_unique_id)
         else:
-            logger.error("Something failed here? Upload to blockfrost failed")
-            return False
+            return None
+        content = query.first()
+        return content.cid if content else None
+
+
+def remember(cid, size=None, file_unique_id=None):
+    """ Records pinned content so it is never uploaded again """
+    with session_scope() as session:
+        content = session.query(IpfsContent).filter(
+            IpfsContent.cid == cid).first() or IpfsContent(cid=cid)
+        content.size = size if size is not None else content.size
+        content.file_unique_id = file_unique_id or content.file_unique_id
+        content.pinned = True
+        session.add(content)
+
 
 def check_ipfs(ipfs_hash):
     """ Check to see if the ipfs hash is accessible via
-    ipfs.io and cloudflare """
-    ipfs_gateways = [
-        f"https://gateway.ipfs.io/ipfs/{ipfs_hash}",
-        f"https://cloudflare-ipfs.com/ipfs/{ipfs_hash}"
-    ]
-
-    ipfs_status = []
-    for gateway in ipfs_gateways:
-        res = requests.get(gateway)
-        logging.info(res.status_code)
-        if res.status_code == 200:
-            ipfs_status.append(True)
-        else:
-            ipfs_status.append(False)
-    logging.info(f"Availability:  {ipfs_status}")
-    return True
+    any of the public gateways, see ipfs_gateways.py """
+    return ipfs_gateways.check(ipfs_hash)
 
 def pin_ipfs(ipfs_hash):
     """ Pins IPFS hash in Account """
     ipfs_pin_url = f"https://ipfs.blockfrost.io/api/v0/ipfs/pin/add/{ipfs_hash}"
     headers = {"project_id": f"{config.BLOCKFROST_IPFS}"}
-    res = requests.post(ipfs_pin_url, headers=headers)
+    res = http_client.post(ipfs_pin_url, headers=headers, rate_limit='blockfrost_ipfs')
     res.raise_for_status()
     if res.status_code == 200:
         logger.info("Uploaded image to Blockfrost")
@@ -60,7 +199,7 @@ def remove_ipfs(ipfs_hash):
     """ Removes pin from IPFS hash in Blockfrost """
     ipfs_remove_url = f"https://ipfs.blockfrost.io/api/v0/ipfs/pin/remove/{ipfs_hash}"
     headers = {"project_id": f"{config.BLOCKFROST_IPFS}"}
-    res = requests.post(ipfs_remove_url, headers=headers)
+    res = http_client.post(ipfs_remove_url, headers=headers, rate_limit='blockfrost_ipfs')
     res.raise_for_status()
     if res.status_code == 200:
         logging.info("Removing pin worked")
@@ -0,0 +1,133 @@
+# key_util.py
+# Ed25519 keys and Shelley addresses without forking cardano-cli.
+# Files use the same text envelope format as cardano-cli.
+
+import hashlib
+import json
+import os
+
+from nacl.signing import SigningKey
+
+# Text envelope type and description per key role
+KEY_ENVELOPES = {
+    'payment': ('PaymentVerificationKeyShelley_ed25519', 'Payment Verification Key',
+                'PaymentSigningKeyShelley_ed25519', 'Payment Signing Key'),
+    'stake': ('StakeVerificationKeyShelley_ed25519', 'Stake Verification Key',
+              'StakeSigningKeyShelley_ed25519', 'Stake Signing Key'),
+}
+
+# Shelley base address header: key hash payment part, key hash stake part
+BASE_ADDRESS_HEADER = 0b0000
+TESTNET_NETWORK_ID = 0
+MAINNET_NETWORK_ID = 1
+
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+
+def blake2b_224(data):
+    return hashlib.blake2b(data, digest_size=28).digest()
+
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _convert_bits(data, from_bits, to_bits):
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << to_bits) - 1
+    for value in data:
+        acc = (acc << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            ret.append((acc >> bits) & maxv)
+    if bits:
+        ret.append((acc << (to_bits - bits)) & maxv)
+    return ret
+
+
+def bech32_encode(hrp, data):
+    """ Bech32 encodes bytes, without the 90 character limit like cardano-cli """
+    values = _convert_bits(data, 8, 5)
+    hrp_expanded = [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+    polymod = _bech32_polymod(hrp_expanded + values + [0] * 6) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in values + checksum)
+
+
+def bech32_decode(bech):
+    """ Returns the raw bytes of a bech32 string such as an address """
+    hrp, _, data_part = bech.lower().rpartition('1')
+    values = [BECH32_CHARSET.index(c) for c in data_part]
+    hrp_expanded = [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+    if not hrp or _bech32_polymod(hrp_expanded + values) != 1:
+        raise ValueError(f"Invalid bech32 string: {bech}")
+    decoded = 0
+    bits = 0
+    raw = bytearray()
+    # Leftover padding bits are dropped
+    for value in values[:-6]:
+        decoded = (decoded << 5) | value
+        bits += 5
+        if bits >= 8:
+            bits -= 8
+            raw.append((decoded >> bits) & 0xff)
+    return bytes(raw)
+
+
+def _write_envelope(path, key_type, description, key_bytes, private=False):
+    envelope = {
+        "type": key_type,
+        "description": description,
+        # CBOR byte string of 32 bytes
+        "cborHex": "5820" + key_bytes.hex()
+    }
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    fd = os.open(path, flags, 0o600 if private else 0o644)
+    with os.fdopen(fd, 'w') as key_file:
+        json.dump(envelope, key_file, indent=4)
+
+
+def read_key(path):
+    """ Returns the raw key bytes from a text envelope key file """
+    with open(path) as key_file:
+        envelope = json.load(key_file)
+    return bytes.fromhex(envelope['cborHex'])[2:]
+
+
+def generate_key_pair(vkey_file, skey_file, role='payment'):
+    """ Same as cardano-cli address/stake-address key-gen
+    Returns the verification key bytes """
+    vkey_type, vkey_desc, skey_type, skey_desc = KEY_ENVELOPES[role]
+    signing_key = SigningKey.generate()
+    verify_key = bytes(signing_key.verify_key)
+    _write_envelope(skey_file, skey_type, skey_desc, bytes(signing_key), private=True)
+    _write_envelope(vkey_file, vkey_type, vkey_desc, verify_key)
+    return verify_key
+
+
+def signing_key(skey_file):
+    """ Loads a SigningKey from a cardano-cli signing key file """
+    return SigningKey(read_key(skey_file))
+
+
+def key_hash(vkey):
+    """ Same as cardano-cli address key-hash, returns hex """
+    return blake2b_224(vkey).hex()
+
+
+def build_address(payment_vkey, stake_vkey, network_id=TESTNET_NETWORK_ID):
+    """ Same as cardano-cli address build with payment and stake keys """
+    header = bytes([BASE_ADDRESS_HEADER << 4 | network_id])
+    raw = header + blake2b_224(payment_vkey) + blake2b_224(stake_vkey)
+    hrp = 'addr' if network_id == MAINNET_NETWORK_ID else 'addr_test'
+    return bech32_encode(hrp, raw)
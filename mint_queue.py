@@ -0,0 +1,279 @@
+# mint_queue.py
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+import config
+from collection_util import ProgressView, mint_collection
+from create_db import session_scope, Tokens, TokenStage, Collections
+from token_util import mint, mint_batch
+import logging
+logger = logging.getLogger(__name__)
+
+# Job stages stored in Tokens.mint_stage
+QUEUED = 'queued'
+MINTING = 'minting'
+SUBMITTED = 'submitted'
+CONFIRMED = 'confirmed'
+EXPIRED = 'expired'
+FAILED = 'failed'
+
+_wakeup = threading.Event()
+_claim_lock = threading.Lock()
+_workers = []
+
+
+def notify(bot, chat_id, text):
+    """ Sends a message to the chat, never raises """
+    if bot is None or chat_id is None:
+        return
+    try:
+        bot.send_message(chat_id=chat_id, text=text)
+    except Exception:
+        logger.exception(f"Could not notify chat {chat_id}")
+
+
+def enqueue(session_uuid, chat_id):
+    """ Queues a session for minting, returns False if it can't be queued """
+    with session_scope() as session:
+        # Locked so two replicas can't queue it twice
+        token_data = session.query(Tokens).filter(
+            Tokens.session_uuid == session_uuid).with_for_update().one_or_none()
+        if token_data is None:
+            logger.info(f"No Session found: {session_uuid}")
+            return False
+        if token_data.reached(TokenStage.SUBMITTED) or token_data.mint_stage in (QUEUED, MINTING):
+            logger.info(f"Session already queued or minted: {session_uuid}")
+            return False
+        token_data.chat_id = chat_id
+        token_data.mint_stage = QUEUED
+        token_data.mint_queued_at = datetime.utcnow()
+    logger.info(f"Queued mint for {session_uuid}")
+    _wakeup.set()
+    return True
+
+
+def enqueue_collection(collection_uuid):
+    """ Queues a funded collection for minting """
+    with session_scope() as session:
+        queued = session.query(Collections).filter(
+            Collections.collection_uuid == collection_uuid).filter(
+            Collections.mint_stage.is_(None) | (Collections.mint_stage == FAILED)).update(
+            {Collections.mint_stage: QUEUED, Collections.mint_queued_at: datetime.utcnow()},
+            synchronize_session=False)
+    if queued:
+        logger.info(f"Queued collection {collection_uuid}")
+        _wakeup.set()
+    return bool(queued)
+
+
+def _claim_collection():
+    """ Moves the oldest queued collection to MINTING and returns it """
+    with _claim_lock, session_scope() as session:
+        # Rows another replica is claiming right now are skipped
+        collection = session.query(Collections).filter(
+            Collections.mint_stage == QUEUED).filter(
+            Collections.mint_queued_at.is_(None) |
+            (Collections.mint_queued_at <= datetime.utcnow())).order_by(
+            Collections.mint_queued_at).with_for_update(skip_locked=True).first()
+        if collection is None:
+            return None
+        collection.mint_stage = MINTING
+        collection.mint_claimed_by = config.NODE_ID
+        collection.mint_claimed_at = datetime.utcnow()
+        return collection.collection_uuid, collection.chat_id
+
+
+def _claim(limit=1):
+    """ Moves up to limit of the oldest queued jobs to MINTING and returns them """
+    with _claim_lock, session_scope() as session:
+        # SELECT ... FOR UPDATE SKIP LOCKED on a server database,
+        # replicas take different rows. SQLite has one writer anyway.
+        queued = session.query(Tokens).filter(
+            Tokens.mint_stage == QUEUED).filter(
+            Tokens.mint_queued_at.is_(None) | (Tokens.mint_queued_at <= datetime.utcnow())).order_by(
+            Tokens.mint_queued_at).limit(limit).with_for_update(skip_locked=True).all()
+        now = datetime.utcnow()
+        for token_data in queued:
+            token_data.mint_stage = MINTING
+            token_data.mint_claimed_by = config.NODE_ID
+            token_data.mint_claimed_at = now
+        return [(t.session_uuid, t.chat_id) for t in queued]
+
+
+def _set_stage(session_uuid, stage):
+    with session_scope() as session:
+        session.query(Tokens).filter(
+            Tokens.session_uuid == session_uuid).update(
+            {Tokens.mint_stage: stage})
+
+
+def _requeue(session_uuid, delay):
+    """ Back to the queue, not claimed again for delay seconds """
+    with session_scope() as session:
+        session.query(Tokens).filter(
+            Tokens.session_uuid == session_uuid).update(
+            {Tokens.mint_stage: QUEUED,
+             Tokens.mint_queued_at: datetime.utcnow() + timedelta(seconds=delay)})
+
+
+def _finish(bot, session_uuid, chat_id, minted):
+    """ Records the outcome of a job and tells the chat """
+    if minted:
+        # The confirm_watcher reports back once the transaction is on chain
+        _set_stage(session_uuid, SUBMITTED)
+        notify(bot, chat_id, "I'll let you know as soon as the transaction is confirmed.")
+    elif minted is None:
+        # Funding not indexed by Blockfrost yet, or didn't fit in this batch
+        _requeue(session_uuid, config.MINT_RETRY_DELAY)
+    else:
+        _set_stage(session_uuid, FAILED)
+        notify(bot, chat_id,
+               "Something failed, please try not to panic, "
+               "but you may have hit a bug. Sorry. \n"
+               "You can run /MINT again to retry.")
+
+
+def _run_job(bot, session_uuid, chat_id):
+    """ Mints a single session and reports back to the chat """
+    def progress(text):
+        notify(bot, chat_id, text)
+
+    try:
+        minted = mint(session_uuid=session_uuid, progress=progress)
+    except Exception:
+        logger.exception(f"Minting crashed for {session_uuid}")
+        minted = False
+    _finish(bot, session_uuid, chat_id, minted)
+
+
+def _run_batch(bot, jobs):
+    """ Mints several sessions in one transaction """
+    chats = dict(jobs)
+    progress = {
+        session_uuid: (lambda text, chat_id=chat_id: notify(bot, chat_id, text))
+        for session_uuid, chat_id in jobs
+    }
+    try:
+        results = mint_batch(list(chats), progress=progress)
+    except Exception:
+        logger.exception(f"Batch minting crashed for {list(chats)}")
+        results = {session_uuid: False for session_uuid in chats}
+    for session_uuid, minted in results.items():
+        _finish(bot, session_uuid, chats[session_uuid], minted)
+
+
+def _run_collection(bot, collection_uuid, chat_id):
+    """ Mints a collection batch by batch with a progress view per item
+    Returns False when the collection went back to the queue """
+    view = None
+    index = {}
+
+    def on_start(numbers):
+        # Only once the funding is confirmed, a requeued pass sends nothing
+        nonlocal view
+        index.update({number: i for i, number in enumerate(numbers)})
+        view = ProgressView(bot, chat_id, "Minting your collection", [f"#{n}" for n in numbers])
+
+    try:
+        minted = mint_collection(
+            collection_uuid, on_start=on_start,
+            on_item=lambda number, text: view.update(index[number], text))
+        if view is not None:
+            view.flush()
+    except Exception:
+        logger.exception(f"Collection minting crashed for {collection_uuid}")
+        minted = False
+
+    with session_scope() as session:
+        query = session.query(Collections).filter(
+            Collections.collection_uuid == collection_uuid)
+        if minted is None:
+            # Funding not indexed by Blockfrost yet, not claimed again for a while
+            query.update({Collections.mint_stage: QUEUED,
+                          Collections.mint_queued_at: datetime.utcnow() +
+                          timedelta(seconds=config.MINT_RETRY_DELAY)})
+        else:
+            query.update({Collections.mint_stage: SUBMITTED if minted else FAILED})
+    if minted is None:
+        return False
+    if minted:
+        notify(bot, chat_id, "All batches are submitted, "
+                             "I'll let you know once the whole collection is confirmed.")
+    else:
+        notify(bot, chat_id, "Something failed while minting your collection, "
+                             "the items already submitted are on their way. Sorry.")
+    return True
+
+
+def _worker(bot):
+    while True:
+        collection = _claim_collection()
+        if collection is not None:
+            # A requeued collection waits out MINT_RETRY_DELAY in the queue
+            _run_collection(bot, *collection)
+            continue
+        jobs = _claim(config.BATCH_MAX if config.BATCH_MINT else 1)
+        if not jobs:
+            # Nothing to do, sleep until a job is queued or the poll expires
+            _wakeup.wait(config.MINT_QUEUE_POLL)
+            _wakeup.clear()
+            continue
+        name = threading.current_thread().name
+        if config.BATCH_MINT:
+            # Give other funded sessions a moment to join the batch
+            time.sleep(config.BATCH_WINDOW)
+            jobs += _claim(config.BATCH_MAX - len(jobs))
+            logger.info(f"Worker {name} batch minting {len(jobs)} sessions")
+            _run_batch(bot, jobs)
+        else:
+            session_uuid, chat_id = jobs[0]
+            logger.info(f"Worker {name} minting {session_uuid}")
+            _run_job(bot, session_uuid, chat_id)
+
+
+def _interrupted(model):
+    """ MINTING rows of an earlier run of this process, or of a replica
+    that stopped updating them long ago """
+    if config.SINGLE_NODE:
+        # Nobody else can be minting them
+        return (model.mint_stage == MINTING,)
+    stale = datetime.utcnow() - timedelta(minutes=config.MINT_CLAIM_STALE_MINUTES)
+    return (model.mint_stage == MINTING,
+            model.mint_claimed_by.is_(None) |
+            (model.mint_claimed_by == config.NODE_ID) |
+            (model.mint_claimed_at < stale))
+
+
+def _requeue_interrupted():
+    """ Jobs left in MINTING by a previous process go back to the queue
+    Jobs other live replicas are minting are left alone """
+    with session_scope() as session:
+        requeued = session.query(Tokens).filter(
+            *_interrupted(Tokens)).filter(
+            Tokens.stage < TokenStage.SUBMITTED).update(
+            {Tokens.mint_stage: QUEUED}, synchronize_session=False)
+        session.query(Collections).filter(
+            *_interrupted(Collections)).update(
+            {Collections.mint_stage: QUEUED}, synchronize_session=False)
+        # Already on its way, leave it to the confirm_watcher
+        session.query(Tokens).filter(
+            *_interrupted(Tokens)).filter(
+            Tokens.stage >= TokenStage.SUBMITTED).update(
+            {Tokens.mint_stage: SUBMITTED}, synchronize_session=False)
+    if requeued:
+        logger.info(f"Requeued {requeued} interrupted mint jobs")
+
+
+def start(bot, workers=None):
+    """ Starts the pool of mint worker threads """
+    if _workers:
+        return
+    _requeue_interrupted()
+    for i in range(workers or config.MINT_WORKERS):
+        thread = threading.Thread(
+            target=_worker, args=(bot,), name=f"mint-worker-{i}", daemon=True)
+        thread.start()
+        _workers.append(thread)
+    logger.info(f"Started {len(_workers)} mint workers")
@@ -0,0 +1,212 @@
+# persistence.py
+# Conversation states and context.user_data kept in the database, so a
+# restart or deploy picks every chat up where it left off. Only changed
+# keys are written, flushes are coalesced over PERSISTENCE_FLUSH_INTERVAL.
+
+import json
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from telegram.ext import BasePersistence
+
+import config
+from create_db import session_scope, ConversationState, UserDataEntry
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DBPersistence(BasePersistence):
+    """ BasePersistence on the bot database
+    user_data is stored one row per (user, key) as JSON, chat and bot
+    data are not used by the bot and not stored """
+
+    def __init__(self, flush_interval=None):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval or config.PERSISTENCE_FLUSH_INTERVAL
+        self._lock = threading.Lock()
+        # user_id -> {key: JSON} as last written
+        self._written = {}
+        # (user_id, key) -> JSON, None deletes the key
+        self._dirty_data = {}
+        # (name, key JSON) -> state, None ends the conversation
+        self._dirty_conversations = {}
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._pruned_at = time.monotonic()
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="persistence-flush", daemon=True)
+        self._flusher.start()
+
+    # Loading
+
+    def get_user_data(self):
+        """ user_data of users active within PERSISTENCE_MAX_AGE_HOURS
+        Called once on start, idle users are deleted first. Only changed keys
+        are written, the rest of an active user's keys may be older """
+        self._prune()
+        user_data = defaultdict(dict)
+        with session_scope() as session:
+            for entry in session.query(UserDataEntry):
+                user_data[entry.user_id][entry.key] = json.loads(entry.value)
+                self._written.setdefault(entry.user_id, {})[entry.key] = entry.value
+        logger.info(f"Loaded user_data of {len(user_data)} users")
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        since = datetime.utcnow() - timedelta(hours=config.PERSISTENCE_MAX_AGE_HOURS)
+        with session_scope() as session:
+            rows = session.query(ConversationState).filter(
+                ConversationState.name == name).filter(
+                ConversationState.updated_at >= since).all()
+            conversations = {tuple(json.loads(row.key)): row.state for row in rows}
+        logger.info(f"Loaded {len(conversations)} {name} conversations")
+        return conversations
+
+    # Updates, buffered until the next flush
+
+    def update_user_data(self, user_id, data):
+        """ Called after every update, records the keys that changed """
+        changed = False
+        with self._lock:
+            written = self._written.setdefault(user_id, {})
+            for key, value in data.items():
+                try:
+                    encoded = json.dumps(value, sort_keys=True)
+                except (TypeError, ValueError):
+                    logger.warning(f"user_data[{key!r}] of {user_id} is not JSON, not stored")
+                    continue
+                if written.get(key) != encoded:
+                    written[key] = encoded
+                    self._dirty_data[(user_id, key)] = encoded
+                    changed = True
+            for key in [key for key in written if key not in data]:
+                del written[key]
+                self._dirty_data[(user_id, key)] = None
+                changed = True
+            if not written:
+                del self._written[user_id]
+        if changed:
+            self._wakeup.set()
+
+    def drop_user_data(self, user_id):
+        """ Deletes the stored user_data of an evicted user, see user_state.py """
+        with self._lock:
+            written = self._written.pop(user_id, {})
+            for key in written:
+                self._dirty_data[(user_id, key)] = None
+        if written:
+            self._wakeup.set()
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def update_conversation(self, name, key, new_state):
+        # run_async handlers report (old state, Promise) until they resolve
+        if isinstance(new_state, tuple):
+            new_state = new_state[0]
+        if new_state is not None and not isinstance(new_state, int):
+            return
+        with self._lock:
+            self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._wakeup.set()
+
+    # Writing
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._wakeup.wait()
+            # Let more changes pile up, one write for all of them
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._write()
+            except Exception:
+                logger.exception("Persistence flush failed")
+
+    def _write(self):
+        with self._lock:
+            dirty_data, self._dirty_data = self._dirty_data, {}
+            dirty_conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not dirty_data and not dirty_conversations:
+            return
+        now = datetime.utcnow()
+        try:
+            with session_scope() as session:
+                self._write_user_data(session, dirty_data, now)
+                self._write_conversations(session, dirty_conversations, now)
+        except Exception:
+            # Keep the changes for the next try, newer ones win
+            with self._lock:
+                self._dirty_data = {**dirty_data, **self._dirty_data}
+                self._dirty_conversations = {**dirty_conversations, **self._dirty_conversations}
+            raise
+        logger.info(f"Persisted {len(dirty_data)} user_data keys "
+                    f"and {len(dirty_conversations)} conversations")
+        if time.monotonic() - self._pruned_at > config.PERSISTENCE_PRUNE_INTERVAL:
+            self._prune()
+
+    def _prune(self):
+        """ Deletes what would never be loaded again: the user_data of users
+        and the conversations idle longer than PERSISTENCE_MAX_AGE_HOURS """
+        since = datetime.utcnow() - timedelta(hours=config.PERSISTENCE_MAX_AGE_HOURS)
+        with session_scope() as session:
+            idle_users = [user_id for (user_id,) in session.query(UserDataEntry.user_id).group_by(
+                UserDataEntry.user_id).having(func.max(UserDataEntry.updated_at) < since)]
+            users = session.query(UserDataEntry).filter(
+                UserDataEntry.user_id.in_(idle_users)).delete(synchronize_session=False)
+            conversations = session.query(ConversationState).filter(
+                ConversationState.updated_at < since).delete(synchronize_session=False)
+        with self._lock:
+            for user_id in idle_users:
+                self._written.pop(user_id, None)
+        self._pruned_at = time.monotonic()
+        if users or conversations:
+            logger.info(f"Pruned {users} user_data keys and {conversations} conversations")
+
+    @staticmethod
+    def _write_user_data(session, dirty_data, now):
+        for (user_id, key), value in dirty_data.items():
+            entry = session.query(UserDataEntry).filter(
+                UserDataEntry.user_id == user_id).filter(
+                UserDataEntry.key == key).one_or_none()
+            if value is None:
+                if entry is not None:
+                    session.delete(entry)
+            elif entry is None:
+                session.add(UserDataEntry(user_id=user_id, key=key, value=value, updated_at=now))
+            else:
+                entry.value = value
+                entry.updated_at = now
+
+    @staticmethod
+    def _write_conversations(session, dirty_conversations, now):
+        for (name, key), state in dirty_conversations.items():
+            row = session.query(ConversationState).filter(
+                ConversationState.name == name).filter(
+                ConversationState.key == key).one_or_none()
+            if state is None:
+                if row is not None:
+                    session.delete(row)
+            elif row is None:
+                session.add(ConversationState(name=name, key=key, state=state, updated_at=now))
+            else:
+                row.state = state
+                row.updated_at = now
+
+    def flush(self):
+        """ Called by the Updater on shutdown, writes whatever is pending """
+        self._stopped = True
+        self._wakeup.set()
+        self._write()
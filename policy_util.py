@@ -0,0 +1,60 @@
+# policy_util.py
+# Native minting policies without forking cardano-cli.
+
+import cbor_util
+import key_util
+
+# Native script tags in the ledger CDDL
+SCRIPT_TAGS = {
+    'sig': 0,
+    'all': 1,
+    'any': 2,
+    'atLeast': 3,
+    'after': 4,
+    'before': 5,
+}
+
+
+def build_policy(policy_keyhash, before_slot):
+    """ Single signature policy locked after before_slot, like policy_dict in mint() """
+    return {
+        "type": "all",
+        "scripts": [
+            {
+                "keyHash": policy_keyhash,
+                "type": "sig"
+            },
+            {
+                "type": "before",
+                "slot": before_slot
+            }
+        ]
+    }
+
+
+def script_to_native(script):
+    """ Converts the cardano-cli JSON script format to the CBOR structure """
+    tag = SCRIPT_TAGS[script['type']]
+    if script['type'] == 'sig':
+        return [tag, bytes.fromhex(script['keyHash'])]
+    if script['type'] in ('after', 'before'):
+        return [tag, script['slot']]
+    scripts = [script_to_native(s) for s in script['scripts']]
+    if script['type'] == 'atLeast':
+        return [tag, script['required'], scripts]
+    return [tag, scripts]
+
+
+def script_cbor(script):
+    return cbor_util.dumps(script_to_native(script))
+
+
+def policy_id(script):
+    """ Same as cardano-cli transaction policyid, returns hex """
+    # Script hashes are prefixed with the native script language tag 0
+    return key_util.blake2b_224(b'\x00' + script_cbor(script)).hex()
+
+
+def policy_keyhash(policy_vkey_file):
+    """ Same as cardano-cli address key-hash for the policy key """
+    return key_util.key_hash(key_util.read_key(policy_vkey_file))
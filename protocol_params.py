@@ -0,0 +1,101 @@
+# protocol_params.py
+# Process wide protocol parameters, fetched once per epoch.
+
+import json
+import os
+import tempfile
+import threading
+
+import chain_tip
+import cli_runner
+import config
+import logging
+logger = logging.getLogger(__name__)
+
+PROTOCOL_PARAMS_FILE = f'{config.SHARED_DIR}/protocol.json'
+
+_lock = threading.Lock()
+# The epoch is None while serving a copy loaded from disk
+_cache = {'epoch': None, 'params': None}
+_watcher = None
+
+
+def _fetch():
+    """ Queries the node and replaces the single on-disk copy """
+    # A file of its own, concurrent refreshes must not write the same one
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(PROTOCOL_PARAMS_FILE), prefix='protocol-',
+            suffix='.json', delete=False) as tmp:
+        tmp_file = tmp.name
+    try:
+        # CliError is a RuntimeError
+        cli_runner.run(
+            ['query', 'protocol-parameters',
+             '--testnet-magic', config.TESTNET_ID,
+             '--out-file', tmp_file],
+            check=True)
+        with open(tmp_file) as params_file:
+            params = json.load(params_file)
+        os.replace(tmp_file, PROTOCOL_PARAMS_FILE)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    logger.info("Saved protocol.json")
+    return params
+
+
+def refresh(epoch=None):
+    """ Fetches fresh parameters for the given epoch """
+    params = _fetch()
+    with _lock:
+        _cache['epoch'] = epoch
+        _cache['params'] = params
+    logger.info(f"Protocol parameters refreshed for epoch {epoch}")
+    return params
+
+
+def get():
+    """ Returns the parsed protocol parameters from memory """
+    with _lock:
+        if _cache['params'] is not None:
+            return _cache['params']
+        if os.path.isfile(PROTOCOL_PARAMS_FILE):
+            with open(PROTOCOL_PARAMS_FILE) as params_file:
+                _cache['params'] = json.load(params_file)
+            return _cache['params']
+    return refresh()
+
+
+def current_epoch():
+    with _lock:
+        return _cache['epoch']
+
+
+def check_epoch():
+    """ Refreshes the parameters once the chain enters a new epoch """
+    epoch = chain_tip.get_tip().get('epoch')
+    if epoch is not None and epoch != current_epoch():
+        refresh(epoch)
+
+
+def _watch(stop_event):
+    while True:
+        try:
+            check_epoch()
+        except Exception:
+            logger.exception("Protocol parameter refresh failed")
+        if stop_event.wait(config.PROTOCOL_PARAMS_POLL):
+            break
+
+
+def start():
+    """ Starts the background epoch watcher """
+    global _watcher
+    if _watcher is not None:
+        return _watcher
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=_watch, args=(stop_event,), name="protocol-params", daemon=True)
+    thread.start()
+    _watcher = stop_event
+    return stop_event
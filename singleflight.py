@@ -0,0 +1,102 @@
+# singleflight.py
+# Coalesces identical calls: while one is running, callers with the same
+# arguments wait for its result instead of starting their own. Results
+# can be kept for a short TTL on top.
+
+import functools
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group:
+    """ One in-flight call per key, results cached for ttl seconds """
+
+    def __init__(self, name, ttl=0):
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+        # key -> (result, expires)
+        self._results = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and time.monotonic() < cached[1]:
+                _record(self.name, 'cached')
+                return cached[0]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            _record(self.name, 'shared')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        _record(self.name, 'executed')
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None and self.ttl:
+                    self._results[key] = (call.result, time.monotonic() + self.ttl)
+                    self._expire()
+            call.done.set()
+        return call.result
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [k for k, (_, expires) in self._results.items() if expires <= now]:
+            del self._results[key]
+
+    def forget(self, key):
+        """ Drops a cached result, e.g. after a submit changed it """
+        with self._lock:
+            self._results.pop(key, None)
+
+
+def _record(name, outcome):
+    with _metrics_lock:
+        stats = _metrics.setdefault(name, {'executed': 0, 'shared': 0, 'cached': 0})
+        stats[outcome] += 1
+
+
+def metrics():
+    """ Per function executions, calls that shared one and cache hits """
+    with _metrics_lock:
+        return {name: dict(stats) for name, stats in _metrics.items()}
+
+
+def coalesce(ttl=0):
+    """ Decorator, calls with equal arguments share one execution
+    The result is shared too, callers must not modify it """
+    def decorator(fn):
+        group = Group(fn.__qualname__, ttl)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            return group.do(key, fn, *args, **kwargs)
+        wrapper.group = group
+        return wrapper
+    return decorator
@@ -0,0 +1,15 @@
+# conftest.py
+# The bot modules live in the repo root and import config at import time,
+# tests get their own SQLite file and session directory unless
+# DATABASE_URL or SHARED_DIR are set.
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_scratch = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_scratch, 'tokens_test.db')}")
+os.environ.setdefault('SHARED_DIR', _scratch)
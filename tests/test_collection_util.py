@@ -0,0 +1,102 @@
+# test_collection_util.py
+# Reading collection uploads: manifests, archives and matching them up.
+
+import io
+import json
+import zipfile
+
+import pytest
+
+import collection_util
+import config
+
+
+def _zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_parse_csv_manifest():
+    # Excel writes a byte order mark
+    data = '\ufeffFile, Name ,description,number\na.png,Alpha , first,7\nb.png,Beta,,\n'
+    assert collection_util.parse_manifest('manifest.csv', data.encode('utf-8')) == [
+        {'file': 'a.png', 'name': 'Alpha', 'description': 'first', 'number': '7'},
+        {'file': 'b.png', 'name': 'Beta', 'description': '', 'number': ''},
+    ]
+
+
+def test_parse_json_manifest():
+    data = json.dumps([{'File': 'a.png', 'number': 2}]).encode('utf-8')
+    assert collection_util.parse_manifest('MANIFEST.JSON', data) == [{'file': 'a.png', 'number': '2'}]
+
+
+@pytest.mark.parametrize('data', ['{"items": []}', '[1, 2]', '"a.png"', '[{"file": "a.png"}, null]'])
+def test_json_manifest_must_be_a_list_of_objects(data):
+    with pytest.raises(ValueError):
+        collection_util.parse_manifest('manifest.json', data.encode('utf-8'))
+
+
+def test_invalid_json_manifest():
+    with pytest.raises(ValueError):
+        collection_util.parse_manifest('manifest.json', b'[{"file": ')
+
+
+def test_read_archive():
+    data = _zip({
+        'art/b.png': b'bbb',
+        'art/a.PNG': b'aaa',
+        'art/manifest.csv': 'file,name\na.PNG,Alpha\n',
+        'art/.hidden.png': b'x',
+        '__MACOSX/art/._a.png': b'x',
+        'art/readme.txt': b'x',
+    })
+    files, manifest = collection_util.read_archive(data)
+    assert files == [('a.PNG', b'aaa'), ('b.png', b'bbb')]
+    assert manifest == [{'file': 'a.PNG', 'name': 'Alpha'}]
+
+
+def test_read_archive_too_big(monkeypatch):
+    monkeypatch.setattr(config, 'COLLECTION_MAX_BYTES', 5)
+    with pytest.raises(ValueError):
+        collection_util.read_archive(_zip({'a.png': b'aaa', 'b.png': b'bbb'}))
+
+
+def test_read_archive_not_a_zip():
+    with pytest.raises(zipfile.BadZipFile):
+        collection_util.read_archive(b'not a zip')
+
+
+def test_build_items_in_order():
+    items = collection_util.build_items([('a.png', b'a'), ('b.png', b'b')], None)
+    assert [(i['file_name'], i['number'], i['name']) for i in items] == [
+        ('a.png', 1, 'a'), ('b.png', 2, 'b')]
+
+
+def test_build_items_from_manifest():
+    files = [('a.png', b'a'), ('b.png', b'b')]
+    manifest = [{'file': 'b.png', 'name': 'Beta', 'number': '10'},
+                {'file': 'a.png', 'description': 'first'}]
+    items = collection_util.build_items(files, manifest)
+    assert [(i['file_name'], i['data'], i['number'], i['name'], i['description'])
+            for i in items] == [('b.png', b'b', 10, 'Beta', ''), ('a.png', b'a', 2, 'a', 'first')]
+
+
+@pytest.mark.parametrize('files, manifest', [
+    ([], None),
+    ([('a.png', b'a')], [{'file': 'missing.png'}]),
+    ([('a.png', b'a')], [{}, {}]),
+    ([('a.png', b'a'), ('b.png', b'b')], [{'number': '1'}, {'number': '1'}]),
+    ([('a.png', b'a')], [{'number': 'one'}]),
+])
+def test_build_items_rejects(files, manifest):
+    with pytest.raises(ValueError):
+        collection_util.build_items(files, manifest)
+
+
+def test_build_items_limit(monkeypatch):
+    monkeypatch.setattr(config, 'COLLECTION_MAX_ITEMS', 1)
+    with pytest.raises(ValueError):
+        collection_util.build_items([('a.png', b'a'), ('b.png', b'b')], None)
@@ -0,0 +1,39 @@
+# test_http_client.py
+# Rate limits and daily quotas of the token buckets.
+
+import logging
+from datetime import timedelta
+
+import pytest
+
+import http_client
+
+
+def test_daily_quota_is_enforced(caplog):
+    bucket = http_client.TokenBucket(rate=1000, burst=100, daily_limit=10)
+    with caplog.at_level(logging.WARNING, logger='http_client'):
+        for _ in range(10):
+            bucket.acquire()
+    # Warned once, at 90%
+    assert len(caplog.records) == 1
+    with pytest.raises(http_client.QuotaExceeded):
+        bucket.acquire()
+    assert bucket.quota()['used_today'] == 10
+
+
+def test_quota_resets_the_next_day():
+    bucket = http_client.TokenBucket(rate=1000, burst=100, daily_limit=1)
+    bucket.acquire()
+    with pytest.raises(http_client.QuotaExceeded):
+        bucket.acquire()
+    bucket.day -= timedelta(days=1)
+    # Counted and warned about again on the new day
+    bucket.acquire()
+    assert bucket.used_today == 1 and bucket.warned
+
+
+def test_no_daily_limit():
+    bucket = http_client.TokenBucket(rate=1000, burst=100)
+    for _ in range(50):
+        bucket.acquire()
+    assert bucket.quota()['used_today'] == 50
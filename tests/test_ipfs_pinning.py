@@ -0,0 +1,124 @@
+# test_ipfs_pinning.py
+# Uploads through the in-memory LocalBackend and the CIDv0 index.
+
+import base64
+import threading
+
+import pytest
+
+import cid_util
+import config
+import create_db
+import ipfs_gateways
+import ipfs_pinning
+import ipfs_util
+from create_db import Base, engine
+from ipfs_util import lookup
+
+HELLO = b'hello world\n'
+HELLO_CID = 'QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o'
+# The empty UnixFS directory as CIDv1 and CIDv0
+EMPTY_DIR_V1 = 'bafybeiczsscdsbs7ffqz55asqdf3smv6klcw3gofszvwlyarci47bgf354'
+EMPTY_DIR_V0 = 'QmUNLLsPACCz1vLxQVkXqqLX5R1X345qqfHbsf67hvA3Nn'
+
+
+def _v1(cid):
+    """ base32 CIDv1 of a CIDv0, as NFT.Storage answers """
+    raw = b'\x01\x70' + cid_util.base58_decode(cid)
+    return 'b' + base64.b32encode(raw).decode().lower().rstrip('=')
+
+
+class V1Backend(ipfs_pinning.LocalBackend):
+    """ Answers with CIDv1 like NFT.Storage """
+
+    def add(self, file_name, source, progress=None, size=None):
+        return _v1(super().add(file_name, source, progress, size))
+
+
+@pytest.fixture
+def local(monkeypatch):
+    Base.metadata.drop_all(engine)
+    create_db.init_db()
+    backend = ipfs_pinning.LocalBackend()
+    monkeypatch.setitem(ipfs_pinning.BACKENDS, 'local', backend)
+    monkeypatch.setattr(config, 'IPFS_BACKENDS', ['local'])
+    monkeypatch.setattr(ipfs_gateways, 'prefetch', lambda cid: None)
+    yield backend
+    create_db.shutdown()
+
+
+def test_to_v0():
+    assert cid_util.to_v0(EMPTY_DIR_V1) == EMPTY_DIR_V0
+    assert cid_util.to_v0(EMPTY_DIR_V0) == EMPTY_DIR_V0
+    assert cid_util.to_v0(_v1(HELLO_CID)) == HELLO_CID
+    # Raw leaf, no CIDv0
+    assert cid_util.to_v0('bafkreifzjut3te2nhyekklss27nh3k72ysco7y32koao5eei66wof36n5e') is None
+
+
+def test_stream_indexed_by_local_cid(local):
+    source = lambda: [HELLO[:5], HELLO[5:]]
+    assert ipfs_pinning.add_and_pin_stream('hello.txt', source, file_unique_id='f1') == HELLO_CID
+    assert lookup(file_unique_id='f1') == HELLO_CID
+    assert lookup(cid=HELLO_CID) == HELLO_CID
+
+
+def test_v1_answer_indexed_by_cid_v0(local, monkeypatch):
+    monkeypatch.setitem(ipfs_pinning.BACKENDS, 'local', V1Backend())
+    assert ipfs_pinning.add_and_pin_data('hello.txt', HELLO) == HELLO_CID
+    assert lookup(cid=HELLO_CID) == HELLO_CID
+
+
+def test_cid_mismatch_not_indexed(local, monkeypatch):
+    monkeypatch.setattr(local, 'add', lambda *args: EMPTY_DIR_V1)
+    assert ipfs_pinning.add_and_pin_stream(
+        'hello.txt', lambda: [HELLO], file_unique_id='f1') == EMPTY_DIR_V1
+    assert lookup(file_unique_id='f1') is None
+    assert lookup(cid=HELLO_CID) is None
+
+
+def test_local_backend_round_trip(local):
+    data = bytes(range(256)) * 2048
+    # Two leaves, the source is read in chunks of another size
+    source = lambda: [data[i:i + 100000] for i in range(0, len(data), 100000)]
+    cid = ipfs_pinning.add_and_pin_stream('image.png', source)
+    assert cid == cid_util.compute_cid(data)
+    assert local.files[cid] == data
+    assert cid in local.pins
+    # Known now, not uploaded again
+    local.files.clear()
+    assert ipfs_pinning.add_and_pin_data('image.png', data) == cid
+    assert local.files == {}
+
+
+class _Response:
+    status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'ipfs_hash': HELLO_CID}
+
+
+def test_only_large_uploads_wait_for_a_slot(monkeypatch):
+    sizes = []
+
+    def post(url, data, **kwargs):
+        sizes.append(len(b''.join(data)))
+        return _Response()
+
+    monkeypatch.setattr(ipfs_util.http_client, 'post', post)
+    # Every slot taken
+    monkeypatch.setattr(ipfs_util, '_upload_slots', threading.BoundedSemaphore(1))
+    ipfs_util._upload_slots.acquire()
+    assert ipfs_util.create_ipfs_stream('hello.txt', lambda: [HELLO], size=len(HELLO))
+    assert sizes
+    large = threading.Thread(
+        target=ipfs_util.create_ipfs_stream, args=('big.png', lambda: [HELLO]),
+        kwargs={'size': config.IPFS_LARGE_UPLOAD_BYTES + 1}, daemon=True)
+    large.start()
+    large.join(0.5)
+    assert large.is_alive() and len(sizes) == 1
+    ipfs_util._upload_slots.release()
+    large.join(5)
+    assert len(sizes) == 2
@@ -0,0 +1,82 @@
+# test_key_util.py
+# key_util against cardano-cli. The keys and addresses are the CIP-19 test
+# vectors, which match `cardano-cli address key-hash` and `address build`.
+
+import json
+import os
+import stat
+
+import pytest
+from nacl.signing import SigningKey
+
+import key_util
+
+PAYMENT_VKEY = bytes.fromhex('73fea80d424276ad0978d4fe5310e8bc2d485f5f6bb3bf87612989f112ad5a7d')
+STAKE_VKEY = bytes.fromhex('09ab278d49b7b86a055185c474c4942281ddfa05a54684c7e8a6f230625aee57')
+PAYMENT_KEY_HASH = '9493315cd92eb5d8c4304e67b7e16ae36d61d34502694657811a2c8e'
+STAKE_KEY_HASH = '337b62cfff6403a06a3acbc34f8c46003c69fe79a3628cefa9c47251'
+TESTNET_ADDRESS = ('addr_test1qz2fxv2umyhttkxyxp8x0dlpdt3k6cwng5pxj3jhsydzer3n0d3vll'
+                   'myqwsx5wktcd8cc3sq835lu7drv2xwl2wywfgs68faae')
+MAINNET_ADDRESS = ('addr1qx2fxv2umyhttkxyxp8x0dlpdt3k6cwng5pxj3jhsydzer3n0d3vllmyqws'
+                   'x5wktcd8cc3sq835lu7drv2xwl2wywfgse35a3x')
+
+# RFC 8032 test 1
+SEED = bytes.fromhex('9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60')
+SEED_VKEY = bytes.fromhex('d75a980182b10ab7d54bfed3c964073a0ee172f3daa62325af021a68f707511a')
+
+
+@pytest.fixture
+def fixed_key(monkeypatch):
+    monkeypatch.setattr(key_util.SigningKey, 'generate', classmethod(lambda cls: cls(SEED)))
+
+
+def test_key_hash():
+    assert key_util.key_hash(PAYMENT_VKEY) == PAYMENT_KEY_HASH
+    assert key_util.key_hash(STAKE_VKEY) == STAKE_KEY_HASH
+
+
+def test_build_address():
+    assert key_util.build_address(PAYMENT_VKEY, STAKE_VKEY) == TESTNET_ADDRESS
+    assert key_util.build_address(
+        PAYMENT_VKEY, STAKE_VKEY, network_id=key_util.MAINNET_NETWORK_ID) == MAINNET_ADDRESS
+
+
+def test_bech32_round_trip():
+    raw = key_util.bech32_decode(TESTNET_ADDRESS)
+    assert raw == b'\x00' + bytes.fromhex(PAYMENT_KEY_HASH + STAKE_KEY_HASH)
+    assert key_util.bech32_encode('addr_test', raw) == TESTNET_ADDRESS
+
+
+def test_bech32_rejects_bad_checksum():
+    with pytest.raises(ValueError):
+        key_util.bech32_decode(TESTNET_ADDRESS[:-1] + 'q')
+
+
+def test_payment_key_envelopes(tmp_path, fixed_key):
+    vkey_file, skey_file = tmp_path / 'payment.vkey', tmp_path / 'payment.skey'
+    assert key_util.generate_key_pair(str(vkey_file), str(skey_file)) == SEED_VKEY
+    assert json.loads(vkey_file.read_text()) == {
+        "type": "PaymentVerificationKeyShelley_ed25519",
+        "description": "Payment Verification Key",
+        "cborHex": "5820" + SEED_VKEY.hex()
+    }
+    assert json.loads(skey_file.read_text()) == {
+        "type": "PaymentSigningKeyShelley_ed25519",
+        "description": "Payment Signing Key",
+        "cborHex": "5820" + SEED.hex()
+    }
+    assert stat.S_IMODE(os.stat(skey_file).st_mode) == 0o600
+
+
+def test_stake_key_envelopes(tmp_path, fixed_key):
+    vkey_file, skey_file = tmp_path / 'stake.vkey', tmp_path / 'stake.skey'
+    key_util.generate_key_pair(str(vkey_file), str(skey_file), role='stake')
+    assert json.loads(vkey_file.read_text())['type'] == "StakeVerificationKeyShelley_ed25519"
+    assert json.loads(skey_file.read_text())['type'] == "StakeSigningKeyShelley_ed25519"
+
+
+def test_signing_key_from_file(tmp_path, fixed_key):
+    vkey_file, skey_file = tmp_path / 'payment.vkey', tmp_path / 'payment.skey'
+    key_util.generate_key_pair(str(vkey_file), str(skey_file))
+    assert key_util.read_key(str(vkey_file)) == SEED_VKEY
+    assert bytes(key_util.signing_key(str(skey_file))) == bytes(SigningKey(SEED))
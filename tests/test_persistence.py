@@ -0,0 +1,135 @@
+# test_persistence.py
+# DBPersistence without a running bot, telegram.ext.BasePersistence is
+# stubbed when python-telegram-bot is not installed.
+
+import json
+import sys
+import types
+from datetime import datetime, timedelta
+
+import pytest
+
+try:
+    import telegram.ext  # noqa: F401
+except ImportError:
+    class BasePersistence:
+        def __init__(self, store_user_data=True, store_chat_data=True, store_bot_data=True):
+            self.store_user_data = store_user_data
+            self.store_chat_data = store_chat_data
+            self.store_bot_data = store_bot_data
+
+    sys.modules['telegram'] = types.ModuleType('telegram')
+    sys.modules['telegram.ext'] = types.ModuleType('telegram.ext')
+    sys.modules['telegram.ext'].BasePersistence = BasePersistence
+
+import config
+import create_db
+import persistence
+from create_db import Base, ConversationState, UserDataEntry, engine, session_scope
+
+
+@pytest.fixture
+def db():
+    Base.metadata.drop_all(engine)
+    create_db.init_db()
+    yield
+    create_db.shutdown()
+
+
+@pytest.fixture
+def store(db):
+    # The flusher thread waits an hour, the tests write with _write()
+    yield persistence.DBPersistence(flush_interval=3600)
+
+
+def _rows():
+    with session_scope() as session:
+        return {(entry.user_id, entry.key): json.loads(entry.value)
+                for entry in session.query(UserDataEntry)}
+
+
+def test_only_changed_keys_are_written(store):
+    store.update_user_data(1, {'a': 1, 'b': [1, 2]})
+    assert store._dirty_data == {(1, 'a'): '1', (1, 'b'): '[1, 2]'}
+    store._write()
+    assert _rows() == {(1, 'a'): 1, (1, 'b'): [1, 2]}
+    # Same content, nothing to write
+    store.update_user_data(1, {'b': [1, 2], 'a': 1})
+    assert store._dirty_data == {}
+    # Changed, removed and not JSON
+    store.update_user_data(1, {'a': 2, 'c': object()})
+    assert store._dirty_data == {(1, 'a'): '2', (1, 'b'): None}
+    store._write()
+    assert _rows() == {(1, 'a'): 2}
+
+
+def test_failed_write_is_retried(store, monkeypatch):
+    def fail(session, dirty_data, now):
+        raise RuntimeError("database gone")
+
+    store.update_user_data(1, {'a': 1, 'b': 1})
+    store.update_conversation('mint', (10, 1), 3)
+    monkeypatch.setattr(store, '_write_user_data', fail)
+    with pytest.raises(RuntimeError):
+        store._write()
+    assert _rows() == {}
+    # Changed while the write failed, the newer value wins
+    store.update_user_data(1, {'a': 2, 'b': 1})
+    monkeypatch.undo()
+    store._write()
+    assert _rows() == {(1, 'a'): 2, (1, 'b'): 1}
+    assert store._dirty_data == {} and store._dirty_conversations == {}
+    assert persistence.DBPersistence(flush_interval=3600).get_conversations('mint') == {(10, 1): 3}
+
+
+def test_drop_user_data(store):
+    store.update_user_data(1, {'a': 1})
+    store.update_user_data(2, {'a': 1})
+    store._write()
+    store.drop_user_data(1)
+    store._write()
+    assert _rows() == {(2, 'a'): 1}
+    # Nothing stored any more, nothing to delete
+    store.drop_user_data(1)
+    assert store._dirty_data == {}
+
+
+def test_conversation_round_trip(store):
+    store.update_conversation('mint', (10, 1), 3)
+    store.update_conversation('mint', (10, 2), 4)
+    # A run_async handler still running, then a state that is not stored
+    store.update_conversation('mint', (10, 3), (5, object()))
+    store.update_conversation('mint', (10, 4), object())
+    store.update_conversation('collection', (10, 1), 1)
+    store._write()
+    store.update_conversation('mint', (10, 2), None)
+    store._write()
+    restarted = persistence.DBPersistence(flush_interval=3600)
+    assert restarted.get_conversations('mint') == {(10, 1): 3, (10, 3): 5}
+    assert restarted.get_conversations('collection') == {(10, 1): 1}
+
+
+def test_old_rows_are_pruned(store):
+    old = datetime.utcnow() - timedelta(hours=config.PERSISTENCE_MAX_AGE_HOURS + 1)
+    with session_scope() as session:
+        session.add(UserDataEntry(user_id=1, key='a', value='1', updated_at=old))
+        session.add(UserDataEntry(user_id=2, key='a', value='1', updated_at=old))
+        session.add(UserDataEntry(user_id=2, key='b', value='1'))
+        session.add(ConversationState(name='mint', key='[10, 1]', state=3, updated_at=old))
+        session.add(ConversationState(name='mint', key='[10, 2]', state=3))
+    # On start, a user active on any key keeps all of them
+    assert store.get_user_data() == {2: {'a': 1, 'b': 1}}
+    assert set(_rows()) == {(2, 'a'), (2, 'b')}
+    with session_scope() as session:
+        assert session.query(ConversationState).count() == 1
+    # And again once PERSISTENCE_PRUNE_INTERVAL has passed
+    with session_scope() as session:
+        for entry in session.query(UserDataEntry):
+            entry.updated_at = old
+    store._pruned_at -= config.PERSISTENCE_PRUNE_INTERVAL + 1
+    store.update_user_data(3, {'a': 1})
+    store._write()
+    assert _rows() == {(3, 'a'): 1}
+    # Pruned user 2 is written in full on its next change
+    store.update_user_data(2, {'a': 1, 'b': 2})
+    assert store._dirty_data == {(2, 'a'): '1', (2, 'b'): '2'}
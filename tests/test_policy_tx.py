@@ -0,0 +1,133 @@
+# test_policy_tx.py
+# Golden vectors of the in-process policy and transaction encoders.
+# POLICY_ID, AUX_HASH, BODY_CBOR and TX_ID were produced by pycardano 0.19.2
+# (ScriptAll/ScriptPubkey/InvalidHereAfter, AuxiliaryData, TransactionBody),
+# an implementation independent of this code. Where CARDANO_CLI points at
+# a cardano-cli binary they are checked against `transaction policyid` and
+# `transaction txid` too. A change here changes what goes on chain.
+
+import json
+import os
+
+import cbor2
+import pytest
+from nacl.signing import SigningKey, VerifyKey
+
+import cbor_util
+import cli_runner
+import config
+import policy_util
+import tx_util
+
+needs_cli = pytest.mark.skipif(
+    not os.access(config.CARDANO_CLI, os.X_OK), reason="cardano-cli not installed")
+
+KEY_HASH = '9493315cd92eb5d8c4304e67b7e16ae36d61d34502694657811a2c8e'
+BEFORE_SLOT = 50000000
+POLICY_CBOR = ('8201828200581c9493315cd92eb5d8c4304e67b7e16ae36d61d34502694657811a2c8e'
+               '82051a02faf080')
+POLICY_ID = 'c4b542badff6dc0d2af9c2de8a7a92da129bbabbec09f8f5893519fe'
+
+ADDRESS = ('addr_test1qz2fxv2umyhttkxyxp8x0dlpdt3k6cwng5pxj3jhsydzer3n0d3vll'
+           'myqwsx5wktcd8cc3sq835lu7drv2xwl2wywfgs68faae')
+METADATA = {"721": {POLICY_ID: {"1": {
+    "image": "ipfs://QmTgqnhFBMkfT9s8PHKcdXBn1f5bG3Q5hmBaR4U6hoTvb1",
+    "ticker": "MINE",
+    "name": "Test Token",
+    "description": "just testing",
+}}}}
+BUNDLE = {POLICY_ID: {"MINE": 1}}
+AUX_HASH = '0c071206332a7ef898ed8ec24514c6742f85ef89a0818a920d268bc517ff39a1'
+TX_ID = 'c9fefe9f1644ee5bb1f285a449e710658c2e6a518277da5de27cf9d796eb8a2d'
+BODY_CBOR = (
+    'a60081825820abababababababababababababababababababababababababababababababab00'
+    '0181825839009493315cd92eb5d8c4304e67b7e16ae36d61d34502694657811a2c8e337b62cfff'
+    '6403a06a3acbc34f8c46003c69fe79a3628cefa9c47251821a00493e00a1581cc4b542badff6dc'
+    '0d2af9c2de8a7a92da129bbabbec09f8f5893519fea1444d494e4501021a00030d40031a02faf0'
+    '800758200c071206332a7ef898ed8ec24514c6742f85ef89a0818a920d268bc517ff39a109a158'
+    '1cc4b542badff6dc0d2af9c2de8a7a92da129bbabbec09f8f5893519fea1444d494e4501'
+)
+SEED = bytes.fromhex('9d61b19deffd5a60ba844af492ec2cc44449c5697b326919703bac031cae7f60')
+PARAMS = {'txFeePerByte': 44, 'txFeeFixed': 155381, 'minUTxOValue': 1000000}
+
+
+def _policy():
+    return policy_util.build_policy(KEY_HASH, before_slot=BEFORE_SLOT)
+
+
+def _body():
+    return tx_util.build_tx_body(
+        [('ab' * 32, 0)], [(ADDRESS, 4800000, BUNDLE)], fee=200000,
+        invalid_hereafter=BEFORE_SLOT, mint=BUNDLE, metadata=METADATA)
+
+
+def test_policy_script_cbor():
+    script = _policy()
+    assert policy_util.script_cbor(script).hex() == POLICY_CBOR
+    assert cbor2.dumps(policy_util.script_to_native(script)).hex() == POLICY_CBOR
+
+
+def test_policy_id():
+    assert policy_util.policy_id(_policy()) == POLICY_ID
+
+
+def test_aux_data_hash():
+    body, aux = _body()
+    assert body[7].hex() == AUX_HASH
+    assert tx_util.blake2b_256(cbor2.dumps(aux)).hex() == AUX_HASH
+
+
+def test_tx_body():
+    body, _ = _body()
+    assert cbor_util.dumps(body).hex() == BODY_CBOR
+    assert cbor2.dumps(body).hex() == BODY_CBOR
+    assert tx_util.blake2b_256(bytes.fromhex(BODY_CBOR)).hex() == TX_ID
+
+
+def test_sign_tx():
+    body, aux = _body()
+    key = SigningKey(SEED)
+    tx_cbor, tx_id = tx_util.sign_tx(body, aux, [key], [_policy()])
+    assert tx_id == TX_ID
+    decoded_body, witnesses, decoded_aux = cbor2.loads(tx_cbor)
+    (vkey, signature), = witnesses[0]
+    VerifyKey(vkey).verify(bytes.fromhex(TX_ID), signature)
+    assert witnesses[1] == [cbor2.loads(bytes.fromhex(POLICY_CBOR))]
+    assert decoded_aux == cbor2.loads(cbor2.dumps(aux))
+
+
+def test_build_signed_tx_pays_min_fee():
+    tx_cbor, _, _, fee = tx_util.build_signed_tx(
+        inputs=[('ab' * 32, 0)], outputs=[(ADDRESS, 5000000, BUNDLE)],
+        invalid_hereafter=BEFORE_SLOT, protocol_params=PARAMS,
+        signing_keys=[SigningKey(SEED)], scripts=[_policy()],
+        mint=BUNDLE, metadata=METADATA)
+    assert fee == tx_util.min_fee(len(tx_cbor), PARAMS)
+    body = cbor2.loads(tx_cbor)[0]
+    assert body[2] == fee
+    assert body[1][0][1][0] == 5000000 - fee
+
+
+def test_long_metadata_strings_are_split():
+    native = tx_util.metadata_to_native({"721": {"a": "x" * 70}})
+    assert native == {721: {"a": ["x" * 64, "x" * 6]}}
+
+
+@needs_cli
+def test_policy_id_matches_cardano_cli(tmp_path):
+    script_file = tmp_path / 'policy.script'
+    script_file.write_text(json.dumps(_policy()))
+    result = cli_runner.run(['transaction', 'policyid', '--script-file', script_file], check=True)
+    assert result.stdout.strip() == POLICY_ID
+
+
+@needs_cli
+def test_tx_id_matches_cardano_cli(tmp_path):
+    body, aux = _body()
+    body_file = tmp_path / 'matx.raw'
+    tx_util.write_envelope(str(body_file), tx_util.TX_BODY_TYPE, cbor_util.dumps([body, [], aux]))
+    result = cli_runner.run(['transaction', 'txid', '--tx-body-file', body_file], check=True)
+    output = result.stdout.strip()
+    # Newer versions answer with JSON
+    tx_id = json.loads(output)['txhash'] if output.startswith('{') else output
+    assert tx_id == TX_ID
@@ -0,0 +1,50 @@
+# test_protocol_params.py
+# Concurrent refreshes of the on-disk protocol parameters.
+
+import json
+import threading
+import time
+
+import pytest
+
+import cli_runner
+import protocol_params
+
+
+def test_concurrent_refreshes(tmp_path, monkeypatch):
+    monkeypatch.setattr(protocol_params, 'PROTOCOL_PARAMS_FILE', str(tmp_path / 'protocol.json'))
+    out_files = []
+
+    def run(args, check=False):
+        out_file = args[args.index('--out-file') + 1]
+        out_files.append(out_file)
+        with open(out_file, 'w') as params_file:
+            params_file.write('{"maxTxSize": ')
+            # Both queries write at the same time
+            time.sleep(0.2)
+            json.dump(16384, params_file)
+            params_file.write('}')
+
+    monkeypatch.setattr(cli_runner, 'run', run)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(protocol_params._fetch()))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{'maxTxSize': 16384}] * 2
+    assert len(set(out_files)) == 2
+    assert [p.name for p in tmp_path.iterdir()] == ['protocol.json']
+
+
+def test_failed_refresh_leaves_no_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(protocol_params, 'PROTOCOL_PARAMS_FILE', str(tmp_path / 'protocol.json'))
+
+    def run(args, check=False):
+        raise cli_runner.CliError("cardano-cli query protocol-parameters timed out")
+
+    monkeypatch.setattr(cli_runner, 'run', run)
+    with pytest.raises(cli_runner.CliError):
+        protocol_params._fetch()
+    assert list(tmp_path.iterdir()) == []
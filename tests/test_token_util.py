@@ -0,0 +1,73 @@
+# test_token_util.py
+# Checks of a session's leg before it joins a batch mint.
+
+import json
+
+import pytest
+
+import cli_runner
+import config
+import key_util
+import protocol_params
+import token_util
+from test_policy_tx import ADDRESS, BEFORE_SLOT, BUNDLE, METADATA, PARAMS, _policy
+
+
+@pytest.fixture
+def leg(tmp_path, monkeypatch):
+    monkeypatch.setattr(protocol_params, 'get', lambda: PARAMS)
+    skeys = []
+    for name in ('payment', 'policy'):
+        key_util.generate_key_pair(str(tmp_path / f'{name}.vkey'), str(tmp_path / f'{name}.skey'))
+        skeys.append(str(tmp_path / f'{name}.skey'))
+    return {
+        'tx_in': ('ab' * 32, 0),
+        'tx_out': (ADDRESS, 5000000, BUNDLE),
+        'mint': BUNDLE,
+        'metadata': METADATA['721'],
+        'policy_script': _policy(),
+        'signing_keys': skeys,
+        'invalid_after_slot': BEFORE_SLOT,
+    }
+
+
+def test_good_leg(leg):
+    token_util._check_leg(leg, BEFORE_SLOT - 1)
+
+
+def test_locked_policy(leg):
+    with pytest.raises(ValueError):
+        token_util._check_leg(leg, BEFORE_SLOT)
+
+
+def test_underfunded_leg(leg):
+    leg['tx_out'] = (ADDRESS, 1100000, BUNDLE)
+    with pytest.raises(ValueError):
+        token_util._check_leg(leg, BEFORE_SLOT - 1)
+
+
+def test_missing_key_file(leg):
+    leg['signing_keys'][1] += '.missing'
+    with pytest.raises(OSError):
+        token_util._check_leg(leg, BEFORE_SLOT - 1)
+
+
+def test_query_utxos_scratch_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'SHARED_DIR', str(tmp_path))
+
+    def run(args, check=False):
+        out_file = args[args.index('--out-file') + 1]
+        assert out_file.startswith(str(tmp_path))
+        with open(out_file, 'w') as utxo_file:
+            json.dump({f"{'ab' * 32}#1": {'address': ADDRESS, 'value': {'lovelace': 5000000}}},
+                      utxo_file)
+
+    monkeypatch.setattr(cli_runner, 'run', run)
+    utxos = token_util.query_utxos([ADDRESS])
+    assert utxos[ADDRESS][0]['lovelace'] == 5000000
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_query_utxos_without_scratch_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'SHARED_DIR', str(tmp_path / 'missing'))
+    assert token_util.query_utxos([ADDRESS]) == {ADDRESS: []}
@@ -0,0 +1,42 @@
+# token_repo.py
+# Loading and saving Tokens rows. The pipeline loads a row once, advances
+# it in memory and commits at stage boundaries only.
+
+from create_db import Tokens, TokenStage
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get(session, session_uuid):
+    """ The session's row, or None """
+    return session.query(Tokens).filter(
+        Tokens.session_uuid == session_uuid).one_or_none()
+
+
+def create(session, session_uuid, **fields):
+    """ Adds and commits a new row with its own key set """
+    token_data = Tokens(session_uuid=session_uuid)
+    token_data.key_id = session_uuid
+    token_data.update(**fields)
+    token_data.advance(TokenStage.NEW)
+    session.add(token_data)
+    session.commit()
+    return token_data
+
+
+def advance(session, token_data, stage, **fields):
+    """ Moves to stage with fields set, committed as one unit """
+    token_data.update(**fields)
+    if not token_data.reached(stage):
+        token_data.advance(stage)
+    session.commit()
+    logger.info(f"{token_data.session_uuid} reached {TokenStage(stage).name}")
+
+
+def advance_all(session, tokens, stage, **fields):
+    """ Same as advance() for several rows, e.g. a batch mint, in one commit """
+    for token_data in tokens:
+        token_data.update(**fields)
+        if not token_data.reached(stage):
+            token_data.advance(stage)
+    session.commit()
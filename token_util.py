@@ -2,58 +2,142 @@
 
 import json
 import os
-import requests
-import subprocess
-import time
+import tempfile
+from datetime import datetime
+from uuid import uuid4
 
+import address_pool
+import chain_tip
+import cli_runner
 import config
-from create_db import Session, Tokens
+import http_client
+import key_util
+import policy_util
+import protocol_params
+import token_repo
+import tx_cache
+import tx_util
+from create_db import session_scope, Tokens, TokenStage
+from singleflight import coalesce
 import logging
 logger = logging.getLogger(__name__)
 
 
+def _query_utxo(*args):
+    """ Runs cardano-cli query utxo, returns stdout or '' on failure """
+    try:
+        result = cli_runner.run(
+            ['query', 'utxo', *args, '--testnet-magic', config.TESTNET_ID])
+    except cli_runner.CliError:
+        logging.exception("UTXO query failed")
+        return ''
+    return result.stdout if result.returncode == 0 else ''
+
+@coalesce(ttl=config.UTXO_QUERY_TTL)
 def check_wallet_utxo(wallet):
     """ Querying all UTXOs in wallet """
-    cmd = f"{config.CARDANO_CLI} query utxo " \
-          f"--address {wallet} " \
-          f"--testnet-magic {config.TESTNET_ID}"
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    out = proc.communicate()
-    response = str(out[0], 'UTF-8')
+    response = _query_utxo('--address', wallet)
     logging.info(response.split()[4:])
     return response.split()[4:]
 
 def check_testnet():
     """ Verifies communication with testnet by querying UTXOs """
-    cmd = f"{config.CARDANO_CLI} query utxo " \
-          f"--testnet-magic {config.TESTNET_ID}"
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    out = proc.communicate()
-    response = str(out[0], 'UTF-8')
+    response = _query_utxo()
     logging.info(response)
 
 
-def get_current_slot():
-    """ Gets blockchain tip returns current slot """
-    cmd = f"{config.CARDANO_CLI} query tip " \
-          f"--testnet-magic {config.TESTNET_ID}"
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    out = proc.communicate()
-    response = str(out[0], 'UTF-8')
-    logging.info(response)
-    data = json.loads(response)
-    logging.info(f"Current Slot:  {data['slot']}")
-    return data['slot']
+def query_utxos(wallets):
+    """ Querying all UTXOs of several wallets in one call
+    Returns a dict of address -> list of UTXO dicts """
+    utxos = {wallet: [] for wallet in wallets}
+    if not utxos:
+        return utxos
+    addresses = []
+    for wallet in utxos:
+        addresses += ['--address', wallet]
+    out_file = None
+    try:
+        fd, out_file = tempfile.mkstemp(prefix='utxo-', suffix='.json', dir=config.SHARED_DIR)
+        os.close(fd)
+        cli_runner.run(
+            ['query', 'utxo', *addresses,
+             '--testnet-magic', config.TESTNET_ID,
+             '--out-file', out_file],
+            check=True)
+        with open(out_file) as utxo_file:
+            data = json.load(utxo_file)
+    except (OSError, ValueError, cli_runner.CliError):
+        logging.exception("Batched UTXO query failed")
+        return utxos
+    finally:
+        if out_file:
+            os.remove(out_file)
+
+    for tx_in, entry in data.items():
+        tx_hash, tx_ix = tx_in.split('#')
+        value = dict(entry.get('value') or {'lovelace': entry.get('amount', 0)})
+        utxo = {
+            'tx_hash': tx_hash,
+            'tx_ix': int(tx_ix),
+            'lovelace': int(value.pop('lovelace', 0)),
+            # policy_id -> {asset_name: quantity}
+            'assets': value,
+        }
+        utxos.setdefault(entry['address'], []).append(utxo)
+    return utxos
 
+@coalesce(ttl=config.SLOT_LENGTH)
+def get_current_slot():
+    """ Gets the current slot from the cached chain tip """
+    current_slot = chain_tip.current_slot()
+    logging.info(f"Current Slot:  {current_slot} "
+                 f"(tip {chain_tip.staleness():.0f}s old)")
+    return current_slot
+
+def submit_tx(signed_tx_file):
+    """ Submits a signed transaction file, True if the node accepted it """
+    try:
+        result = cli_runner.run(
+            ['transaction', 'submit',
+             '--tx-file', signed_tx_file,
+             '--testnet-magic', config.TESTNET_ID])
+    except cli_runner.CliError:
+        logging.exception("Transaction submit failed")
+        return False
+    logging.info(result.stdout)
+    return result.returncode == 0
+
+def submit_txs(signed_tx_files):
+    """ Submits several signed transactions side by side
+    Returns a list of True/False in the same order """
+    results = cli_runner.run_many(
+        [['transaction', 'submit',
+          '--tx-file', signed_tx_file,
+          '--testnet-magic', config.TESTNET_ID]
+         for signed_tx_file in signed_tx_files])
+    return [isinstance(result, cli_runner.CliResult) and result.returncode == 0
+            for result in results]
+
+# tx_cache keeps the results, concurrent misses share one request
+@coalesce()
 def get_tx_details(tx_hash):
-    """ Get TX details from BlockFrost.io """
+    """ Get TX details from BlockFrost.io
+    Returns False when Blockfrost doesn't know the transaction (yet) """
+    cached = tx_cache.get(tx_hash)
+    if cached is not None:
+        return cached
     url = f'https://cardano-testnet.blockfrost.io/api/v0/txs/{tx_hash}/utxos'
     headers = {"project_id": f"{config.BLOCKFROST_TESTNET}"}
-    res = requests.get(url, headers=headers)
+    res = http_client.get(url, headers=headers, rate_limit='blockfrost_testnet')
+    if res.status_code == 404:
+        logging.info(f"Transaction {tx_hash} not indexed yet")
+        tx_cache.put_missing(tx_hash)
+        return False
     res.raise_for_status()
     if res.status_code == 200:
         logging.info("Got TX Details.")
-        # logging.info(res.json())
+        # Only transactions on chain are found, their data never changes
+        tx_cache.put(tx_hash, res.json())
         return res.json()
     else:
         logging.info("Something failed here? blockfrost failed")
@@ -63,312 +147,188 @@ def before_mint(**kwargs):
     """ Sets up the token files and metadata
     User should provide all the details in dict """
     logging.info(f"before_mint started: \n {kwargs}")
-    session_uuid = kwargs.get('session_uuid')
+    session_uuid = kwargs.pop('session_uuid')
 
     # Start DB Session
-    session = Session()
+    with session_scope() as session:
+        return _before_mint(session, session_uuid, **kwargs)
 
+def _before_mint(session, session_uuid, **kwargs):
     # Check to see if session already exists
-    sesh_exists = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).scalar() is not None
-    if sesh_exists:
-        token_data = session.query(Tokens).filter(
-            Tokens.session_uuid == session_uuid).one()
+    token_data = token_repo.get(session, session_uuid)
+    if token_data is not None:
         logging.info(f'Session already exists {token_data}')
+    elif address_pool.claim(session, session_uuid, **kwargs):
+        # Keys and address come ready made from the pool
+        token_data = token_repo.get(session, session_uuid)
+        logging.info(f"New Session {session_uuid} from address pool")
     else:
         # No token session yet, add the data
         logging.info(f"New Session {session_uuid}")
-        token_data = Tokens(session_uuid=session_uuid)
-        token_data.update(**kwargs)
-        session.add(token_data)
-        session.commit()
+        token_data = token_repo.create(session, session_uuid, **kwargs)
 
     # ### Start the actual minting process ###
     logging.info("Setting up the token data")
 
-    # Create Stake keys
-    # Check to see if we ran this step already
-    stake_keys_created = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.stake_keys_created).scalar() is not None
-    if stake_keys_created:
-        logging.info("Stake Keys already created for session, skip.")
-        # return False
-    else:
-        logging.info("Create Stake keys")
-        stake_vkey_file = f'tmp/{session_uuid}-stake.vkey'
-        stake_skey_file = f'tmp/{session_uuid}-stake.skey'
-        cmd = f"{config.CARDANO_CLI} stake-address key-gen " \
-              f"--verification-key-file {stake_vkey_file} " \
-              f"--signing-key-file {stake_skey_file}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        response = str(out[0], 'UTF-8')
-        if response == '':
-            logging.info("Stake keys created.")
-            token_data.stake_keys_created = True
-            session.add(token_data)
-            session.commit()
-        else:
-            # Stake keys are needed if we fail here we bail out
-            logging.info("FAIL: Something went wrong creating stake keys.")
-            return False
-
-    # Create Payment keys
-    # Check to see if we ran this step already
-    payment_keys_created = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.payment_keys_created).scalar() is not None
-    if payment_keys_created:
-        logging.info("Payment Keys already created for session, skip.")
-        # return False
+    # Create Stake keys, Payment keys and the Bot Payment Address
+    if token_data.reached(TokenStage.KEYS_READY):
+        logging.info("Keys and Bot Payment Address already created for session, skip.")
     else:
-        logging.info("Create Payment keys")
-        payment_vkey_file = f'tmp/{session_uuid}-payment.vkey'
-        payment_skey_file = f'tmp/{session_uuid}-payment.skey'
-        cmd = f"{config.CARDANO_CLI} address key-gen " \
-              f"--verification-key-file {payment_vkey_file} " \
-              f"--signing-key-file {payment_skey_file}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        response = str(out[0], 'UTF-8')
-        if response == '':
-            logging.info("Payment keys created.")
-            token_data.payment_keys_created = True
-            session.add(token_data)
-            session.commit()
-        else:
-            # Payment keys are needed if we fail here we bail out
-            logging.info("FAIL: Something went wrong creating Payment keys.")
+        logging.info("Create Stake and Payment keys")
+        try:
+            stake_vkey = key_util.generate_key_pair(
+                token_data.key_file('stake.vkey'), token_data.key_file('stake.skey'),
+                role='stake')
+            payment_vkey = key_util.generate_key_pair(
+                token_data.key_file('payment.vkey'), token_data.key_file('payment.skey'))
+        except OSError:
+            # Stake and Payment keys are needed if we fail here we bail out
+            logging.exception("FAIL: Something went wrong creating keys.")
             return False
-
-    # Create Payment Address
-    stake_keys_created = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.stake_keys_created).scalar() is not None
-
-    payment_keys_created = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.payment_keys_created).scalar() is not None
-
-    if stake_keys_created and payment_keys_created:
         logging.info("Creating Bot Payment Address from stake and Payment keys.")
-        stake_vkey_file = f'tmp/{session_uuid}-stake.vkey'
-        payment_vkey_file = f'tmp/{session_uuid}-payment.vkey'
-        cmd = f"{config.CARDANO_CLI} address build " \
-              f"--payment-verification-key-file {payment_vkey_file} " \
-              f"--stake-verification-key-file {stake_vkey_file} " \
-              f"--testnet-magic {config.TESTNET_ID}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        response = str(out[0], 'UTF-8')
-        bot_payment_addr = response.strip()
-        logging.info(bot_payment_addr.strip())
-        token_data.bot_payment_addr = bot_payment_addr
-        session.add(token_data)
-        session.commit()
-    else:
-        logging.info(f"Either Stake Keys, or Payment Keys have not been created")
-        logging.info(f"Stake Keys: {stake_keys_created}")
-        logging.info(f"Payment Keys: {payment_keys_created}")
-        logging.info("FAIL: Something missing, can't move on.")
-        return False
+        bot_payment_addr = key_util.build_address(
+            payment_vkey=payment_vkey, stake_vkey=stake_vkey)
+        logging.info(bot_payment_addr)
+        token_repo.advance(
+            session, token_data, TokenStage.KEYS_READY, bot_payment_addr=bot_payment_addr)
 
     # Get the blockchain protocol parameters
-    # Generally we only need this once and it should stay around
-    protocol_params = 'tmp/protocol.json'
-    protocol_params_exist = os.path.isfile(protocol_params)
-
-    protocol_params_created = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.protocol_params_created).scalar is not None
-
-    if protocol_params_exist and protocol_params_created:
-        logging.info("protocol_params_exist, no need to recreate")
-    else:
-        cmd = f"{config.CARDANO_CLI} query protocol-parameters " \
-              f"--testnet-magic {config.TESTNET_ID} " \
-              f"--out-file {protocol_params}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        response = str(out[0], 'UTF-8')
-        if response == '':
-            token_data.protocol_params_created = True
-            session.add(token_data)
-            session.commit()
-            logging.info("Saved protocol.json")
-        else:
-            logging.info("FAIL: Could not get protocol.json")
-            return False
-
-    # Create Policy Script
-    policy_vkey = f'tmp/{session_uuid}-policy.vkey'
-    policy_skey = f'tmp/{session_uuid}-policy.skey'
-
-    policy_keys_exist = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.policy_keys_created).scalar() is not None
+    # Shared by every session and refreshed each epoch, see protocol_params.py
+    try:
+        protocol_params.get()
+    except (OSError, ValueError, RuntimeError):
+        logging.exception("FAIL: Could not get protocol.json")
+        return False
 
-    if policy_keys_exist:
+    # Create Policy Keys
+    if token_data.reached(TokenStage.POLICY_KEYS_READY):
         logging.info("Policy Keys already created for session, skip.")
     else:
-        # Create Keys
-        cmd = f"{config.CARDANO_CLI} address key-gen " \
-              f"--verification-key-file {policy_vkey} " \
-              f"--signing-key-file {policy_skey}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        response = str(out[0], 'UTF-8')
-        if response == '':
-            logging.info("Policy keys created.")
-            token_data.policy_keys_created = True
-            session.add(token_data)
-            session.commit()
-        else:
+        try:
+            key_util.generate_key_pair(
+                token_data.key_file('policy.vkey'), token_data.key_file('policy.skey'))
+        except OSError:
             # Policy keys are needed if we fail here we bail out
-            logging.info("FAIL: Something went wrong creating Policy keys.")
+            logging.exception("FAIL: Something went wrong creating Policy keys.")
             return False
+        logging.info("Policy keys created.")
+        token_repo.advance(session, token_data, TokenStage.POLICY_KEYS_READY)
     # At this point we need the bot_payment_addr to have UTXO to burn
     logging.info(f"Please deposit 5 ADA in the following address:")
     logging.info(token_data.bot_payment_addr)
     return True
 
+def _no_progress(text):
+    pass
+
 def mint(**kwargs):
-    """ Minting of the actual token """
+    """ Minting of the actual token
+    Pass progress=callable(text) to receive stage updates
+    Returns None when Blockfrost hasn't indexed the funding yet, try again later """
     # Get session:
     session_uuid = kwargs.get('session_uuid')
-    # Start DB Session
-    session = Session()
+    progress = kwargs.get('progress') or _no_progress
     logging.info(f'Minting started for {session_uuid}')
-
-    sesh_exists = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).scalar() is not None
-    if sesh_exists:
+    # Start DB Session
+    with session_scope() as session:
+        token_data = token_repo.get(session, session_uuid)
+        if token_data is None:
+            logging.info(f"No Session found: {session_uuid}")
+            return False
         logging.info(f'Session Found: {session_uuid}')
-    else:
-        logging.info(f"No Session found: {session_uuid}")
-        return False
-
-    # We have data
-    token_data = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).one()
-
-    # Temporary arbitrary logic to fail tries to re-mint tokens
-    if token_data.tx_submitted:
-        logging.info(f"Session already Minted: {session_uuid}")
-        return False
 
-    # Get current slot
-    current_slot = get_current_slot()
+        # Temporary arbitrary logic to fail tries to re-mint tokens
+        if token_data.reached(TokenStage.SUBMITTED):
+            logging.info(f"Session already Minted: {session_uuid}")
+            return False
 
-    slot_cushion = config.SLOT_BUFFER
-    invalid_after_slot = current_slot + slot_cushion
-    # Add to DB
-    token_data.current_slot = current_slot
-    token_data.slot_cushion = slot_cushion
-    token_data.invalid_after_slot = invalid_after_slot
-    session.add(token_data)
-    session.commit()
-
-    # Check to see if we have UTXO
-    utxo = check_wallet_utxo(token_data.bot_payment_addr)
-    tx_hash = utxo[0]
-    tx_ix = int(utxo[1])
-    available_lovelace = int(utxo[2])
-    if utxo:
-        # Add UTXO data to DB
-        token_data.utxo_tx_hash = utxo[0]
-        token_data.utxo_tx_ix = utxo[1]
-        token_data.utxo_lovelace = utxo[2]
-        session.add(token_data)
-        session.commit()
-
-    if available_lovelace >= 5000000:
+        leg = _prepare_mint(session, token_data, progress)
+        if not leg:
+            return leg
+        return _build_and_submit(session, [leg], f'{config.SHARED_DIR}/{session_uuid}')
+
+def _prepare_mint(session, token_data, progress):
+    """ Finds the funds, creates the policy and metadata for a session
+    Returns the session's part of a mint transaction, False on failure
+    or None when the funding transaction isn't indexed by Blockfrost yet """
+    session_uuid = token_data.session_uuid
+
+    if not token_data.reached(TokenStage.FUNDED):
+        # Check to see if we have UTXO
+        # The funding_watcher may have found it for us already
+        if token_data.utxo_tx_hash:
+            utxo = [token_data.utxo_tx_hash, token_data.utxo_tx_ix, token_data.utxo_lovelace]
+        else:
+            utxo = check_wallet_utxo(token_data.bot_payment_addr)
+        if not utxo:
+            logging.info(f"No UTXO found for {token_data.bot_payment_addr}")
+            progress("Sorry, but there is no UTXO to use yet. Transaction not found. "
+                     "Minting starts automatically once your funds arrive.")
+            return False
+        if int(utxo[2]) < config.MIN_FUNDING_LOVELACE:
+            # FAIL
+            logging.info("Creator failed to send proper funds!")
+            progress("The funding transaction holds less than 5 ADA.")
+            # Look again on the next try
+            token_data.utxo_tx_hash = None
+            session.commit()
+            return False
         # Check BlockFrost for tx details to get the return addr
         tx_details = get_tx_details(utxo[0])
+        if not tx_details:
+            # Seen by the node before Blockfrost, the mint queue tries again
+            logging.info(f"Funding of {session_uuid} not indexed by Blockfrost yet")
+            return None
         creator_pay_addr = tx_details['inputs'][0]['address']
-        token_data.creator_pay_addr = creator_pay_addr
-        session.add(token_data)
-        session.commit()
+        token_repo.advance(
+            session, token_data, TokenStage.FUNDED,
+            utxo_tx_hash=utxo[0], utxo_tx_ix=int(utxo[1]), utxo_lovelace=int(utxo[2]),
+            creator_pay_addr=creator_pay_addr)
         logging.info(f"Added creator_pay_addr to DB, "
               f"we will send the token back to this address")
         logging.info(creator_pay_addr)
-    else:
-        # FAIL
-        logging.info("Creator failed to send proper funds!")
-        return False
+    progress("OK, I found the Transaction! Building your NFT...")
 
     # Use policy keys to make policy file
-    # TODO Verify policy keys were made previously
-    policy_vkey = f'tmp/{session_uuid}-policy.vkey'
-    policy_script = f'tmp/{session_uuid}-policy.script'
-    policy_id = ''
-
-    policy_script_exists = session.query(Tokens).filter(
-        Tokens.session_uuid == session_uuid).filter(
-        Tokens.policy_script_created).scalar() is not None
+    policy_vkey = token_data.key_file('policy.vkey')
+    policy_script = f'{config.SHARED_DIR}/{session_uuid}-policy.script'
 
-    logging.info(policy_script_exists)
-    if policy_script_exists:
+    if token_data.reached(TokenStage.POLICY_READY):
         logging.info("Policy Script already created for session, skip.")
     else:
-        # Building a token locking policy for NFT
-        policy_dict = {
-            "type": "all",
-            "scripts": [
-                {
-                    "keyHash": "",
-                    "type": "sig"
-                },
-                {
-                    "type": "before",
-                    "slot": 0
-                }
-            ]
-        }
+        # The policy locks SLOT_BUFFER slots from now, the TX must be in before that
+        current_slot = get_current_slot()
+        slot_cushion = config.SLOT_BUFFER
+        invalid_after_slot = current_slot + slot_cushion
         # Generate policy key-hash
-        cmd = f"{config.CARDANO_CLI} address key-hash " \
-              f"--payment-verification-key-file {policy_vkey}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        response = str(out[0], 'UTF-8')
-        policy_keyhash = response.strip()
-        if policy_keyhash:
-            logging.info(f"Policy keyHash created: {policy_keyhash}")
-            token_data.policy_keyhash = policy_keyhash
-            session.add(token_data)
-            session.commit()
-        else:
-            logging.info("Policy keyHash failed to create")
+        try:
+            policy_keyhash = policy_util.policy_keyhash(policy_vkey)
+        except (OSError, ValueError, KeyError):
+            logging.exception("Policy keyHash failed to create")
             return False
+        logging.info(f"Policy keyHash created: {policy_keyhash}")
 
-        # Add keyHash and slot to dict
-        policy_dict["scripts"][0]["keyHash"] = policy_keyhash
-        policy_dict["scripts"][1]["slot"] = current_slot + slot_cushion
+        # Building a token locking policy for NFT
+        policy_dict = policy_util.build_policy(
+            policy_keyhash, before_slot=invalid_after_slot)
 
         logging.info(f"Policy Dictionary for token: {policy_dict}")
         # Write out the policy script to a file for later
-        policy_script_out = open(policy_script, "w+")
-        json.dump(policy_dict, policy_script_out)
-        policy_script_out.close()
-        token_data.policy_keys_created = True
-        session.add(token_data)
-        session.commit()
+        with open(policy_script, "w+") as policy_script_out:
+            json.dump(policy_dict, policy_script_out)
 
         # Generate policy ID
-
-        cmd = f"{config.CARDANO_CLI} transaction policyid --script-file {policy_script}"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = proc.communicate()
-        policy_id = str(out[0], 'UTF-8')
+        policy_id = policy_util.policy_id(policy_dict)
         logging.info(f"Policy ID: {policy_id}")
-        token_data.policy_id = policy_id
-        session.add(token_data)
-        session.commit()
+        token_repo.advance(
+            session, token_data, TokenStage.POLICY_READY,
+            current_slot=current_slot, slot_cushion=slot_cushion,
+            invalid_after_slot=invalid_after_slot,
+            policy_keyhash=policy_keyhash, policy_id=policy_id)
 
     # Create Metadata
 
-    metadata_file = f'tmp/{session_uuid}-metadata.json'
+    metadata_file = f'{config.SHARED_DIR}/{session_uuid}-metadata.json'
     meta_dict = {
         "721": {
             token_data.policy_id.strip(): {
@@ -382,147 +342,159 @@ def mint(**kwargs):
         }
     }
     # Write out the policy
-    metadata_out = open(metadata_file, "w+")
-    json.dump(meta_dict, metadata_out)
-    metadata_out.close()
+    with open(metadata_file, "w+") as metadata_out:
+        json.dump(meta_dict, metadata_out)
     logging.info("Created metadata.json")
-    token_data.metadata_created = True
-    session.add(token_data)
-    session.commit()
-
-    matx_raw = f'tmp/{session_uuid}-matx.raw'
-    # Build Raw TX
-    tx_fee = 0
-    cmd = f'{config.CARDANO_CLI} transaction build-raw ' \
-          f'--fee {tx_fee} ' \
-          f'--tx-in {tx_hash}#{tx_ix} ' \
-          f'--tx-out {token_data.creator_pay_addr}+{available_lovelace}+"{token_data.token_amount} {token_data.policy_id.strip()}.{token_data.token_ticker}" ' \
-          f'--mint="{token_data.token_amount} {token_data.policy_id.strip()}.{token_data.token_ticker}" ' \
-          f'--metadata-json-file {metadata_file} ' \
-          f'--invalid-hereafter={invalid_after_slot} ' \
-          f'--out-file {matx_raw}'
-
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    # Command does not return anything
-    out = proc.communicate()
-    if out[1] is None:
-        logging.info(out)
-        logging.info("Raw transaction created")
-        token_data.raw_tx_created = True
-        session.add(token_data)
-        session.commit()
-    else:
-        logging.info(out)
-        logging.info('Something failed on building the transaction')
-        return False
-
-    # Calculate Fee [or hard set to 3 ADA]
-    protocol_params = 'tmp/protocol.json'
-    cmd = f"{config.CARDANO_CLI} transaction calculate-min-fee " \
-          f"--tx-body-file {matx_raw} " \
-          f"--tx-in-count 1 " \
-          f"--tx-out-count 1 " \
-          f"--witness-count 1 " \
-          f"--testnet-magic {config.TESTNET_ID} " \
-          f"--protocol-params-file {protocol_params}"
-
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    out = proc.communicate()
-    response = str(out[0], 'UTF-8').split()
-    # calculate-fee always seems low in testnet
-    # Add 100 Lovelace for reasons ???
-    tx_fee = int(response[0]) + 100
+    # Committed together with the signed TX
+    token_data.advance(TokenStage.METADATA_READY)
+
+    # Build the TX from this
+    with open(policy_script) as policy_script_in:
+        policy_dict = json.load(policy_script_in)
+    token_bundle = {
+        token_data.policy_id.strip(): {token_data.token_ticker: token_data.token_amount}
+    }
+    return {
+        'token_data': token_data,
+        'progress': progress,
+        'tx_in': (token_data.utxo_tx_hash, int(token_data.utxo_tx_ix)),
+        # Return the ADA minus fees plus the token back to the funder
+        'tx_out': (token_data.creator_pay_addr, int(token_data.utxo_lovelace), token_bundle),
+        'mint': token_bundle,
+        'metadata': meta_dict["721"],
+        'policy_script': policy_dict,
+        'signing_keys': [
+            token_data.key_file('payment.skey'),
+            token_data.key_file('policy.skey'),
+        ],
+        'invalid_after_slot': token_data.invalid_after_slot,
+    }
 
-    logging.info(f'The TX fee today: {tx_fee}')
-    # Build TX with Fees
-
-    matx_raw = f'tmp/{session_uuid}-real-matx.raw'
-    # Build Raw TX
-    ada_return = available_lovelace - tx_fee
-    logging.info(f"Return this much plus token back to the "
-          f"original funder: {ada_return} lovelace")
-    cmd = f'{config.CARDANO_CLI} transaction build-raw ' \
-          f'--fee {tx_fee} ' \
-          f'--tx-in {tx_hash}#{tx_ix} ' \
-          f'--tx-out {token_data.creator_pay_addr}+{ada_return}+"{token_data.token_amount} {token_data.policy_id.strip()}.{token_data.token_ticker}" ' \
-          f'--mint="{token_data.token_amount} {token_data.policy_id.strip()}.{token_data.token_ticker}" ' \
-          f'--metadata-json-file {metadata_file} ' \
-          f'--invalid-hereafter={invalid_after_slot} ' \
-          f'--out-file {matx_raw}'
-
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    # Command does not return anything
-    out = proc.communicate()
-
-    if out[1] is None:
-        logging.info(out)
-        logging.info("Real Raw transaction created")
-    else:
-        logging.info(out)
-        logging.info('Something failed on building the real transaction')
+def _build_tx(legs):
+    """ Builds and signs one transaction minting every leg """
+    mint_bundle = {}
+    metadata = {}
+    for leg in legs:
+        mint_bundle.update(leg['mint'])
+        metadata.update(leg['metadata'])
+    return tx_util.build_signed_tx(
+        inputs=[leg['tx_in'] for leg in legs],
+        outputs=[leg['tx_out'] for leg in legs],
+        # Every policy must still be open
+        invalid_hereafter=min(leg['invalid_after_slot'] for leg in legs),
+        protocol_params=protocol_params.get(),
+        signing_keys=[key_util.signing_key(skey)
+                      for leg in legs for skey in leg['signing_keys']],
+        scripts=[leg['policy_script'] for leg in legs],
+        mint=mint_bundle,
+        metadata={"721": metadata},
+        # Everybody pays an equal share of the fee
+        fee_payers=range(len(legs)),
+    )
+
+def _build_and_submit(session, legs, tx_prefix):
+    """ Builds, signs and submits one TX for all legs
+    Files are written as {tx_prefix}-matx.raw and {tx_prefix}-matx.signed """
+    try:
+        signed_tx, raw_tx, tx_id, tx_fee = _build_tx(legs)
+    except (OSError, ValueError, KeyError, RuntimeError):
+        logging.exception('Something failed on building the transaction')
         return False
+    logging.info(f'The TX fee today: {tx_fee}')
 
-    # Sign TX
-    payment_skey_file = f'tmp/{session_uuid}-payment.skey'
-    policy_skey = f'tmp/{session_uuid}-policy.skey'
-
-    matx_signed = f'tmp/{session_uuid}-matx.signed'
-    cmd = f"{config.CARDANO_CLI} transaction sign " \
-          f"--signing-key-file {payment_skey_file} " \
-          f"--signing-key-file {policy_skey} " \
-          f"--script-file {policy_script} " \
-          f"--testnet-magic {config.TESTNET_ID} " \
-          f"--tx-body-file {matx_raw} " \
-          f"--out-file {matx_signed}"
-
-
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    # Command does not return anything
-    out = proc.communicate()
-    if out[1] is None:
-        logging.info(out)
-        logging.info("Transaction signed")
-        token_data.signed_tx_created = True
-        session.add(token_data)
-        session.commit()
-    else:
-        logging.info(out)
-        logging.info('Something failed on Transaction signing')
-        return False
+    matx_raw = f'{tx_prefix}-matx.raw'
+    tx_util.write_envelope(matx_raw, tx_util.TX_BODY_TYPE, raw_tx)
+    logging.info("Raw transaction created")
+
+    matx_signed = f'{tx_prefix}-matx.signed'
+    tx_util.write_envelope(matx_signed, tx_util.TX_SIGNED_TYPE, signed_tx)
+    logging.info(f"Transaction signed: {tx_id}")
+    for leg in legs:
+        leg['progress']("Transaction built and signed.")
+    token_repo.advance_all(
+        session, [leg['token_data'] for leg in legs], TokenStage.SIGNED, tx_file=matx_signed)
 
     # Send to Blockchain
-    cmd = f"{config.CARDANO_CLI} transaction submit " \
-          f"--tx-file  {matx_signed} " \
-          f"--testnet-magic {config.TESTNET_ID}"
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    # Command does not return anything
-    out = proc.communicate()
-    if out[1] is None:
-        logging.info(out)
-        logging.info("Transaction Submitted")
-        token_data.tx_submitted = True
-        session.add(token_data)
-        session.commit()
-    else:
-        logging.info(out)
+    if not submit_tx(matx_signed):
         logging.info('Something failed on Transaction Submitted')
         return False
+    logging.info("Transaction Submitted")
+    for leg in legs:
+        leg['progress']("Transaction submitted, waiting for confirmation...")
+    token_repo.advance_all(
+        session, [leg['token_data'] for leg in legs], TokenStage.SUBMITTED,
+        tx_submitted_at=datetime.utcnow(), tx_resubmits=0)
+
+    # The confirm_watcher picks it up from here
+    return True
 
-    # Verify Sent
-    confirmed = False
-    while confirmed is False:
-        creator_utxo = check_wallet_utxo(token_data.creator_pay_addr)
-        if creator_utxo:
-            # Sleep while wait for BlockFrost to pick up TX
-            time.sleep(5)
-            nft_tx_details = get_tx_details(creator_utxo[0])
-            logging.info(nft_tx_details)
-            # Done with minting
-            token_data.token_tx_hash = creator_utxo[0]
-            session.add(token_data)
-            session.commit()
-            return True
-        confirmed = False
-        # Sleep for 5 sec, blocks are 20 seconds
-        # so we should get a confirmation in 4 tries
-        time.sleep(5)
+def _check_leg(leg, current_slot):
+    """ Raises when the leg can't be minted, e.g. its policy is locked,
+    a key file is missing or the funding doesn't cover the fee """
+    if leg['invalid_after_slot'] <= current_slot:
+        raise ValueError(f"Policy locked at slot {leg['invalid_after_slot']}")
+    # Alone it pays the whole fee, more than its share of a batch
+    fee = _build_tx([leg])[3]
+    if leg['tx_out'][1] - fee < tx_util.min_ada(leg['mint'], protocol_params.get()):
+        raise ValueError("Funding doesn't cover the fee and the minimum ADA")
+
+def _fit_batch(legs):
+    """ Drops legs from the end until the TX fits maxTxSize
+    Returns the legs that fit """
+    max_size = protocol_params.get()['maxTxSize'] * config.BATCH_SIZE_MARGIN
+    while len(legs) > 1:
+        size = len(_build_tx(legs)[0])
+        if size <= max_size:
+            break
+        # Shrink in proportion to the overshoot
+        legs = legs[:min(len(legs) - 1, int(len(legs) * max_size / size))]
+    return legs
+
+def mint_batch(session_uuids, progress=None):
+    """ Mints several funded sessions in a single transaction
+    progress maps session_uuid -> callable(text)
+    Returns a dict of session_uuid -> True (submitted), False (failed)
+    or None (did not fit or funding not indexed yet, try again later) """
+    progress = progress or {}
+    logging.info(f'Batch minting started for {session_uuids}')
+    with session_scope() as session:
+        return _mint_batch(session, session_uuids, progress)
+
+def _mint_batch(session, session_uuids, progress):
+    results = {session_uuid: False for session_uuid in session_uuids}
+    current_slot = get_current_slot()
+    legs = []
+    # A bad leg fails its own session only, the batch is built from the rest
+    for token_data in session.query(Tokens).filter(
+            Tokens.session_uuid.in_(session_uuids)).all():
+        session_uuid = token_data.session_uuid
+        if token_data.reached(TokenStage.SUBMITTED):
+            logging.info(f"Session already Minted: {session_uuid}")
+            continue
+        try:
+            leg = _prepare_mint(session, token_data, progress.get(session_uuid) or _no_progress)
+            if leg:
+                _check_leg(leg, current_slot)
+        except (OSError, ValueError, KeyError, RuntimeError):
+            logging.exception(f"Session {session_uuid} dropped from the batch")
+            continue
+        if leg:
+            legs.append(leg)
+        elif leg is None:
+            results[session_uuid] = None
+    if not legs:
+        return results
+
+    try:
+        fitting = _fit_batch(legs)
+    except (OSError, ValueError, KeyError, RuntimeError):
+        logging.exception('Something failed on sizing the batch')
+        return results
+    for leg in legs[len(fitting):]:
+        results[leg['token_data'].session_uuid] = None
+
+    submitted = _build_and_submit(session, fitting, f'{config.SHARED_DIR}/batch-{uuid4()}')
+    for leg in fitting:
+        results[leg['token_data'].session_uuid] = submitted
+    logging.info(f"Batch of {len(fitting)} sessions submitted: {submitted}")
+    return results
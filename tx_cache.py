@@ -0,0 +1,73 @@
+# tx_cache.py
+# Confirmed transactions never change, their Blockfrost UTXO data is kept
+# in memory (LRU) and in the tx_details table. Hashes Blockfrost doesn't
+# know yet are remembered for a short while only.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from sqlalchemy.exc import SQLAlchemyError
+
+from create_db import session_scope, TxDetails
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_memory = OrderedDict()
+# tx_hash -> monotonic time the miss expires
+_missing = {}
+
+
+def _remember(tx_hash, details):
+    with _lock:
+        _memory[tx_hash] = details
+        _memory.move_to_end(tx_hash)
+        while len(_memory) > config.TX_CACHE_SIZE:
+            _memory.popitem(last=False)
+        _missing.pop(tx_hash, None)
+
+
+def get(tx_hash):
+    """ Cached details, False for a recent miss, None when unknown """
+    with _lock:
+        if tx_hash in _memory:
+            _memory.move_to_end(tx_hash)
+            return _memory[tx_hash]
+        expires = _missing.get(tx_hash)
+        if expires is not None:
+            if time.monotonic() < expires:
+                return False
+            del _missing[tx_hash]
+    with session_scope() as session:
+        row = session.query(TxDetails).filter(TxDetails.tx_hash == tx_hash).one_or_none()
+        details = json.loads(row.details) if row else None
+    if details is not None:
+        _remember(tx_hash, details)
+    return details
+
+
+def put(tx_hash, details):
+    """ Stores the details of a confirmed transaction for good """
+    _remember(tx_hash, details)
+    try:
+        # Not part of the caller's transaction, a duplicate must not undo it
+        with session_scope(independent=True) as session:
+            if session.query(TxDetails).filter(TxDetails.tx_hash == tx_hash).count() == 0:
+                session.add(TxDetails(tx_hash=tx_hash, details=json.dumps(details)))
+    except SQLAlchemyError:
+        # Another thread stored it first, memory has it anyway
+        logger.exception(f"Could not store details of {tx_hash}")
+
+
+def put_missing(tx_hash):
+    """ Blockfrost doesn't know the hash yet, ask again after TX_CACHE_MISS_TTL """
+    with _lock:
+        _missing[tx_hash] = time.monotonic() + config.TX_CACHE_MISS_TTL
+        # Expired misses are dropped once there are too many
+        if len(_missing) > config.TX_CACHE_SIZE:
+            now = time.monotonic()
+            for key in [k for k, expires in _missing.items() if expires <= now]:
+                del _missing[key]
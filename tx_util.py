@@ -0,0 +1,155 @@
+# tx_util.py
+# Mary era transactions built, fee balanced and signed in-process.
+# Only the submit is left to cardano-cli.
+
+import hashlib
+import json
+
+import cbor_util
+import key_util
+import policy_util
+import logging
+logger = logging.getLogger(__name__)
+
+# Text envelope types used by cardano-cli in the Mary era
+TX_BODY_TYPE = 'TxBodyMary'
+TX_SIGNED_TYPE = 'Tx MaryEra'
+
+# cardano-cli rejects metadata strings longer than this
+METADATA_MAX_STR = 64
+
+
+def blake2b_256(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def min_fee(tx_size, protocol_params):
+    """ Linear fee: txFeePerByte * size + txFeeFixed """
+    return protocol_params['txFeePerByte'] * tx_size + protocol_params['txFeeFixed']
+
+
+def min_ada(assets, protocol_params):
+    """ Mary era minimum ADA of an output holding the given assets """
+    min_utxo = protocol_params.get('minUTxOValue') or 1000000
+    if not assets:
+        return min_utxo
+    names = {name for tokens in assets.values() for name in tokens}
+    token_count = sum(len(tokens) for tokens in assets.values())
+    name_bytes = sum(len(name.encode('utf-8')) for name in names)
+    # Size of the value in 8 byte words
+    size = 6 + (token_count * 12 + name_bytes + len(assets) * 28 + 7) // 8
+    # Relative to an ADA only UTXO of 27 words
+    return max(min_utxo, (min_utxo // 27) * (27 + size))
+
+
+def _metadata_value(value):
+    """ cardano-cli --metadata-json-file no schema mapping """
+    if isinstance(value, dict):
+        return {str(k): _metadata_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_metadata_value(v) for v in value]
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        if len(data) <= METADATA_MAX_STR:
+            return value
+        # Long strings are split into a list of chunks
+        chunks = []
+        while data:
+            size = METADATA_MAX_STR
+            # Don't cut a multi byte character in half
+            while size < len(data) and (data[size] & 0xc0) == 0x80:
+                size -= 1
+            chunks.append(data[:size].decode('utf-8'))
+            data = data[size:]
+        return chunks
+    return value
+
+
+def metadata_to_native(metadata):
+    """ Top level keys are integer labels, e.g. 721 """
+    return {int(label): _metadata_value(value) for label, value in metadata.items()}
+
+
+def _multi_asset(assets):
+    """ {policy_id hex: {asset name: quantity}} -> CBOR structure """
+    return {
+        bytes.fromhex(policy_id): {
+            name.encode('utf-8'): quantity for name, quantity in tokens.items()
+        }
+        for policy_id, tokens in assets.items()
+    }
+
+
+def _output(address, lovelace, assets=None):
+    raw_address = key_util.bech32_decode(address)
+    if assets:
+        return [raw_address, [lovelace, _multi_asset(assets)]]
+    return [raw_address, lovelace]
+
+
+def build_tx_body(inputs, outputs, fee, invalid_hereafter, mint=None, metadata=None):
+    """ Same as cardano-cli transaction build-raw
+    inputs: [(tx_hash, tx_ix)], outputs: [(address, lovelace, assets)]
+    Returns the body and auxiliary data as CBOR structures """
+    body = {
+        0: [[bytes.fromhex(tx_hash), int(tx_ix)] for tx_hash, tx_ix in inputs],
+        1: [_output(*output) for output in outputs],
+        2: fee,
+        3: invalid_hereafter,
+    }
+    aux = metadata_to_native(metadata) if metadata else None
+    if aux is not None:
+        body[7] = blake2b_256(cbor_util.dumps(aux))
+    if mint:
+        body[9] = _multi_asset(mint)
+    return body, aux
+
+
+def sign_tx(body, aux, signing_keys, scripts=()):
+    """ Same as cardano-cli transaction sign
+    Returns the signed transaction CBOR and the transaction id """
+    body_cbor = cbor_util.dumps(body)
+    tx_id = blake2b_256(body_cbor)
+    witnesses = {
+        0: [[bytes(key.verify_key), key.sign(tx_id).signature] for key in signing_keys]
+    }
+    if scripts:
+        witnesses[1] = [policy_util.script_to_native(script) for script in scripts]
+    tx_cbor = cbor_util.dumps([body, witnesses, aux])
+    return tx_cbor, tx_id.hex()
+
+
+def build_signed_tx(inputs, outputs, invalid_hereafter, protocol_params,
+                    signing_keys, scripts=(), mint=None, metadata=None, fee_payers=(0,)):
+    """ Builds and signs a transaction paying exactly the minimum fee
+    The fee is split evenly over the outputs in fee_payers
+    Returns (tx_cbor, body_cbor, tx_id, fee) """
+    fee = 0
+    # The fee changes the size of the tx, repeat until it settles
+    for _ in range(5):
+        share, remainder = divmod(fee, len(fee_payers))
+        balanced = [list(output) for output in outputs]
+        for n, index in enumerate(fee_payers):
+            balanced[index][1] -= share + (remainder if n == 0 else 0)
+        body, aux = build_tx_body(inputs, balanced, fee, invalid_hereafter, mint, metadata)
+        tx_cbor, tx_id = sign_tx(body, aux, signing_keys, scripts)
+        needed = min_fee(len(tx_cbor), protocol_params)
+        if needed <= fee:
+            break
+        fee = needed
+    else:
+        raise ValueError("Transaction fee did not settle")
+    logger.info(f"Transaction {tx_id} size {len(tx_cbor)} fee {fee}")
+    body_cbor = cbor_util.dumps([body, [], aux])
+    return tx_cbor, body_cbor, tx_id, fee
+
+
+def write_envelope(path, envelope_type, cbor):
+    """ Writes a cardano-cli text envelope file """
+    envelope = {
+        "type": envelope_type,
+        "description": "",
+        "cborHex": cbor.hex()
+    }
+    with open(path, 'w') as envelope_file:
+        json.dump(envelope, envelope_file, indent=4)
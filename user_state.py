@@ -0,0 +1,156 @@
+# user_state.py
+# Keeps context.user_data bounded: every user's last activity is tracked in
+# LRU order, users idle longer than USER_DATA_TTL and the least recently
+# seen beyond USER_DATA_MAX_USERS are evicted together with their
+# conversations and persisted data.
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import config
+import logging
+logger = logging.getLogger(__name__)
+
+# The fixed schema of context.user_data, anything else is dropped
+FIELDS = (
+    'token_ipfs_hash',
+    'token_ticker',
+    'token_name',
+    'token_desc',
+    'token_number',
+    # Pre-minted session waiting for /MINT or its funding
+    'session_uuid',
+    'collection_files',
+)
+# The draft of a single NFT, gone once it is pre-minted or abandoned
+DRAFT_FIELDS = FIELDS[:5]
+
+_lock = threading.Lock()
+# user_id -> monotonic time of the last update, least recent first
+_seen = OrderedDict()
+_metrics = {'evicted_idle': 0, 'evicted_lru': 0, 'dropped_keys': 0, 'sweeps': 0}
+_watcher = None
+
+
+def touch(update, _context):
+    """ TypeHandler callback, records the user's activity for every update """
+    user = update.effective_user
+    if user is None:
+        return
+    with _lock:
+        _seen[user.id] = time.monotonic()
+        _seen.move_to_end(user.id)
+
+
+def clear(context, *keep):
+    """ Empties the user's user_data except the keep fields """
+    for key in [key for key in context.user_data if key not in keep]:
+        del context.user_data[key]
+
+
+def _end_conversations(dispatcher, user_id):
+    """ Ends the user's conversations in every ConversationHandler """
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            conversations = getattr(handler, 'conversations', None)
+            if not conversations:
+                continue
+            # Keys are (chat_id, user_id) tuples
+            for key in [key for key in list(conversations) if key and key[-1] == user_id]:
+                conversations.pop(key, None)
+                if dispatcher.persistence and handler.persistent:
+                    dispatcher.persistence.update_conversation(handler.name, key, None)
+
+
+def _evict(dispatcher, user_id):
+    dispatcher.user_data.pop(user_id, None)
+    _end_conversations(dispatcher, user_id)
+    if dispatcher.persistence:
+        dispatcher.persistence.drop_user_data(user_id)
+
+
+def _prune(user_data):
+    """ Drops keys outside FIELDS, e.g. from older bot versions """
+    unknown = [key for key in user_data if key not in FIELDS]
+    for key in unknown:
+        user_data.pop(key, None)
+    return len(unknown)
+
+
+def sweep(dispatcher):
+    """ Evicts idle users and the least recently seen beyond the cap """
+    now = time.monotonic()
+    idle, over = [], []
+    with _lock:
+        # Users restored by the persistence count as seen at start
+        for user_id in list(dispatcher.user_data):
+            if user_id not in _seen:
+                _seen[user_id] = now
+                _seen.move_to_end(user_id, last=False)
+        for user_id, seen in _seen.items():
+            if now - seen < config.USER_DATA_TTL:
+                break
+            idle.append(user_id)
+        for user_id in idle:
+            del _seen[user_id]
+        while len(_seen) > config.USER_DATA_MAX_USERS:
+            over.append(_seen.popitem(last=False)[0])
+    for user_id in idle + over:
+        _evict(dispatcher, user_id)
+    dropped = 0
+    for user_data in list(dispatcher.user_data.values()):
+        dropped += _prune(user_data)
+    with _lock:
+        _metrics['evicted_idle'] += len(idle)
+        _metrics['evicted_lru'] += len(over)
+        _metrics['dropped_keys'] += dropped
+        _metrics['sweeps'] += 1
+    if over:
+        logger.warning(f"{len(over)} users evicted over the cap of {config.USER_DATA_MAX_USERS}")
+    logger.info(f"Evicted {len(idle)} idle users, {metrics(dispatcher)}")
+
+
+def _size(value):
+    """ Rough bytes of a user_data value, containers one level deep """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+def metrics(dispatcher):
+    """ Users held in memory, their approximate footprint and evictions """
+    user_data = list(dispatcher.user_data.items())
+    approx_bytes = sum(
+        sys.getsizeof(data) + sum(_size(value) for value in data.values())
+        for _, data in user_data)
+    with _lock:
+        return {
+            'users': len(user_data),
+            'tracked': len(_seen),
+            'approx_bytes': approx_bytes,
+            **_metrics
+        }
+
+
+def _watch(dispatcher, stop_event):
+    while not stop_event.wait(config.USER_DATA_SWEEP_INTERVAL):
+        try:
+            sweep(dispatcher)
+        except Exception:
+            logger.exception("user_data sweep failed")
+
+
+def start(dispatcher):
+    """ Starts the background sweeper """
+    global _watcher
+    if _watcher is not None:
+        return _watcher
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=_watch, args=(dispatcher, stop_event), name="user-state", daemon=True)
+    thread.start()
+    _watcher = stop_event
+    return stop_event